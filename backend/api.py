@@ -1,26 +1,40 @@
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import sqlite3
+import asyncio
 import json
 import logging
-from typing import Dict, Optional, Any
+from typing import Dict, List, Optional, Any
 from datetime import datetime
 import os
 import requests
-from src import logic
+from contextlib import asynccontextmanager
+from src import logic, db, events, querystats, metrics, importer, fx, archive, backup, maintenance
+from src.serialization import FastJSONResponse, RawJSON, CompressionMiddleware
 # Import handlers for webhook processing
 # Note: handlers must be available in python path. Since it is in src/, we import from src
 from src import handlers
 
 # --- Config ---
-DB_PATH = "data/splitopus.db"
+DB_PATH = os.getenv("DB_PATH", "data/splitopus.db")
 
 # --- Setup ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Scheduled backups and database maintenance run here and not in the bot: one process per volume
+    backup.scheduler.start()
+    maintenance.scheduler.start()
+    yield
+    maintenance.scheduler.stop()
+    backup.scheduler.stop()
+
+app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -30,6 +44,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware, minimum_size=1024)
+# Per-request SQL counts and N+1 warnings, tagged with the route
+app.add_middleware(querystats.QueryStatsMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+
+OVERVIEW_FIELDS = ("members", "expenses", "balances", "debts", "stats")
+OVERVIEW_PAGE_SIZE = 50
+# SSE comment lines keep idle connections open through nginx (proxy_read_timeout is 60s)
+EVENTS_KEEPALIVE_SECONDS = 15
+
+CONDITIONAL_GETS = metrics.counter(
+    "splitopus_conditional_get_total",
+    "Trip GETs by If-None-Match outcome: hit (304), miss (stale ETag) or none (no header)", ["result"])
 
 # --- Models ---
 class ExpenseCreate(BaseModel):
@@ -39,13 +66,132 @@ class ExpenseCreate(BaseModel):
     description: str
     category: str
     split: Dict[str, float]
+    # Amount and split in this currency; converted to the trip currency on insert
+    currency: Optional[str] = None
+
+class ExpenseUpdate(BaseModel):
+    # Only the fields sent are changed; amount and split are in the currency the expense
+    # was entered in (see db.update_expense)
+    payer_id: Optional[str] = None
+    amount: Optional[float] = None
+    description: Optional[str] = None
+    category: Optional[str] = None
+    split: Optional[Dict[str, float]] = None
+    user_id: Optional[str] = None  # who edits, for the audit log
+
+class ExpenseImport(BaseModel):
+    # Rows as described in src/importer.py: payer_id (or payer name), amount, description,
+    # category, split (optional, default: all members equally), created_at / date, currency
+    expenses: List[Dict[str, Any]]
+    imported_by: Optional[str] = None
 
 # --- DB Helper ---
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = querystats.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
+def _decode_expense(row):
+    exp = dict(row)
+    try:
+        exp["split"] = json.loads(row["split_json"]) if row["split_json"] else {}
+    except:
+        exp["split"] = {}
+    del exp["split_json"]
+    return exp
+
+def _raw_expense(row):
+    """Like _decode_expense, but keeps split as stored JSON text for list responses."""
+    exp = dict(row)
+    exp["split"] = RawJSON(exp.pop("split_json"))
+    return exp
+
+# Expense columns of list responses (/api/expenses, /overview, /changes)
+EXPENSE_COLUMNS = ("id", "payer_id", "amount", "description", "category", "created_at", "split_json",
+                   "currency", "original_amount")
+# split_json goes out verbatim (RawJSON): a corrupt row becomes {} in SQL, as _decode_expense does,
+# instead of breaking the whole response (json_object() rather than '{}': _select_in formats the query)
+EXPENSE_SELECT = ("id, payer_id, amount, description, category, created_at, "
+                  "CASE WHEN json_valid(split_json) THEN split_json ELSE json_object() END AS split_json, "
+                  "currency, original_amount")
+
+def _archived_rows(cursor, trip_id, columns=EXPENSE_COLUMNS, newest_first=True):
+    """Expense rows of an archived trip from its archive file (src/archive.py); None if it is not archived."""
+    if not archive.is_archived(cursor, trip_id):
+        return None
+    rows = archive.load(trip_id)["expenses"]
+    if newest_first:
+        rows = sorted(rows, key=lambda r: (r["created_at"], r["id"]), reverse=True)
+    return [{k: row.get(k) for k in columns} for row in rows]
+
+def _member_names(members_rows):
+    return {row["id"]: row["name"] for row in members_rows}
+
+def _load_balance_trip(cursor, trip_id, members_rows, version=None):
+    """
+    Builds the minimal trip dict logic.calculate_balance needs. id + version let the
+    NumPy engine reuse its columns for large trips (src/fastbalance.py).
+    """
+    cursor.execute("""
+    SELECT payer_id, amount, category, created_at, split_json 
+    FROM expenses 
+    WHERE trip_id = ? AND deleted_at IS NULL
+    """, (trip_id,))
+    rows = cursor.fetchall()
+    if not rows:
+        rows = _archived_rows(cursor, trip_id, ("payer_id", "amount", "category", "created_at", "split_json"),
+                              newest_first=False) or []
+    expenses = []
+    for row in rows:
+        exp = _decode_expense(row)
+        exp["ts"] = row["created_at"]
+        expenses.append(exp)
+    return {
+        'id': trip_id,
+        'version': version,
+        'members': [row["id"] for row in members_rows],
+        'expenses': expenses
+    }
+
+# --- Conditional GET ---
+def _trip_version(cursor, trip_id):
+    cursor.execute("SELECT version FROM trips WHERE id = ?", (trip_id,))
+    row = cursor.fetchone()
+    return row["version"] if row else None
+
+def _trip_etag(trip_id, version):
+    if version is None: return None
+    return f'"{trip_id}.{version}"'
+
+def _etag_matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not etag or not header: return False
+    # nginx weakens ETags of gzipped responses, so W/ is accepted as well
+    tags = [t.strip() for t in header.split(",")]
+    tags = [t[2:] if t.startswith("W/") else t for t in tags]
+    return "*" in tags or etag in tags
+
+def _cache_headers(etag):
+    # No shared-cache lifetime: a copy served without asking us could be a version behind the
+    # /changes the client already applied. Every reuse is an If-None-Match -> cheap 304
+    return {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+    }
+
+def _conditional(request, cursor, trip_id):
+    """
+    Checks If-None-Match against the trip version before any expense rows are read.
+    Returns (304 response to send as-is or None, cache headers for the full response).
+    """
+    etag = _trip_etag(trip_id, _trip_version(cursor, trip_id))
+    if not etag: return None, {}
+    if _etag_matches(request, etag):
+        CONDITIONAL_GETS.inc(result="hit")
+        return Response(status_code=304, headers=_cache_headers(etag)), {}
+    CONDITIONAL_GETS.inc(result="miss" if request.headers.get("if-none-match") else "none")
+    return None, _cache_headers(etag)
+
 # --- Notification Logic ---
 def send_telegram_msg(chat_id, text):
     token = os.getenv('BOT_TOKEN')
@@ -87,12 +233,45 @@ def notify_new_expense(trip_id, payer_id, amount, desc):
     finally:
         conn.close()
 
+def notify_import(trip_id, expenses, imported_by):
+    """One summary per member instead of a message per imported expense."""
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT name, currency FROM trips WHERE id = ?", (trip_id,))
+        trip_row = cursor.fetchone()
+        if not trip_row: return
+        curr = trip_row['currency']
+        cursor.execute("SELECT name FROM users WHERE id = ?", (imported_by,))
+        importer_row = cursor.fetchone()
+        importer_name = importer_row['name'] if importer_row else 'Кто-то'
+        cursor.execute("SELECT user_id FROM trip_members WHERE trip_id = ?", (trip_id,))
+        members = [r['user_id'] for r in cursor.fetchall()]
+
+        spent = [e for e in expenses if e['category'] != "REPAYMENT"]
+        total = sum(e['amount'] for e in spent)
+        for m_id in members:
+            if str(m_id) == str(imported_by): continue
+            share = sum(e['split'].get(str(m_id), 0.0) for e in spent)
+            msg = (f"📥 *{trip_row['name']}*: *{importer_name}* импортировал {len(expenses)} трат "
+                   f"на *{total:,.0f} {curr}*\n👤 Ваша доля: *{share:,.0f} {curr}*")
+            send_telegram_msg(m_id, msg)
+    except Exception as e:
+        logger.error(f'Notification error: {e}')
+    finally:
+        conn.close()
+
 # --- API Endpoints ---
 
 @app.get("/")
 def health_check():
     return {"status": "ok", "service": "splitopus-api"}
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus scrape target. nginx only proxies /api/, so this stays internal."""
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
 @app.post("/api/webhook")
 async def telegram_webhook(update: Dict[str, Any] = Body(...)):
     """Handle Telegram Webhook updates."""
@@ -103,15 +282,16 @@ async def telegram_webhook(update: Dict[str, Any] = Body(...)):
     return {"ok": True}
 
 @app.get("/api/trips/{user_id}")
-def get_user_trips(user_id: str):
+def get_user_trips(user_id: str, archived: bool = False):
+    """Current trips; ?archived=true lists the archived ones instead."""
     conn = get_db()
     cursor = conn.cursor()
     try:
-        query = """
-        SELECT t.id, t.code, t.name, t.currency, t.rate
+        query = f"""
+        SELECT t.id, t.code, t.name, t.currency, t.rate, t.archived_at
         FROM trips t
         JOIN trip_members tm ON t.id = tm.trip_id
-        WHERE tm.user_id = ?
+        WHERE tm.user_id = ? AND t.archived_at IS {'NOT ' if archived else ''}NULL
         ORDER BY t.created_at DESC
         """
         cursor.execute(query, (user_id,))
@@ -123,31 +303,40 @@ def get_user_trips(user_id: str):
     finally:
         conn.close()
 
+@app.get("/api/users/{user_id}/summary")
+def get_user_summary(user_id: str):
+    """
+    Net position per trip and per counterparty across all of the user's trips, from
+    trip_balances (kept up to date on insert): a handful of queries however many trips
+    and expenses there are. Amounts are in each trip's currency.
+    """
+    try:
+        master_id, trips, link_map, names = db.get_user_ledger(user_id)
+        return dict(logic.user_summary(master_id, trips, link_map, names), user_id=user_id)
+    except Exception as e:
+        logger.error(f"Error building summary for {user_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/expenses/{trip_id}")
-def get_trip_expenses(trip_id: str):
+def get_trip_expenses(trip_id: str, request: Request):
     conn = get_db()
     cursor = conn.cursor()
     try:
-        query = """
-        SELECT id, payer_id, amount, description, category, created_at, split_json
+        not_modified, cache_headers = _conditional(request, cursor, trip_id)
+        if not_modified: return not_modified
+        
+        query = f"""
+        SELECT {EXPENSE_SELECT}
         FROM expenses
-        WHERE trip_id = ?
+        WHERE trip_id = ? AND deleted_at IS NULL
         ORDER BY created_at DESC
         """
         cursor.execute(query, (trip_id,))
-        rows = cursor.fetchall()
+        rows = cursor.fetchall() or _archived_rows(cursor, trip_id) or []
         
-        expenses = []
-        for row in rows:
-            exp = dict(row)
-            try:
-                exp["split"] = json.loads(row["split_json"]) if row["split_json"] else {}
-            except:
-                exp["split"] = {}
-            del exp["split_json"]
-            expenses.append(exp)
-            
-        return {"expenses": expenses}
+        expenses = [_raw_expense(row) for row in rows]
+
+        return FastJSONResponse({"expenses": expenses}, headers=cache_headers)
     except Exception as e:
         logger.error(f"Error fetching expenses: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -156,45 +345,161 @@ def get_trip_expenses(trip_id: str):
 
 @app.post("/api/expenses")
 def create_expense(expense: ExpenseCreate):
-    conn = get_db()
-    cursor = conn.cursor()
     try:
-        split_json = json.dumps(expense.split)
-        created_at = int(datetime.now().timestamp())
-        
-        query = """
-        INSERT INTO expenses (trip_id, payer_id, amount, description, category, created_at, split_json)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """
-        cursor.execute(query, (
-            expense.trip_id,
-            expense.payer_id,
-            expense.amount,
-            expense.description,
-            expense.category,
-            created_at,
-            split_json
-        ))
-        conn.commit()
-        new_id = cursor.lastrowid
-        
-        logger.info(f"New expense created: ID={new_id}")
-        
-        notify_new_expense(expense.trip_id, expense.payer_id, expense.amount, expense.description)
-        
-        return {"status": "success", "id": new_id}
+        new = db.create_expense(expense.trip_id, expense.payer_id, expense.amount, expense.description,
+                                expense.category, expense.split, fx.currency_code(expense.currency))
+    except db.TripArchived:
+        raise HTTPException(status_code=409, detail="Trip is archived")
+    except (ValueError, fx.RateMissing) as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         logger.error(f"Error creating expense: {e}")
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+
+    logger.info(f"New expense created: ID={new['id']}")
+    events.broker.wake()
+
+    notify_new_expense(expense.trip_id, expense.payer_id, new["amount"], expense.description)
+
+    return {"status": "success", "id": new["id"], "amount": new["amount"]}
+
+@app.patch("/api/expenses/{expense_id}")
+def update_expense(expense_id: int, payload: ExpenseUpdate):
+    """Edits an expense in place; balances and stats take only the delta."""
+    changes = payload.model_dump(exclude_unset=True, exclude={"user_id"})
+    if changes.get("amount") is not None and changes["amount"] <= 0:
+        raise HTTPException(status_code=422, detail="amount must be positive")
+    if any(v is None for v in changes.values()):
+        raise HTTPException(status_code=422, detail="fields cannot be null")
+    try:
+        expense = db.update_expense(expense_id, changes, payload.user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error updating expense {expense_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if expense is None:
+        raise HTTPException(status_code=404, detail="Expense not found")
+    events.broker.wake()
+    return {"status": "success", "expense": expense}
+
+@app.delete("/api/expenses/{expense_id}")
+def delete_expense(expense_id: int, user_id: Optional[str] = None):
+    """Soft delete: the row stays for the audit log, clients get a tombstone in /changes."""
+    try:
+        expense = db.delete_expense(expense_id, user_id)
+    except Exception as e:
+        logger.error(f"Error deleting expense {expense_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if expense is None:
+        raise HTTPException(status_code=404, detail="Expense not found")
+    events.broker.wake()
+    return {"status": "success", "id": expense_id}
+
+@app.post("/api/trips/{trip_id}/archive")
+def archive_trip(trip_id: str):
+    """Moves a finished trip's expenses and notes to cold storage; it stays readable, not writable."""
+    conn = get_db()
+    try:
+        link_map = {r["id"]: r["linked_to"] for r in conn.execute("SELECT id, linked_to FROM users WHERE linked_to IS NOT NULL")}
     finally:
         conn.close()
+    info = archive.archive_trip(trip_id, link_map)
+    if info is None:
+        raise HTTPException(status_code=409, detail="Trip not found or already archived")
+    events.broker.wake()
+    return {"status": "success", **info}
+
+@app.post("/api/trips/{trip_id}/unarchive")
+def unarchive_trip(trip_id: str):
+    if not archive.unarchive_trip(trip_id):
+        raise HTTPException(status_code=409, detail="Trip is not archived")
+    events.broker.wake()
+    return {"status": "success"}
+
+@app.get("/api/expenses/{expense_id}/history")
+def get_expense_history(expense_id: int):
+    return {"history": db.get_expense_history(expense_id)}
+
+def _import_members(trip_id):
+    conn = get_db()
+    try:
+        if not conn.execute("SELECT 1 FROM trips WHERE id = ?", (trip_id,)).fetchone():
+            raise HTTPException(status_code=404, detail="Trip not found")
+        rows = conn.execute("""
+        SELECT tm.user_id, u.name
+        FROM trip_members tm
+        LEFT JOIN users u ON u.id = tm.user_id
+        WHERE tm.trip_id = ?
+        """, (trip_id,)).fetchall()
+        return importer.Members({row["user_id"]: row["name"] for row in rows})
+    finally:
+        conn.close()
+
+def _import_rejected(errors):
+    return HTTPException(status_code=422, detail={
+        "errors": errors[:importer.MAX_ERRORS],
+        "error_count": len(errors),
+    })
+
+def _import_expenses(trip_id, members, rows, imported_by):
+    """Validates every row first; writes nothing unless all of them are fine."""
+    conn = get_db()
+    try:
+        db.ensure_open(conn, trip_id)
+        expenses, errors = importer.validate(rows, members, db.trip_converter(conn, trip_id))
+    except db.TripArchived:
+        raise HTTPException(status_code=409, detail="Trip is archived")
+    finally:
+        conn.close()
+    if errors:
+        raise _import_rejected(errors)
+
+    ids = []
+    try:
+        for chunk_ids in db.import_expenses(trip_id, expenses):
+            ids.extend(chunk_ids)
+            events.broker.wake()
+    except Exception as e:
+        # Chunks are committed one by one: tell the client how far it got
+        logger.error(f"Import into {trip_id} failed after {len(ids)} of {len(expenses)}: {e}")
+        raise HTTPException(status_code=500, detail=f"Imported {len(ids)} of {len(expenses)} expenses: {e}")
+
+    logger.info(f"Imported {len(ids)} expenses into {trip_id}")
+    notify_import(trip_id, expenses, imported_by)
+    return {"status": "success", "imported": len(ids), "first_id": ids[0], "last_id": ids[-1]}
+
+@app.post("/api/trips/{trip_id}/import")
+def import_expenses(trip_id: str, payload: ExpenseImport):
+    """Bulk import of a JSON array of expenses; all-or-nothing validation, chunked inserts."""
+    return _import_expenses(trip_id, _import_members(trip_id), payload.expenses, payload.imported_by)
+
+@app.post("/api/trips/{trip_id}/import/csv")
+async def import_expenses_csv(trip_id: str, request: Request, imported_by: Optional[str] = None):
+    """
+    CSV as the raw request body (Content-Type: text/csv): a spreadsheet with
+    date/payer/amount/description/category/split columns, or a Splitwise export.
+    """
+    body = await request.body()
+
+    def run():
+        members = _import_members(trip_id)
+        try:
+            rows = importer.rows_from_csv(importer.decode(body), members)
+        except importer.RowError as e:
+            raise _import_rejected([{"row": None, "error": str(e)}])
+        return _import_expenses(trip_id, members, rows, imported_by)
+
+    return await run_in_threadpool(run)
 
 @app.get("/api/members/{trip_id}")
-def get_trip_members(trip_id: str):
+def get_trip_members(trip_id: str, request: Request):
     conn = get_db()
     cursor = conn.cursor()
     try:
+        not_modified, cache_headers = _conditional(request, cursor, trip_id)
+        if not_modified: return not_modified
+        
         query = """
         SELECT u.id, u.name
         FROM users u
@@ -203,7 +508,7 @@ def get_trip_members(trip_id: str):
         """
         cursor.execute(query, (trip_id,))
         members = [dict(row) for row in cursor.fetchall()]
-        return {"members": members}
+        return FastJSONResponse({"members": members}, headers=cache_headers)
     except Exception as e:
         logger.error(f"Error fetching members: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -211,10 +516,13 @@ def get_trip_members(trip_id: str):
         conn.close()
 
 @app.get("/api/debts/{trip_id}")
-def get_trip_debts(trip_id: str):
+def get_trip_debts(trip_id: str, request: Request):
     conn = get_db()
     cursor = conn.cursor()
     try:
+        not_modified, cache_headers = _conditional(request, cursor, trip_id)
+        if not_modified: return not_modified
+        
         cursor.execute("""
         SELECT u.id, u.name 
         FROM users u 
@@ -223,41 +531,264 @@ def get_trip_debts(trip_id: str):
         """, (trip_id,))
         members_rows = cursor.fetchall()
         
-        members = [row["id"] for row in members_rows]
-        user_names = {row["id"]: row["name"] for row in members_rows}
-        
-        cursor.execute("""
-        SELECT payer_id, amount, category, created_at, split_json 
-        FROM expenses 
-        WHERE trip_id = ?
-        """, (trip_id,))
-        expenses_rows = cursor.fetchall()
-        
-        expenses = []
-        for row in expenses_rows:
-            exp = dict(row)
-            try:
-                exp["split"] = json.loads(row["split_json"]) if row["split_json"] else {}
-            except:
-                exp["split"] = {}
-            exp["ts"] = row["created_at"]
-            expenses.append(exp)
-            
-        trip = {
-            'members': members,
-            'expenses': expenses
-        }
-        
+        trip = _load_balance_trip(cursor, trip_id, members_rows, _trip_version(cursor, trip_id))
         balances, total_spent, paid_by = logic.calculate_balance(trip, link_map={})
-        transactions = logic.simplify_debts(balances, user_names)
+        transactions = logic.simplify_debts(balances, _member_names(members_rows))
         
-        return {
+        return FastJSONResponse({
             "debts": transactions,
             "balances": balances
-        }
+        }, headers=cache_headers)
         
     except Exception as e:
         logger.error(f"Error calculating debts: {e}")
         raise HTTPException(status_code=500, detail=str(e))
     finally:
         conn.close()
+
+
+@app.get("/api/stats/{trip_id}")
+def get_trip_stats(trip_id: str, request: Request, user_id: Optional[str] = None):
+    """
+    Category totals, the user's share per category and spend per day, read from the
+    rollup tables (db.rollup_expense) in a few indexed lookups whatever the trip size.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        not_modified, cache_headers = _conditional(request, cursor, trip_id)
+        if not_modified: return not_modified
+        return FastJSONResponse(db.get_stats(conn, trip_id, user_id or None), headers=cache_headers)
+    except Exception as e:
+        logger.error(f"Error fetching stats: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+@app.get("/api/trips/{trip_id}/overview")
+def get_trip_overview(trip_id: str, request: Request,
+                      fields: Optional[str] = None, user_id: Optional[str] = None,
+                      limit: int = OVERVIEW_PAGE_SIZE, offset: int = 0):
+    """
+    Everything a trip screen needs in one round trip, read from a single snapshot.
+    fields: comma-separated subset of OVERVIEW_FIELDS (default: all).
+    """
+    wanted = set(OVERVIEW_FIELDS)
+    if fields:
+        wanted = {f.strip() for f in fields.split(",") if f.strip()}
+        unknown = wanted - set(OVERVIEW_FIELDS)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    if limit < 1 or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid pagination")
+
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        # One read transaction -> all parts see the same state of the trip
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT id, code, name, currency, rate, version, archived_at FROM trips WHERE id = ?", (trip_id,))
+        trip_row = cursor.fetchone()
+        if not trip_row:
+            raise HTTPException(status_code=404, detail="Trip not found")
+        etag = _trip_etag(trip_id, trip_row["version"])
+        if _etag_matches(request, etag):
+            CONDITIONAL_GETS.inc(result="hit")
+            return Response(status_code=304, headers=_cache_headers(etag))
+        CONDITIONAL_GETS.inc(result="miss" if request.headers.get("if-none-match") else "none")
+        result = {"trip": dict(trip_row)}
+
+        cursor.execute("""
+        SELECT u.id, u.name
+        FROM users u
+        JOIN trip_members tm ON u.id = tm.user_id
+        WHERE tm.trip_id = ?
+        """, (trip_id,))
+        members_rows = cursor.fetchall()
+        if "members" in wanted:
+            result["members"] = [dict(row) for row in members_rows]
+
+        if "expenses" in wanted and trip_row["archived_at"]:
+            archived = _archived_rows(cursor, trip_id) or []
+            result["expenses"] = [_raw_expense(row) for row in archived[offset:offset + limit]]
+            result["expenses_page"] = {
+                "limit": limit,
+                "offset": offset,
+                "total": len(archived),
+                "has_more": offset + len(result["expenses"]) < len(archived)
+            }
+        elif "expenses" in wanted:
+            cursor.execute(f"""
+            SELECT {EXPENSE_SELECT}
+            FROM expenses
+            WHERE trip_id = ? AND deleted_at IS NULL
+            ORDER BY created_at DESC, id DESC
+            LIMIT ? OFFSET ?
+            """, (trip_id, limit, offset))
+            result["expenses"] = [_raw_expense(row) for row in cursor.fetchall()]
+            cursor.execute("SELECT COUNT(*) FROM expenses WHERE trip_id = ? AND deleted_at IS NULL", (trip_id,))
+            total = cursor.fetchone()[0]
+            result["expenses_page"] = {
+                "limit": limit,
+                "offset": offset,
+                "total": total,
+                "has_more": offset + len(result["expenses"]) < total
+            }
+
+        if wanted & {"balances", "debts"}:
+            trip = _load_balance_trip(cursor, trip_id, members_rows, trip_row["version"])
+            balances, total_spent, paid_by = logic.calculate_balance(trip, link_map={})
+            if "balances" in wanted:
+                result["balances"] = balances
+                result["total_spent"] = total_spent
+            if "debts" in wanted:
+                result["debts"] = logic.simplify_debts(balances, _member_names(members_rows))
+        if "stats" in wanted:
+            # Pre-aggregated on insert (db.rollup_expense), no pass over the expenses
+            result["stats"] = db.get_stats(conn, trip_id, user_id or None)
+
+        return FastJSONResponse(result, headers=_cache_headers(etag))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error building trip overview: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+def _select_in(cursor, query, trip_id, ids):
+    """Runs `... AND <col> IN ({})` in chunks so long change lists stay under SQLite's variable limit."""
+    rows = []
+    ids = list(ids)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        cursor.execute(query.format(",".join("?" * len(chunk))), (trip_id, *chunk))
+        rows.extend(cursor.fetchall())
+    return rows
+
+@app.get("/api/trips/{trip_id}/changes")
+def get_trip_changes(trip_id: str, since: int = 0):
+    """
+    Delta sync: expenses, notes and members changed after the client-held version,
+    plus tombstones for deleted ones. `reset: true` means the client must drop its
+    local copy and take the returned lists as the full state.
+    """
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN")
+        cursor.execute("SELECT id, code, name, currency, rate, version, archived_at FROM trips WHERE id = ?", (trip_id,))
+        trip_row = cursor.fetchone()
+        if not trip_row:
+            raise HTTPException(status_code=404, detail="Trip not found")
+
+        version = trip_row["version"]
+        result = {
+            "version": version,
+            "reset": False,
+            "expenses": [],
+            "notes": [],
+            "members": [],
+            "deleted": {"expenses": [], "notes": [], "members": []}
+        }
+        if since == version:
+            return FastJSONResponse(result)
+
+        floor = db.get_changes_floor(conn)
+        # An archived trip has no rows to pick upserts from: its clients get the full state.
+        # A version ahead of the trip's was seen before a restore from backup
+        if since <= 0 or since > version or floor is None or since < floor or trip_row["archived_at"]:
+            result["reset"] = True
+            result["trip"] = dict(trip_row)
+            if trip_row["archived_at"]:
+                result["expenses"] = [_raw_expense(row) for row in _archived_rows(cursor, trip_id)]
+                result["notes"] = [{k: row.get(k) for k in ("id", "author_name", "text", "created_at")}
+                                   for row in archive.load(trip_id)["notes"]]
+            else:
+                cursor.execute(f"""
+                SELECT {EXPENSE_SELECT}
+                FROM expenses WHERE trip_id = ? AND deleted_at IS NULL ORDER BY created_at DESC
+                """, (trip_id,))
+                result["expenses"] = [_raw_expense(row) for row in cursor.fetchall()]
+                cursor.execute("SELECT id, author_name, text, created_at FROM notes WHERE trip_id = ?", (trip_id,))
+                result["notes"] = [dict(row) for row in cursor.fetchall()]
+            cursor.execute("""
+            SELECT u.id, u.name FROM users u
+            JOIN trip_members tm ON u.id = tm.user_id
+            WHERE tm.trip_id = ?
+            """, (trip_id,))
+            result["members"] = [dict(row) for row in cursor.fetchall()]
+            return FastJSONResponse(result)
+
+        changes = db.get_trip_changes(conn, trip_id, since)
+        upserts = {"expense": [], "note": [], "member": []}
+        for (entity, entity_id), op in changes.items():
+            if entity == "trip":
+                result["trip"] = dict(trip_row)
+            elif op == "delete":
+                result["deleted"][entity + "s"].append(entity_id)
+            else:
+                upserts[entity].append(entity_id)
+
+        if upserts["expense"]:
+            rows = _select_in(cursor, f"""
+            SELECT {EXPENSE_SELECT}
+            FROM expenses WHERE trip_id = ? AND deleted_at IS NULL AND id IN ({{}})
+            """, trip_id, upserts["expense"])
+            result["expenses"] = [_raw_expense(row) for row in rows]
+        if upserts["note"]:
+            rows = _select_in(cursor, """
+            SELECT id, author_name, text, created_at FROM notes WHERE trip_id = ? AND id IN ({})
+            """, trip_id, upserts["note"])
+            result["notes"] = [dict(row) for row in rows]
+        if upserts["member"]:
+            rows = _select_in(cursor, """
+            SELECT u.id, u.name FROM users u
+            JOIN trip_members tm ON u.id = tm.user_id
+            WHERE tm.trip_id = ? AND u.id IN ({})
+            """, trip_id, upserts["member"])
+            result["members"] = [dict(row) for row in rows]
+            # A member change for someone no longer in the trip is a removal
+            present = {str(row["id"]) for row in rows}
+            result["deleted"]["members"].extend(m for m in upserts["member"] if m not in present)
+
+        return FastJSONResponse(result)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error fetching trip changes: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        conn.close()
+
+
+@app.get("/api/trips/{trip_id}/events")
+async def trip_events(trip_id: str, request: Request):
+    """
+    Server-sent events with compact change notices for one trip:
+    {"type": "change", "v": <version>, "e": "expense", "id": "42", "op": "upsert"}.
+    The first event carries the current version; a client that is behind (or gets
+    a "resync") catches up through /api/trips/{trip_id}/changes?since=<its version>.
+    """
+    version = await asyncio.to_thread(db.get_trip_version, trip_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    sub = events.broker.subscribe(trip_id)
+
+    async def stream():
+        try:
+            yield f"retry: 3000\nevent: hello\ndata: {json.dumps({'type': 'hello', 'v': version})}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), timeout=EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event['v']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            events.broker.unsubscribe(sub)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # nginx must not buffer the stream
+    })
@@ -0,0 +1,95 @@
+"""
+API latency while an online backup (src/backup.py) runs against the same database.
+
+    cd backend && python -m benchmarks.backup
+    cd backend && python -m benchmarks.backup --expenses 5000 --pages=-1,64,1024 --sleep-ms 5
+
+The API mix from benchmarks.load (reads plus POST expense) is replayed once with no
+backup, then once per --pages value with a thread taking snapshots back to back for the
+whole phase. Each phase is reported against the idle one (Δp95), together with how long
+a snapshot took and how often SQLite restarted the copy because an expense was written
+in the middle of it. --pages -1 is the copy in one step (the read lock held throughout).
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from benchmarks import harness
+from benchmarks.load import run_api
+
+
+def backup_loop(backup, backup_dir, pages, sleep_ms, stop, runs):
+    while not stop.is_set():
+        info = backup.snapshot(backup_dir, pages=pages, sleep_ms=sleep_ms)
+        os.remove(info["path"])
+        runs.append(info)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API latency during online backups")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--trips", type=int, default=20)
+    parser.add_argument("--members", type=int, default=6)
+    parser.add_argument("--linked", type=float, default=0.2)
+    parser.add_argument("--expenses", type=int, default=2000, help="expenses per trip")
+    parser.add_argument("--requests", type=int, default=1000, help="API requests per phase")
+    parser.add_argument("--pages", default="-1,64,1024", help="comma-separated pages per backup step")
+    parser.add_argument("--sleep-ms", type=float, default=5, help="pause between backup steps")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="splitopus-bench-")
+    db_path = os.path.join(work_dir, "bench.db")
+    os.environ["DB_PATH"] = db_path
+    os.environ.setdefault("BOT_TOKEN", "bench")
+    os.environ.setdefault("TRACE_FILE", os.path.join(work_dir, "traces.jsonl"))
+
+    from benchmarks.seed import seed, SeedConfig
+    dataset = seed(db_path, SeedConfig(
+        users=args.users, trips=args.trips, members_per_trip=args.members,
+        linked_ratio=args.linked, expenses_per_trip=args.expenses, seed=args.seed))
+    print(f"Seeded {db_path}: {os.path.getsize(db_path) / 1e6:.1f} MB, {args.trips} trips x {args.expenses} expenses")
+
+    import logging
+    logging.disable(logging.WARNING)
+    from src import backup
+    backup_dir = os.path.join(work_dir, "backups")
+    results = {}
+
+    recorder = harness.Recorder()
+    run_api(dataset, recorder, args.requests, random.Random(args.seed))
+    results["idle"] = recorder.summary()
+    harness.print_report("api: no backup", results["idle"])
+
+    for pages in (int(p) for p in args.pages.split(",")):
+        stop, runs = threading.Event(), []
+        thread = threading.Thread(target=backup_loop, args=(backup, backup_dir, pages, args.sleep_ms, stop, runs))
+        thread.start()
+        recorder = harness.Recorder()
+        start = time.perf_counter()
+        run_api(dataset, recorder, args.requests, random.Random(args.seed))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        thread.join()
+        name = f"pages={pages}"
+        results[name] = recorder.summary()
+        harness.print_report(f"api: during backups, {name}, sleep {args.sleep_ms} ms", results[name], results["idle"])
+        if runs:
+            mean = sum(r["seconds"] for r in runs) / len(runs)
+            print(f"backups: {len(runs)} in {elapsed:.1f}s, {mean * 1000:.0f} ms each, "
+                  f"{sum(r['restarts'] for r in runs)} restarts")
+        results[name]["backups"] = {"count": len(runs), "restarts": sum(r["restarts"] for r in runs)}
+
+    if args.json:
+        harness.save(args.json, results)
+        print(f"\nResults written to {args.json}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
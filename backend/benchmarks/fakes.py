@@ -0,0 +1,47 @@
+import itertools
+from collections import Counter
+
+
+class FakeTelegramClient:
+    """
+    Drop-in for src.telegram.TelegramClient that never touches the network.
+    Keeps the last markup sent to each chat so a replay can follow the bot's
+    own buttons (draft ids live only in callback_data).
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.last_markup = {}
+        self._message_ids = itertools.count(1000)
+
+    def _sent(self, method, chat_id, reply_markup=None):
+        self.calls[method] += 1
+        if reply_markup is not None:
+            self.last_markup[str(chat_id)] = reply_markup
+        return {"ok": True, "result": {"message_id": next(self._message_ids)}}
+
+    def get_updates(self, offset=None, timeout=60):
+        return []
+
+    def send_message(self, chat_id, text, reply_markup=None, parse_mode="Markdown"):
+        return self._sent("sendMessage", chat_id, reply_markup)
+
+    def edit_message(self, chat_id, message_id, text, reply_markup=None, parse_mode="Markdown"):
+        return self._sent("editMessageText", chat_id, reply_markup)
+
+    def delete_message(self, chat_id, message_id):
+        self.calls["deleteMessage"] += 1
+        return {"ok": True, "result": True}
+
+    def send_document(self, chat_id, file_path):
+        return self._sent("sendDocument", chat_id)
+
+    def answer_callback_query(self, callback_query_id, text=None, show_alert=False):
+        self.calls["answerCallbackQuery"] += 1
+        return {"ok": True, "result": True}
+
+    def buttons(self, chat_id, prefix):
+        """callback_data of the last markup sent to chat_id that start with prefix."""
+        markup = self.last_markup.get(str(chat_id)) or {}
+        return [b["callback_data"] for row in markup.get("inline_keyboard", [])
+                for b in row if b.get("callback_data", "").startswith(prefix)]
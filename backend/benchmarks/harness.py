@@ -0,0 +1,123 @@
+import json
+import math
+import sqlite3
+import time
+from collections import defaultdict
+
+
+class QueryCounter:
+    """Counts SQL statements through sqlite3 trace callbacks on patched connection factories."""
+
+    def __init__(self):
+        self.count = 0
+
+    def hit(self, statement):
+        self.count += 1
+
+    def wrap(self, factory):
+        def connect(*args, **kwargs):
+            conn = factory(*args, **kwargs)
+            conn.set_trace_callback(self.hit)
+            return conn
+        return connect
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+class Recorder:
+    def __init__(self, queries=None):
+        self.queries = queries
+        self.samples = defaultdict(list)   # op -> [seconds]
+        self.query_counts = defaultdict(int)
+        self.wall = 0.0
+
+    def measure(self, op, fn, *args, **kwargs):
+        before = self.queries.count if self.queries else 0
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.wall += elapsed
+            self.samples[op].append(elapsed)
+            if self.queries:
+                self.query_counts[op] += self.queries.count - before
+
+    def summary(self):
+        result = {}
+        for op, values in sorted(self.samples.items()):
+            values = sorted(values)
+            total = sum(values)
+            result[op] = {
+                "count": len(values),
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "ops_per_s": len(values) / total if total else 0.0,
+                "queries_per_op": self.query_counts[op] / len(values),
+            }
+        return result
+
+
+def bench(fn, *args, min_time=0.2, max_rounds=1000, min_rounds=3):
+    """
+    Times fn(*args) the way pytest-benchmark does: calibrates how many calls fit in
+    a round, then runs rounds until min_time has passed. Returns per-call seconds.
+    """
+    start = time.perf_counter()
+    fn(*args)
+    once = time.perf_counter() - start
+    iterations = max(1, int(0.01 / once)) if once < 0.01 else 1
+
+    times = []
+    deadline = time.perf_counter() + min_time
+    while len(times) < max_rounds and (len(times) < min_rounds or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            fn(*args)
+        times.append((time.perf_counter() - start) / iterations)
+    times.sort()
+    mean = sum(times) / len(times)
+    return {
+        "rounds": len(times),
+        "iterations": iterations,
+        "min_ms": times[0] * 1000,
+        "median_ms": percentile(times, 50) * 1000,
+        "mean_ms": mean * 1000,
+        "stddev_ms": math.sqrt(sum((t - mean) ** 2 for t in times) / len(times)) * 1000,
+        "ops_per_s": 1 / mean if mean else 0.0,
+    }
+
+
+def print_report(title, summary, baseline=None):
+    print(f"\n== {title} ==")
+    header = f"{'operation':<28} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>9} {'q/op':>7}"
+    if baseline:
+        header += f" {'Δp95':>8}"
+    print(header)
+    for op, s in summary.items():
+        line = (f"{op:<28} {s['count']:>6} {s['p50_ms']:>9.2f} {s['p95_ms']:>9.2f} "
+                f"{s['p99_ms']:>9.2f} {s['ops_per_s']:>9.0f} {s['queries_per_op']:>7.1f}")
+        if baseline and op in baseline:
+            before = baseline[op]["p95_ms"]
+            line += f" {((s['p95_ms'] - before) / before * 100 if before else 0):>+7.0f}%"
+        print(line)
+    total_ops = sum(s["count"] for s in summary.values())
+    total_time = sum(s["count"] / s["ops_per_s"] for s in summary.values() if s["ops_per_s"])
+    if total_time:
+        print(f"{'total':<28} {total_ops:>6} {'':>9} {'':>9} {'':>9} {total_ops / total_time:>9.0f}")
+
+
+def save(path, results):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,217 @@
+"""
+Synthetic load for the bot and the API against a seeded SQLite database.
+
+    cd backend && python -m benchmarks.load --updates 2000 --requests 1000 --json before.json
+    ... change something ...
+    cd backend && python -m benchmarks.load --updates 2000 --requests 1000 --compare before.json
+
+Bot traffic is replayed through handlers.process_update with a fake TelegramClient;
+the replay follows the bot's own buttons (category -> toggles -> confirm), so drafts,
+balances and history pages go through the real code paths. API traffic goes through
+the ASGI app with Starlette's TestClient (adds roughly a millisecond per request).
+Reports p50/p95/p99 latency, throughput and SQL statements per operation.
+"""
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import time
+
+from benchmarks import harness
+
+BOT_SCENARIOS = {
+    "expense": 30,
+    "MENU_BALANCE": 15,
+    "MENU_ME": 10,
+    "OPEN_DASHBOARD": 15,
+    "MENU_ALL_EXPENSES": 10,
+    "ALL_EXPENSES_PAGE": 5,
+    "MENU_NOTES": 5,
+    "/start": 10,
+}
+# Descriptions after the amount; the first two are categorized by src.parsing, the rest go through CAT
+EXPENSE_TEXTS = ["Обед", "такси", "Сувениры", "Расход"]
+
+API_SCENARIOS = {
+    "GET expenses": 20,
+    "GET expenses (304)": 15,
+    "GET debts": 15,
+    "GET members": 10,
+    "GET overview": 15,
+    "GET stats": 10,
+    "GET changes": 10,
+    "GET user trips": 5,
+    "POST expense": 10,
+}
+
+
+class Replay:
+    """Builds Telegram updates shaped like the ones getUpdates returns."""
+
+    def __init__(self):
+        self.update_ids = itertools.count(1)
+
+    def message(self, uid, text):
+        return {"update_id": next(self.update_ids), "message": {
+            "message_id": 1, "chat": {"id": int(uid)},
+            "from": {"id": int(uid), "first_name": "Bench"}, "text": text}}
+
+    def callback(self, uid, data):
+        update_id = next(self.update_ids)
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": {"id": int(uid)},
+            "message": {"chat": {"id": int(uid)}, "message_id": 1}, "data": data}}
+
+
+def run_bot(dataset, recorder, n_updates, rng, scenarios=BOT_SCENARIOS):
+    from src import handlers
+    from benchmarks.fakes import FakeTelegramClient
+
+    fake = FakeTelegramClient()
+    handlers.bot = fake
+    replay = Replay()
+    users = sorted(dataset.active_trip)
+    names, weights = zip(*scenarios.items())
+    done = 0
+
+    def send(op, update):
+        nonlocal done
+        recorder.measure(op, handlers.process_update, update)
+        done += 1
+
+    while done < n_updates:
+        uid = rng.choice(users)
+        kind = rng.choices(names, weights)[0]
+        if kind == "expense":
+            send("text: expense", replay.message(uid, f"{rng.randint(50, 5000)} {rng.choice(EXPENSE_TEXTS)}"))
+            cats = fake.buttons(uid, "CAT|")
+            if cats:
+                send("cb: CAT", replay.callback(uid, rng.choice(cats)))
+            elif not fake.buttons(uid, "CONFIRM|"):
+                continue  # no active trip; a recognized category goes straight to the split menu
+            for _ in range(rng.randint(0, 2)):
+                toggles = fake.buttons(uid, "TOGGLE|")
+                if toggles: send("cb: TOGGLE", replay.callback(uid, rng.choice(toggles)))
+            confirm = fake.buttons(uid, "CONFIRM|")
+            if confirm: send("cb: CONFIRM", replay.callback(uid, confirm[0]))
+        elif kind == "/start":
+            send("cmd: /start", replay.message(uid, "/start"))
+        elif kind == "ALL_EXPENSES_PAGE":
+            send("cb: ALL_EXPENSES_PAGE", replay.callback(uid, f"ALL_EXPENSES_PAGE|{rng.randint(1, 5)}"))
+        else:
+            send(f"cb: {kind}", replay.callback(uid, kind))
+    return fake.calls
+
+
+def run_api(dataset, recorder, n_requests, rng):
+    import api
+    from fastapi.testclient import TestClient
+
+    api.send_telegram_msg = lambda *args, **kwargs: None
+    client = TestClient(api.app)
+    trips = sorted(dataset.trips)
+    names, weights = zip(*API_SCENARIOS.items())
+    etags = {}
+
+    for _ in range(n_requests):
+        tid = rng.choice(trips)
+        kind = rng.choices(names, weights)[0]
+        if kind == "GET expenses":
+            resp = recorder.measure(kind, client.get, f"/api/expenses/{tid}")
+            etags[tid] = resp.headers.get("etag")
+        elif kind == "GET expenses (304)":
+            if not etags.get(tid):
+                etags[tid] = client.get(f"/api/expenses/{tid}").headers.get("etag")
+            recorder.measure(kind, client.get, f"/api/expenses/{tid}", headers={"If-None-Match": etags[tid]})
+        elif kind == "GET debts":
+            recorder.measure(kind, client.get, f"/api/debts/{tid}")
+        elif kind == "GET members":
+            recorder.measure(kind, client.get, f"/api/members/{tid}")
+        elif kind == "GET overview":
+            recorder.measure(kind, client.get, f"/api/trips/{tid}/overview",
+                             params={"user_id": dataset.trips[tid][0]})
+        elif kind == "GET stats":
+            recorder.measure(kind, client.get, f"/api/stats/{tid}", params={"user_id": dataset.trips[tid][0]})
+        elif kind == "GET changes":
+            version = client.get(f"/api/trips/{tid}/changes", params={"since": 10**12}).json()["version"]
+            recorder.measure(kind, client.get, f"/api/trips/{tid}/changes", params={"since": max(1, version - 10)})
+        elif kind == "GET user trips":
+            recorder.measure(kind, client.get, f"/api/trips/{rng.choice(dataset.trips[tid])}")
+        elif kind == "POST expense":
+            masters = dataset.masters[tid]
+            amount = float(rng.randint(50, 5000))
+            recorder.measure(kind, client.post, "/api/expenses", json={
+                "trip_id": tid, "payer_id": rng.choice(dataset.trips[tid]), "amount": amount,
+                "description": "Bench", "category": "FOOD",
+                "split": {m: amount / len(masters) for m in masters}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic load for the splitopus bot and API")
+    parser.add_argument("--db", help="database path (default: a temp file, reseeded each run)")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--trips", type=int, default=20)
+    parser.add_argument("--members", type=int, default=6)
+    parser.add_argument("--linked", type=float, default=0.2)
+    parser.add_argument("--expenses", type=int, default=500, help="expenses per trip")
+    parser.add_argument("--updates", type=int, default=1000, help="bot updates to replay")
+    parser.add_argument("--requests", type=int, default=500, help="API requests to send")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--weight", action="append", default=[], metavar="SCENARIO=N",
+                        help="override a bot scenario weight, e.g. expense=0 for a read-only run")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results written earlier with --json")
+    args = parser.parse_args()
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="splitopus-bench-"), "bench.db")
+    # Must be set before src.data is imported: it initializes the database on import
+    os.environ["DB_PATH"] = db_path
+    os.environ.setdefault("BOT_TOKEN", "bench")
+    os.environ.setdefault("TRACE_FILE", os.path.join(os.path.dirname(db_path), "traces.jsonl"))
+
+    from benchmarks.seed import seed, SeedConfig
+    from src import db
+
+    start = time.perf_counter()
+    dataset = seed(db_path, SeedConfig(
+        users=args.users, trips=args.trips, members_per_trip=args.members,
+        linked_ratio=args.linked, expenses_per_trip=args.expenses, seed=args.seed))
+    print(f"Seeded {db_path} in {time.perf_counter() - start:.1f}s: {args.users} users, "
+          f"{args.trips} trips x {args.expenses} expenses, {len(dataset.link_map)} linked accounts")
+
+    import logging
+    logging.disable(logging.WARNING)  # N+1 / slow-query warnings are expected under load
+    import api
+    queries = harness.QueryCounter()
+    db.get_connection = queries.wrap(db.get_connection)
+    api.get_db = queries.wrap(api.get_db)
+
+    baseline = harness.load(args.compare) if args.compare else {}
+    rng = random.Random(args.seed)
+    results = {}
+
+    bot_recorder = harness.Recorder(queries)
+    scenarios = dict(BOT_SCENARIOS)
+    for override in args.weight:
+        name, _, weight = override.rpartition("=")
+        if name not in scenarios:
+            parser.error(f"unknown bot scenario {name!r}; known: {', '.join(scenarios)}")
+        scenarios[name] = float(weight)
+    calls = run_bot(dataset, bot_recorder, args.updates, rng, scenarios)
+    results["bot"] = bot_recorder.summary()
+    harness.print_report("bot: handlers.process_update", results["bot"], baseline.get("bot"))
+    print("Telegram calls: " + ", ".join(f"{k}={v}" for k, v in sorted(calls.items())))
+
+    api_recorder = harness.Recorder(queries)
+    run_api(dataset, api_recorder, args.requests, rng)
+    results["api"] = api_recorder.summary()
+    harness.print_report("api: ASGI", results["api"], baseline.get("api"))
+
+    if args.json:
+        harness.save(args.json, results)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
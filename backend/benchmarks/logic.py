@@ -0,0 +1,293 @@
+"""
+Micro-benchmarks for the balance and settlement functions in src/logic.py.
+
+    cd backend && python -m benchmarks.logic
+    cd backend && python -m benchmarks.logic --expenses 1000,100000 --members 20 --json before.json
+    cd backend && python -m benchmarks.logic --engine python --engine numpy --engine numpy-warm
+
+Trips are generated in the shape db.get_trip returns, from 10 to 100k expenses and
+2 to 200 members, with and without link_map families (including old splits stored
+by child ids). Every engine is checked against the reference implementations below;
+engines after the first are also checked for bit-identical output against the first
+one and timed relative to it. An engine is any module with calculate_balance,
+get_my_stats and simplify_debts, or 'python' / 'numpy' / 'numpy-warm' for the paths
+src.logic dispatches between (fastbalance.MIN_EXPENSES).
+"""
+import argparse
+import importlib
+import itertools
+import math
+import random
+from types import SimpleNamespace
+
+from benchmarks import harness
+
+EXPENSES = [10, 100, 1_000, 10_000, 100_000]
+MEMBERS = [2, 20, 200]
+# 100k expenses x 200 members is ~16M split entries; skipped unless --full
+MAX_SPLIT_ENTRIES = 2_000_000
+CATEGORIES = ["FOOD", "ALCOHOL", "TRANSPORT", "SHOP", "FUN", "HOME", "OTHER"]
+
+
+def generate_trip(n_expenses, n_members, linked, seed=1):
+    """Returns (trip, link_map, user_names) shaped like db.get_trip / db.get_link_map."""
+    rng = random.Random(seed * 1_000_003 + n_expenses * 7 + n_members)
+    members = [str(7_000_000_000 + i) for i in range(n_members)]
+    link_map = {}
+    if linked and n_members > 2:
+        # Every fifth member is a child of the member before it
+        link_map = {members[i]: members[i - 1] for i in range(1, n_members, 5)}
+    masters = sorted({link_map.get(m, m) for m in members})
+    children = {}
+    for child, master in link_map.items():
+        children.setdefault(master, []).append(child)
+
+    expenses = []
+    for i in range(n_expenses):
+        payer = rng.choice(members)
+        payer_master = link_map.get(payer, payer)
+        ts = 1_700_000_000 + i * 60
+        if len(masters) > 1 and rng.random() < 0.05:
+            target = rng.choice([m for m in masters if m != payer_master])
+            amount = float(rng.randint(100, 3000))
+            expenses.append({"id": i + 1, "payer_id": payer, "amount": amount, "category": "REPAYMENT",
+                             "split": {target: amount}, "ts": ts})
+            continue
+        amount = round(rng.uniform(50, 5000), 2)
+        shared = masters if rng.random() < 0.5 else rng.sample(masters, rng.randint(1, len(masters)))
+        if link_map and rng.random() < 0.1:
+            # Old data: split stored by individual ids, children included
+            shared = list(itertools.chain.from_iterable([m] + children.get(m, []) for m in shared))
+        share = amount / len(shared)
+        expenses.append({"id": i + 1, "payer_id": payer, "amount": amount, "category": rng.choice(CATEGORIES),
+                         "split": {uid: share for uid in shared}, "ts": ts})
+
+    trip = {"id": "bench", "members": members, "expenses": expenses}
+    user_names = {uid: f"User {i}" for i, uid in enumerate(members)}
+    return trip, link_map, user_names
+
+
+# --- Reference implementations: straightforward and exactly summed (math.fsum) ---
+
+def reference_balance(trip, link_map):
+    def master(uid):
+        return link_map.get(str(uid), str(uid))
+
+    masters = {master(uid) for uid in trip["members"]}
+    paid = {m: [] for m in masters}
+    owed = {m: [] for m in masters}
+    spent = []
+    for exp in trip["expenses"]:
+        amount = float(exp["amount"])
+        if exp.get("category", "OTHER") != "REPAYMENT":
+            spent.append(amount)
+        payer = master(exp["payer_id"])
+        if payer in masters:
+            paid[payer].append(amount)
+        for uid, share in exp["split"].items():
+            consumer = master(uid)
+            if consumer in masters:
+                owed[consumer].append(share)
+    balances = {m: math.fsum(paid[m] + [-s for s in owed[m]]) for m in masters}
+    return balances, math.fsum(spent), {m: math.fsum(paid[m]) for m in masters}
+
+
+def reference_stats(trip, my_uid, link_map):
+    def master(uid):
+        return link_map.get(str(uid), str(uid))
+
+    me = master(my_uid)
+    shares, cats = [], {}
+    mine, received = [], []
+    for exp in trip["expenses"]:
+        payer = master(exp["payer_id"])
+        amount = float(exp["amount"])
+        if exp.get("category", "OTHER") == "REPAYMENT":
+            target = master(next(iter(exp["split"])))
+            if payer == me:
+                mine.append({"to": target, "amount": amount, "ts": exp["ts"]})
+            elif target == me:
+                received.append({"from": payer, "amount": amount, "ts": exp["ts"]})
+            continue
+        split = exp.get("split", {})
+        share = split.get(me, 0.0)
+        if share == 0:
+            share = math.fsum(s for uid, s in split.items() if master(uid) == me)
+        if share > 0:
+            shares.append(share)
+            cats.setdefault(exp.get("category", "OTHER"), []).append(share)
+    return {"total_share": math.fsum(shares), "cats": {c: math.fsum(v) for c, v in cats.items()},
+            "my_repayments": mine, "received_repayments": received}
+
+
+def check_settlement(balances, transactions):
+    """simplify_debts has no unique answer to compare with, so check what it must guarantee."""
+    debtors = {uid for uid, bal in balances.items() if bal < -0.01}
+    creditors = {uid for uid, bal in balances.items() if bal > 0.01}
+    residual = dict(balances)
+    for tx in transactions:
+        if tx["from"] not in debtors or tx["to"] not in creditors:
+            return f"{tx['from']} -> {tx['to']} is not debtor -> creditor"
+        if not tx["amount"] > 0:
+            return f"non-positive transfer {tx['amount']}"
+        residual[tx["from"]] += tx["amount"]
+        residual[tx["to"]] -= tx["amount"]
+    if transactions and len(transactions) > len(debtors) + len(creditors) - 1:
+        return f"{len(transactions)} transfers for {len(debtors) + len(creditors)} parties"
+    worst = max((abs(v) for v in residual.values()), default=0.0)
+    if worst > 0.01 * len(balances) + 1e-6:
+        return f"unsettled residual {worst:.4f}"
+    return None
+
+
+def close(a, b, tol):
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(close(a[k], b[k], tol) for k in a)
+    if isinstance(a, (list, tuple)):
+        return len(a) == len(b) and all(close(x, y, tol) for x, y in zip(a, b))
+    if isinstance(a, float):
+        return abs(a - b) <= tol
+    return a == b
+
+
+def verify(engine, trip, link_map, user_names):
+    """Returns a list of problems with engine's output on this trip."""
+    problems = []
+    tol = 1e-9 * max(1.0, sum(float(e["amount"]) for e in trip["expenses"]))
+
+    result = engine.calculate_balance(trip, link_map)
+    if not close(result, reference_balance(trip, link_map), tol):
+        problems.append("calculate_balance differs from reference")
+
+    for uid in trip["members"][:3]:
+        if not close(engine.get_my_stats(trip, uid, link_map), reference_stats(trip, uid, link_map), tol):
+            problems.append(f"get_my_stats({uid}) differs from reference")
+
+    # Ids instead of names, so transfers can be matched back to balances
+    error = check_settlement(result[0], engine.simplify_debts(result[0], {}))
+    if error:
+        problems.append(f"simplify_debts: {error}")
+    return problems
+
+
+def outputs(engine, trip, link_map, user_names):
+    balances = engine.calculate_balance(trip, link_map)
+    return (balances, engine.get_my_stats(trip, trip["members"][0], link_map),
+            engine.simplify_debts(balances[0], user_names))
+
+
+def engine_by_name(name):
+    """
+    A module path, or 'python' / 'numpy' / 'numpy-warm' for the paths behind src.logic's
+    dispatch ('numpy' rebuilds the columns on every call, 'numpy-warm' reuses them).
+    """
+    from src import logic, fastbalance
+    if name == "python":
+        return SimpleNamespace(calculate_balance=logic.calculate_balance_py,
+                               get_my_stats=logic.get_my_stats_py, simplify_debts=logic.simplify_debts)
+    if name == "numpy":
+        if fastbalance.np is None:
+            raise SystemExit("numpy is not installed")
+
+        # First call on a new trip version: the column build is part of the cost
+        def cold(fn):
+            def run(*args):
+                fastbalance.clear_cache()
+                return fn(*args)
+            return run
+        return SimpleNamespace(calculate_balance=cold(fastbalance.calculate_balance),
+                               get_my_stats=cold(fastbalance.get_my_stats), simplify_debts=logic.simplify_debts)
+    if name == "numpy-warm":
+        # Later calls on the same version reuse the cached columns
+        return SimpleNamespace(calculate_balance=fastbalance.calculate_balance,
+                               get_my_stats=fastbalance.get_my_stats, simplify_debts=logic.simplify_debts)
+    return importlib.import_module(name)
+
+
+def cases(expenses, members, full):
+    for n_expenses, n_members, linked in itertools.product(expenses, members, (False, True)):
+        if linked and n_members <= 2:
+            continue
+        if not full and n_expenses * n_members > MAX_SPLIT_ENTRIES:
+            continue
+        yield n_expenses, n_members, linked
+
+
+def print_report(results, engines, baseline):
+    print(f"{'benchmark':<44} {'engine':<16} {'rounds':>7} {'min ms':>10} {'median ms':>10} "
+          f"{'stddev':>8} {'ops/s':>10} {'vs':>8}")
+    for name, by_engine in results.items():
+        first = by_engine[engines[0]]["median_ms"]
+        for engine_name in engines:
+            r = by_engine[engine_name]
+            if engine_name != engines[0]:
+                vs = f"{first / r['median_ms']:.2f}x" if r["median_ms"] else ""
+            elif baseline.get(name, {}).get(engine_name):
+                before = baseline[name][engine_name]["median_ms"]
+                vs = f"{(r['median_ms'] - before) / before * 100:+.0f}%" if before else ""
+            else:
+                vs = ""
+            print(f"{name:<44} {engine_name:<16} {r['rounds']:>7} {r['min_ms']:>10.3f} {r['median_ms']:>10.3f} "
+                  f"{r['stddev_ms']:>8.3f} {r['ops_per_s']:>10.0f} {vs:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark balance and settlement functions")
+    parser.add_argument("--engine", action="append",
+                        help="module, 'python', 'numpy' or 'numpy-warm' (repeatable, default src.logic)")
+    parser.add_argument("--expenses", default=",".join(map(str, EXPENSES)))
+    parser.add_argument("--members", default=",".join(map(str, MEMBERS)))
+    parser.add_argument("--full", action="store_true", help=f"include cases above {MAX_SPLIT_ENTRIES:,} split entries")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per benchmark")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results written earlier with --json")
+    args = parser.parse_args()
+
+    engine_names = args.engine or ["src.logic"]
+    engines = {name: engine_by_name(name) for name in engine_names}
+    baseline = harness.load(args.compare) if args.compare else {}
+    expenses = [int(x) for x in args.expenses.split(",")]
+    members = [int(x) for x in args.members.split(",")]
+
+    results, failures = {}, []
+    for n_expenses, n_members, linked in cases(expenses, members, args.full):
+        trip, link_map, user_names = generate_trip(n_expenses, n_members, linked)
+        label = f"{n_expenses}x{n_members}{'-linked' if linked else ''}"
+
+        reference = None
+        for engine_name, engine in engines.items():
+            failures += [f"{engine_name} [{label}]: {p}" for p in verify(engine, trip, link_map, user_names)]
+            out = outputs(engine, trip, link_map, user_names)
+            if reference is None:
+                reference = out
+            elif repr(out) != repr(reference):  # repr: exact floats and dict order
+                failures.append(f"{engine_name} [{label}]: output not identical to {engine_names[0]}")
+
+        balances = reference[0][0]
+        benchmarks = {
+            f"calculate_balance[{label}]": lambda e: harness.bench(
+                e.calculate_balance, trip, link_map, min_time=args.min_time),
+            f"get_my_stats[{label}]": lambda e: harness.bench(
+                e.get_my_stats, trip, trip["members"][0], link_map, min_time=args.min_time),
+            f"simplify_debts[{label}]": lambda e: harness.bench(
+                e.simplify_debts, balances, user_names, min_time=args.min_time),
+        }
+        for name, run in benchmarks.items():
+            results[name] = {engine_name: run(engine) for engine_name, engine in engines.items()}
+
+    print_report(results, engine_names, baseline)
+    if failures:
+        print("\nCorrectness FAILED:")
+        for failure in failures:
+            print(f"  {failure}")
+    else:
+        print(f"\nCorrectness: all {len(engines)} engine(s) match the reference implementations")
+
+    if args.json:
+        harness.save(args.json, results)
+        print(f"Results written to {args.json}")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Memory held by a trip's expenses: the old dict-per-expense shape vs src.tripstore.
+
+    cd backend && python -m benchmarks.memory
+    cd backend && python -m benchmarks.memory --expenses 1000,100000 --members 8,50
+
+Expenses from benchmarks.logic.generate_trip are written to an in-memory SQLite table
+and read back as sqlite3.Row, as db.get_trip does. For each representation it reports
+the bytes still allocated after the build (tracemalloc, rows excluded), the peak during
+the build, build time, and the time of the pure-Python balance / stats loops reading it,
+and checks that both give identical balances.
+"""
+import argparse
+import gc
+import json
+import sqlite3
+import tracemalloc
+
+from benchmarks import harness
+from benchmarks.logic import generate_trip
+
+DESCRIPTIONS = ["Обед", "Такси", "Продукты", "Бар", "Жилье", "Экскурсия", "Кофе"]
+
+
+def load_rows(n_expenses, n_members, linked):
+    """(rows, trip without expenses, link_map) with rows fetched from SQLite like db.get_trip."""
+    trip, link_map, _ = generate_trip(n_expenses, n_members, linked)
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE expenses (id INTEGER PRIMARY KEY AUTOINCREMENT, trip_id TEXT, payer_id TEXT, "
+                 "amount REAL, description TEXT, category TEXT, created_at INTEGER, split_json TEXT)")
+    conn.executemany(
+        "INSERT INTO expenses (trip_id, payer_id, amount, description, category, split_json, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(trip["id"], e["payer_id"], e["amount"], DESCRIPTIONS[i % len(DESCRIPTIONS)], e["category"],
+          json.dumps(e["split"], separators=(",", ":")), e["ts"]) for i, e in enumerate(trip["expenses"])])
+    rows = conn.execute("SELECT * FROM expenses WHERE trip_id = ?", (trip["id"],)).fetchall()
+    conn.close()
+    trip["expenses"] = None
+    return rows, trip, link_map
+
+
+def measure(build, rows):
+    """(result, retained bytes, peak bytes) of build(rows)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build(rows)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, current - before, peak - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory of dict expenses vs src.tripstore")
+    parser.add_argument("--expenses", default="1000,10000,100000")
+    parser.add_argument("--members", default="8,50")
+    parser.add_argument("--linked", action="store_true", help="trips with link_map families")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    from src import logic, tripstore
+    shapes = {
+        "dicts": tripstore.dict_expenses,
+        "tripstore": lambda rows: tripstore.ExpenseList.from_rows(rows, "bench"),
+    }
+
+    print(f"{'trip':<14} {'shape':<10} {'retained':>11} {'B/expense':>10} {'peak':>11} "
+          f"{'build ms':>9} {'balance ms':>11} {'stats ms':>9}")
+    results, failures = {}, []
+    for n_expenses in (int(x) for x in args.expenses.split(",")):
+        for n_members in (int(x) for x in args.members.split(",")):
+            rows, trip, link_map = load_rows(n_expenses, n_members, args.linked)
+            label = f"{n_expenses}x{n_members}{'-linked' if args.linked else ''}"
+            outputs = {}
+            for shape, build in shapes.items():
+                expenses, retained, peak = measure(build, rows)
+                t = dict(trip, expenses=expenses)
+                me = trip["members"][0]
+                outputs[shape] = repr((logic.calculate_balance_py(t, link_map), logic.get_my_stats_py(t, me, link_map)))
+                r = {
+                    "retained_bytes": retained,
+                    "peak_bytes": peak,
+                    "build_ms": harness.bench(build, rows, min_time=args.min_time, max_rounds=50)["median_ms"],
+                    "balance_ms": harness.bench(logic.calculate_balance_py, t, link_map,
+                                                min_time=args.min_time, max_rounds=50)["median_ms"],
+                    "stats_ms": harness.bench(logic.get_my_stats_py, t, me, link_map,
+                                              min_time=args.min_time, max_rounds=50)["median_ms"],
+                }
+                results.setdefault(label, {})[shape] = r
+                print(f"{label:<14} {shape:<10} {retained / 2**20:>9.2f}MB {retained / n_expenses:>10.0f} "
+                      f"{peak / 2**20:>9.2f}MB {r['build_ms']:>9.1f} {r['balance_ms']:>11.1f} {r['stats_ms']:>9.1f}")
+            if outputs["tripstore"] != outputs["dicts"]:
+                failures.append(f"{label}: balances differ between shapes")
+            before, after = results[label]["dicts"], results[label]["tripstore"]
+            print(f"{'':<14} {'':<10} {before['retained_bytes'] / max(1, after['retained_bytes']):>10.1f}x smaller")
+
+    if failures:
+        print("\nCorrectness FAILED:")
+        for failure in failures:
+            print(f"  {failure}")
+    else:
+        print("\nCorrectness: both shapes give identical balances and stats")
+    if args.json:
+        harness.save(args.json, results)
+        print(f"Results written to {args.json}")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
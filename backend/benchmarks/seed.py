@@ -0,0 +1,153 @@
+"""
+Seeds a SQLite database with a synthetic but realistic splitopus workload.
+
+    cd backend && python -m benchmarks.seed /tmp/bench.db --users 500 --trips 50 --expenses 2000
+
+Users are spread over trips; a share of members are linked into families (a child
+pays through its master, like JOIN_LINKED in the bot). Expenses are split between
+masters the same way the bot stores them, with occasional repayments.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import time
+from dataclasses import dataclass, field
+
+from src import db
+
+DESCRIPTIONS = ["Обед", "Ужин", "Такси", "Продукты", "Бар", "Кофе", "Экскурсия", "Аренда байка", "Отель"]
+CATEGORIES = ["FOOD", "ALCOHOL", "TRANSPORT", "SHOP", "FUN", "HOME", "OTHER"]
+
+
+@dataclass
+class SeedConfig:
+    users: int = 200
+    trips: int = 20
+    members_per_trip: int = 6
+    linked_ratio: float = 0.2
+    expenses_per_trip: int = 500
+    notes_per_trip: int = 5
+    repayment_ratio: float = 0.05
+    seed: int = 1
+
+
+@dataclass
+class Dataset:
+    """What the load generator needs to know about the seeded data."""
+    users: list
+    trips: dict = field(default_factory=dict)         # trip_id -> [member ids]
+    masters: dict = field(default_factory=dict)       # trip_id -> [master ids]
+    active_trip: dict = field(default_factory=dict)   # user_id -> trip_id
+    link_map: dict = field(default_factory=dict)      # child -> master
+
+
+def seed(db_path, config=None):
+    config = config or SeedConfig()
+    rng = random.Random(config.seed)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    saved_path, db.DB_PATH = db.DB_PATH, db_path
+    try:
+        db.init_db()
+    finally:
+        db.DB_PATH = saved_path
+
+    users = [str(9_000_000_000 + i) for i in range(config.users)]
+    dataset = Dataset(users=users)
+    now = int(time.time()) - config.expenses_per_trip * 600
+
+    for t in range(config.trips):
+        tid = f"bench_trip_{t}"
+        members = rng.sample(users, min(config.members_per_trip, len(users)))
+        dataset.trips[tid] = members
+        for uid in members:
+            dataset.active_trip.setdefault(uid, tid)
+        # Families: a linked child pays through a master of the same trip
+        n_linked = int(len(members) * config.linked_ratio)
+        for child in members[:n_linked]:
+            if child in dataset.link_map or child in dataset.link_map.values():
+                continue
+            candidates = [m for m in members[n_linked:] if m not in dataset.link_map]
+            if candidates:
+                dataset.link_map[child] = rng.choice(candidates)
+
+    for tid, members in dataset.trips.items():
+        dataset.masters[tid] = sorted({dataset.link_map.get(m, m) for m in members})
+
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (id, name, active_trip_id, linked_to) VALUES (?, ?, ?, ?)",
+            [(uid, f"User {i}", dataset.active_trip.get(uid), dataset.link_map.get(uid)) for i, uid in enumerate(users)]
+        )
+        for t, (tid, members) in enumerate(dataset.trips.items()):
+            conn.execute(
+                "INSERT INTO trips (id, code, creator_id, name, currency) VALUES (?, ?, ?, ?, ?)",
+                (tid, f"B{t:05d}", members[0], f"Bench trip {t}", "THB")
+            )
+            conn.executemany("INSERT INTO trip_members (trip_id, user_id) VALUES (?, ?)", [(tid, m) for m in members])
+
+            masters = dataset.masters[tid]
+            rows = []
+            for i in range(config.expenses_per_trip):
+                payer = rng.choice(members)
+                payer_master = dataset.link_map.get(payer, payer)
+                ts = now + i * 600
+                if len(masters) > 1 and rng.random() < config.repayment_ratio:
+                    target = rng.choice([m for m in masters if m != payer_master])
+                    amount = float(rng.randint(100, 3000))
+                    rows.append((tid, payer, amount, "Возврат долга", "REPAYMENT", ts, json.dumps({target: amount})))
+                    continue
+                amount = float(rng.randint(50, 5000))
+                shared = rng.sample(masters, rng.randint(1, len(masters)))
+                share = amount / len(shared)
+                rows.append((tid, payer, amount, rng.choice(DESCRIPTIONS), rng.choice(CATEGORIES), ts,
+                             json.dumps({m: share for m in shared})))
+            conn.executemany(
+                "INSERT INTO expenses (trip_id, payer_id, amount, description, category, created_at, split_json) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.executemany(
+                "INSERT INTO notes (trip_id, author_name, text, created_at) VALUES (?, ?, ?, ?)",
+                [(tid, "User", f"Заметка {n}", now) for n in range(config.notes_per_trip)]
+            )
+            # Change log + version, as if everything had been written through db.*
+            conn.execute(
+                "INSERT INTO trip_changes (trip_id, entity, entity_id, op, created_at) "
+                "SELECT trip_id, 'expense', id, 'upsert', created_at FROM expenses WHERE trip_id = ?",
+                (tid,)
+            )
+            conn.execute(
+                "UPDATE trips SET version = (SELECT MAX(seq) FROM trip_changes WHERE trip_id = ?) WHERE id = ?",
+                (tid, tid)
+            )
+        db.rebuild_stats(conn)
+    conn.close()
+    return dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a synthetic splitopus database")
+    parser.add_argument("db_path")
+    parser.add_argument("--users", type=int, default=SeedConfig.users)
+    parser.add_argument("--trips", type=int, default=SeedConfig.trips)
+    parser.add_argument("--members", type=int, default=SeedConfig.members_per_trip)
+    parser.add_argument("--linked", type=float, default=SeedConfig.linked_ratio)
+    parser.add_argument("--expenses", type=int, default=SeedConfig.expenses_per_trip)
+    parser.add_argument("--seed", type=int, default=SeedConfig.seed)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    dataset = seed(args.db_path, SeedConfig(
+        users=args.users, trips=args.trips, members_per_trip=args.members,
+        linked_ratio=args.linked, expenses_per_trip=args.expenses, seed=args.seed
+    ))
+    print(f"Seeded {len(dataset.users)} users, {len(dataset.trips)} trips, "
+          f"{len(dataset.link_map)} linked accounts in {time.perf_counter() - start:.1f}s -> {args.db_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Payload size and encode time of an expense list response on a 10k-expense trip.
+
+    cd backend && python -m benchmarks.serialization [--expenses 10000] [--members 8]
+
+Compares the old path (json.loads every split_json, FastAPI's jsonable_encoder,
+stdlib json) with src.serialization (stored split JSON spliced in as-is; orjson
+when installed), and the wire size with gzip / brotli.
+"""
+import argparse
+import json
+import random
+import time
+
+from src import serialization
+from src.serialization import RawJSON
+
+try:
+    from fastapi.encoders import jsonable_encoder
+except ImportError:
+    jsonable_encoder = None
+
+
+def make_rows(n_expenses, n_members, seed=1):
+    rng = random.Random(seed)
+    members = [str(5_000_000_000 + i) for i in range(n_members)]
+    descriptions = ["Обед", "Такси", "Продукты", "Бар", "Жилье", "Экскурсия", "Кофе"]
+    categories = ["FOOD", "TRANSPORT", "SHOP", "ALCOHOL", "HOME", "FUN", "OTHER"]
+    rows = []
+    for i in range(n_expenses):
+        amount = round(rng.uniform(50, 5000), 2)
+        shared = rng.sample(members, rng.randint(1, n_members))
+        share = amount / len(shared)
+        rows.append({
+            "id": i + 1,
+            "payer_id": rng.choice(members),
+            "amount": amount,
+            "description": rng.choice(descriptions),
+            "category": rng.choice(categories),
+            "created_at": 1_700_000_000 + i * 60,
+            "split_json": json.dumps({m: share for m in shared}),
+        })
+    return rows
+
+
+def old_path(rows):
+    expenses = []
+    for row in rows:
+        exp = dict(row)
+        exp["split"] = json.loads(row["split_json"])
+        del exp["split_json"]
+        expenses.append(exp)
+    content = {"expenses": expenses}
+    if jsonable_encoder is not None:
+        content = jsonable_encoder(content)
+    # starlette.responses.JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def new_path(rows):
+    expenses = []
+    for row in rows:
+        exp = dict(row)
+        exp["split"] = RawJSON(exp.pop("split_json"))
+        expenses.append(exp)
+    return serialization.dumps({"expenses": expenses})
+
+
+def stdlib_passthrough(rows):
+    saved, serialization.orjson = serialization.orjson, None
+    try:
+        return new_path(rows)
+    finally:
+        serialization.orjson = saved
+
+
+def timeit(fn, rows, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        body = fn(rows)
+        best = min(best, time.perf_counter() - start)
+    return best, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--expenses", type=int, default=10_000)
+    parser.add_argument("--members", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.expenses, args.members)
+    variants = [("old: loads + jsonable_encoder + json", old_path),
+                ("new: passthrough, stdlib json", stdlib_passthrough)]
+    if serialization.orjson is not None:
+        variants.append(("new: passthrough, orjson", new_path))
+
+    print(f"{args.expenses} expenses, {args.members} members, best of {args.rounds}\n")
+    print(f"{'variant':<40} {'encode ms':>10} {'bytes':>10}")
+    bodies = {}
+    for name, fn in variants:
+        elapsed, body = timeit(fn, rows, args.rounds)
+        bodies[name] = body
+        print(f"{name:<40} {elapsed * 1000:>10.1f} {len(body):>10}")
+
+    reference = json.loads(bodies[variants[0][0]])
+    for name, body in bodies.items():
+        assert json.loads(body) == reference, f"{name} produced a different document"
+
+    body = bodies[variants[-1][0]]
+    print(f"\n{'encoding':<40} {'encode ms':>10} {'bytes':>10}")
+    encodings = ["gzip"] + (["br"] if serialization.brotli is not None else [])
+    for encoding in encodings:
+        start = time.perf_counter()
+        compressed = serialization.compress(body, encoding)
+        print(f"{encoding:<40} {(time.perf_counter() - start) * 1000:>10.1f} {len(compressed):>10}")
+
+
+if __name__ == "__main__":
+    main()
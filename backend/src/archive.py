@@ -0,0 +1,261 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from . import db, logic, tripstore
+
+# --- Trip Archive ---
+# Законченная поездка уезжает из горячих таблиц: её траты (вместе с удаленными), заметки
+# и журнал правок пишутся в сжатый файл ARCHIVE_DIR/<trip_id>.json.gz, строки удаляются
+# из expenses / notes / expense_audit, а в trip_archive остаются итоговые балансы. Роллапы
+# статистики и trip_balances не трогаются, так что /api/stats и /summary работают как раньше.
+# Чтение архивной поездки (бот, /api/expenses, /debts, /overview, /changes) берет траты из
+# файла; прочитанные держатся в небольшом LRU, запись которого сверяется с mtime и размером
+# файла (другой процесс мог вернуть поездку и заархивировать её снова). Писать в архивную
+# поездку нельзя (db.TripArchived), пока её не вернут через unarchive_trip.
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR") or os.path.join(os.path.dirname(db.DB_PATH) or ".", "archive")
+CACHE_SIZE = int(os.getenv("ARCHIVE_CACHE_SIZE", "16"))
+FORMAT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+# Same columns the bot and the API read from the hot tables
+_EXPENSE_KEYS = ("id", "trip_id", "payer_id", "amount", "description", "category", "created_at",
+                 "split_json", "currency", "original_amount", "fx_rate", "updated_at", "deleted_at")
+_NOTE_KEYS = ("id", "trip_id", "author_name", "text", "created_at")
+
+
+def path_for(trip_id):
+    # Trip ids are generated (ids.new_id), but the path must never leave ARCHIVE_DIR
+    return os.path.join(ARCHIVE_DIR, os.path.basename(str(trip_id)) + ".json.gz")
+
+
+def is_archived(conn, trip_id):
+    return conn.execute("SELECT 1 FROM trip_archive WHERE trip_id = ?", (trip_id,)).fetchone() is not None
+
+
+def _rows(conn, sql, params):
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
+
+
+def _write(path, payload):
+    """gzip JSON through a temp file + fsync + rename: a crash leaves the old state or the new one."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+            f.write(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+# --- Archive / Unarchive ---
+
+def archive_trip(trip_id, link_map=None):
+    """
+    Moves a trip's rows into its archive file in one write transaction. Returns the
+    trip_archive row as a dict, or None if the trip does not exist or is archived already.
+    """
+    conn = db.get_connection()
+    path = path_for(trip_id)
+    written = False
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        trip = conn.execute("SELECT * FROM trips WHERE id = ?", (trip_id,)).fetchone()
+        if not trip or trip['archived_at']:
+            conn.rollback()
+            return None
+        expenses = _rows(conn, "SELECT * FROM expenses WHERE trip_id = ? ORDER BY id", (trip_id,))
+        notes = _rows(conn, "SELECT * FROM notes WHERE trip_id = ? ORDER BY id", (trip_id,))
+        audit = _rows(conn, "SELECT * FROM expense_audit WHERE trip_id = ? ORDER BY id", (trip_id,))
+        members = [r['user_id'] for r in conn.execute("SELECT user_id FROM trip_members WHERE trip_id = ?", (trip_id,))]
+
+        live = [e for e in expenses if e.get('deleted_at') is None]
+        balances, total_spent, _ = logic.calculate_balance_py(
+            {"members": members, "expenses": tripstore.dict_expenses(live)}, link_map or {})
+        now = int(time.time())
+        size = _write(path, {"format": FORMAT_VERSION, "trip_id": trip_id, "archived_at": now,
+                             "expenses": expenses, "notes": notes, "audit": audit})
+        written = True
+
+        conn.execute(
+            "INSERT INTO trip_archive (trip_id, archived_at, path, expenses, notes, bytes, total_spent, balances_json) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (trip_id, now, os.path.basename(path), len(live), len(notes), size, total_spent,
+             json.dumps(balances, separators=(",", ":"))))
+        conn.execute("DELETE FROM expenses WHERE trip_id = ?", (trip_id,))
+        conn.execute("DELETE FROM notes WHERE trip_id = ?", (trip_id,))
+        conn.execute("DELETE FROM expense_audit WHERE trip_id = ?", (trip_id,))
+        conn.execute("DELETE FROM drafts WHERE trip_id = ?", (trip_id,))
+        conn.execute("UPDATE trips SET archived_at = ? WHERE id = ?", (now, trip_id))
+        db.record_change(conn, trip_id, "trip", trip_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        if written and os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        conn.close()
+    logger.info(f"Archived {trip_id}: {len(live)} expenses, {len(notes)} notes, {size} bytes")
+    return {"trip_id": trip_id, "archived_at": now, "expenses": len(live), "notes": len(notes),
+            "bytes": size, "total_spent": total_spent, "balances": balances}
+
+
+def _insert(conn, table, rows, keys):
+    if not rows:
+        return
+    columns = [k for k in keys if k in rows[0]]
+    conn.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        [tuple(r.get(k) for k in columns) for r in rows])
+
+
+def unarchive_trip(trip_id):
+    """Puts the rows back (same ids, so client copies stay valid); True if the trip was archived."""
+    conn = db.get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if not is_archived(conn, trip_id):
+            conn.rollback()
+            return False
+        payload = _read(path_for(trip_id))
+        _insert(conn, "expenses", payload["expenses"], _EXPENSE_KEYS)
+        _insert(conn, "notes", payload["notes"], _NOTE_KEYS)
+        if payload["audit"]:
+            _insert(conn, "expense_audit", payload["audit"], tuple(payload["audit"][0]))
+        conn.execute("DELETE FROM trip_archive WHERE trip_id = ?", (trip_id,))
+        conn.execute("UPDATE trips SET archived_at = NULL WHERE id = ?", (trip_id,))
+        db.record_change(conn, trip_id, "trip", trip_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    _forget(trip_id)
+    os.remove(path_for(trip_id))
+    logger.info(f"Unarchived {trip_id}")
+    return True
+
+
+def stale_trips(days):
+    """Trips with no change for `days` days that are not archived yet"""
+    cutoff = int(time.time()) - days * 86400
+    conn = db.get_connection()
+    try:
+        rows = conn.execute("""
+            SELECT t.id FROM trips t
+            WHERE t.archived_at IS NULL
+              AND COALESCE((SELECT MAX(created_at) FROM trip_changes c WHERE c.trip_id = t.id), 0) < ?
+        """, (cutoff,)).fetchall()
+    finally:
+        conn.close()
+    return [r['id'] for r in rows]
+
+
+# --- Reading ---
+
+_cache = OrderedDict()  # trip_id -> ((st_mtime_ns, st_size), payload)
+_cache_lock = threading.Lock()
+
+
+def _read(path):
+    with gzip.open(path, "rb") as f:
+        return json.loads(f.read())
+
+
+def _forget(trip_id):
+    with _cache_lock:
+        _cache.pop(trip_id, None)
+
+
+def _checked(expense):
+    # split_json is sent to API clients verbatim; a corrupt one becomes {} like in the hot tables
+    try:
+        json.loads(expense.get("split_json") or "{}")
+    except ValueError:
+        expense = dict(expense, split_json="{}")
+    return expense
+
+
+def load(trip_id):
+    """
+    {"expenses": [...], "notes": [...]} of an archived trip: rows shaped like the hot
+    tables' (split_json as text), live expenses only, in id order like a table scan (so
+    balances add up in the same order, bit for bit). Shared, read-only.
+    """
+    path = path_for(trip_id)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _cache_lock:
+        cached = _cache.get(trip_id)
+        if cached is not None and cached[0] == stamp:
+            _cache.move_to_end(trip_id)
+            return cached[1]
+    payload = _read(path)
+    result = {"expenses": [_checked(e) for e in payload["expenses"] if e.get("deleted_at") is None],
+              "notes": payload["notes"]}
+    with _cache_lock:
+        _cache[trip_id] = (stamp, result)
+        _cache.move_to_end(trip_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def fill_trip(trip):
+    """Fills a db.get_trip() dict of an archived trip with its expenses and notes."""
+    archived = load(trip['id'])
+    trip['expenses'] = tripstore.expenses_from_rows(archived['expenses'], trip['id'])
+    trip['notes'] = [dict(n, ts=n['created_at']) for n in archived['notes']]
+    return trip
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive finished trips out of the hot tables")
+    sub = parser.add_subparsers(dest="command", required=True)
+    put = sub.add_parser("archive", help="archive trips by id")
+    put.add_argument("trip_ids", nargs="+")
+    back = sub.add_parser("unarchive", help="move archived trips back into the hot tables")
+    back.add_argument("trip_ids", nargs="+")
+    idle = sub.add_parser("idle", help="archive every trip with no changes for DAYS days")
+    idle.add_argument("days", type=int)
+    idle.add_argument("--dry-run", action="store_true")
+    sub.add_parser("list", help="archived trips")
+    args = parser.parse_args(argv)
+
+    from . import data  # creates / migrates the database
+    link_map = {uid: u['linked_to'] for uid, u in data.get_all_users_as_dict().items() if u.get('linked_to')}
+    if args.command == "list":
+        conn = db.get_connection()
+        for r in conn.execute("SELECT trip_id, archived_at, expenses, notes, bytes FROM trip_archive ORDER BY archived_at"):
+            print(f"{r['trip_id']}  {time.strftime('%Y-%m-%d', time.localtime(r['archived_at']))}  "
+                  f"{r['expenses']} expenses, {r['notes']} notes, {r['bytes']} bytes")
+        conn.close()
+        return 0
+    if args.command == "unarchive":
+        for trip_id in args.trip_ids:
+            print(f"{trip_id}: {'unarchived' if unarchive_trip(trip_id) else 'not archived'}")
+        return 0
+    trip_ids = args.trip_ids if args.command == "archive" else stale_trips(args.days)
+    for trip_id in trip_ids:
+        if getattr(args, "dry_run", False):
+            print(f"{trip_id}: would archive")
+            continue
+        info = archive_trip(trip_id, link_map)
+        print(f"{trip_id}: " + (f"{info['expenses']} expenses, {info['bytes']} bytes" if info else "skipped"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+import argparse
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+from . import archive, db, metrics
+
+# --- Online Backup ---
+# Бот и API пишут в один splitopus.db, и копировать живой файл нельзя: cp посреди записи
+# дает битую копию. Снимок делается через SQLite backup API: страницы копируются пачками
+# по BACKUP_PAGES с паузой BACKUP_SLEEP_MS между ними, поэтому читающая блокировка
+# держится миллисекунды, а писатели успевают между шагами. Если базу поменяли посреди
+# копирования, SQLite начинает заново; после BACKUP_MAX_RESTARTS рестартов снимок
+# делается одним шагом. Готовая копия проверяется PRAGMA integrity_check и только потом
+# переименовывается в splitopus-YYYYmmdd-HHMMSS.db. Файлы архива поездок (src/archive.py)
+# неизменяемы и докопируются в BACKUP_DIR/archive. Старые снимки чистит retention:
+# последние BACKUP_KEEP и по одному на день за BACKUP_KEEP_DAYS дней. По расписанию
+# (BACKUP_INTERVAL_S) снимки делает процесс API.
+
+BACKUP_DIR = os.getenv("BACKUP_DIR") or os.path.join(os.path.dirname(db.DB_PATH) or ".", "backups")
+INTERVAL_S = float(os.getenv("BACKUP_INTERVAL_S", str(6 * 3600)))
+PAGES = int(os.getenv("BACKUP_PAGES", "256"))
+SLEEP_MS = float(os.getenv("BACKUP_SLEEP_MS", "5"))
+MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "20"))
+KEEP = int(os.getenv("BACKUP_KEEP", "8"))
+KEEP_DAYS = int(os.getenv("BACKUP_KEEP_DAYS", "14"))
+
+SNAPSHOT_NAME = re.compile(r"^splitopus-(\d{8}-\d{6})(?:-[a-z-]+)?\.db$")
+
+logger = logging.getLogger(__name__)
+
+BACKUPS = metrics.counter("splitopus_backups_total", "Backups by result (ok / failed)", ["result"])
+BACKUP_SECONDS = metrics.histogram(
+    "splitopus_backup_seconds", "Time to copy and verify a backup", buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+BACKUP_RESTARTS = metrics.counter(
+    "splitopus_backup_restarts_total", "Backup copies restarted because the database changed under them")
+LAST_BACKUP = metrics.gauge("splitopus_backup_last_success_timestamp_seconds", "When the newest backup finished")
+BACKUP_BYTES = metrics.gauge("splitopus_backup_bytes", "Size of the newest backup")
+
+
+class BackupFailed(Exception):
+    """The copy did not pass the integrity check."""
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def integrity_errors(path):
+    """[] if PRAGMA integrity_check passes, else its messages."""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = [r[0] for r in conn.execute("PRAGMA integrity_check").fetchall()]
+    finally:
+        conn.close()
+    return [] if rows == ["ok"] else rows
+
+
+def _copy(source_path, target_path, pages, sleep_ms, journal_mode=None):
+    """
+    Copies source into target with the backup API, `pages` pages per step. Returns how
+    many times SQLite restarted the copy; raises _TooManyRestarts past MAX_RESTARTS.
+    """
+    source = sqlite3.connect(source_path, timeout=30)
+    target = sqlite3.connect(target_path, timeout=30)
+    restarts = 0
+    last = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last
+        if last is not None and remaining > last:
+            restarts += 1
+            BACKUP_RESTARTS.inc()
+            if restarts > MAX_RESTARTS:
+                raise _TooManyRestarts()
+        last = remaining
+        # The read lock is released between steps: this is where writers get in
+        if remaining and sleep_ms:
+            time.sleep(sleep_ms / 1000)
+
+    try:
+        source.backup(target, pages=pages, progress=progress)
+        if journal_mode:
+            target.execute(f"PRAGMA journal_mode = {journal_mode}")
+    finally:
+        target.close()
+        source.close()
+    return restarts
+
+
+def _fsync(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def _sync_archive(source_dir, target_dir):
+    """Copies archive files missing (or changed, after unarchive + archive) in target_dir."""
+    if not os.path.isdir(source_dir):
+        return 0
+    os.makedirs(target_dir, exist_ok=True)
+    copied = 0
+    for name in os.listdir(source_dir):
+        if not name.endswith(".json.gz"):
+            continue
+        src, dst = os.path.join(source_dir, name), os.path.join(target_dir, name)
+        if os.path.exists(dst) and os.path.getsize(dst) == os.path.getsize(src) \
+                and os.path.getmtime(dst) >= os.path.getmtime(src):
+            continue
+        shutil.copy2(src, dst)
+        copied += 1
+    return copied
+
+
+def snapshot(backup_dir=None, pages=None, sleep_ms=None, label=None):
+    """
+    Online backup of db.DB_PATH into backup_dir. Returns {'path', 'bytes', 'seconds',
+    'restarts', 'archive_files'}; raises BackupFailed if the copy is corrupt.
+    """
+    backup_dir = backup_dir or BACKUP_DIR
+    pages = PAGES if pages is None else pages
+    sleep_ms = SLEEP_MS if sleep_ms is None else sleep_ms
+    os.makedirs(backup_dir, exist_ok=True)
+    name = time.strftime("splitopus-%Y%m%d-%H%M%S", time.localtime()) + (f"-{label}" if label else "") + ".db"
+    path = os.path.join(backup_dir, name)
+    tmp = f"{path}.tmp"
+    start = time.perf_counter()
+    try:
+        try:
+            # The copy of a WAL database is switched to a rollback journal: one self-contained file
+            restarts = _copy(db.DB_PATH, tmp, pages, sleep_ms, "delete")
+        except _TooManyRestarts:
+            # The database keeps changing faster than it is copied: one step, writers wait
+            logger.warning(f"Backup restarted more than {MAX_RESTARTS} times, copying in one step")
+            os.remove(tmp)
+            _copy(db.DB_PATH, tmp, -1, 0, "delete")
+            restarts = MAX_RESTARTS + 1
+        errors = integrity_errors(tmp)
+        if errors:
+            raise BackupFailed(f"{name}: integrity_check failed: {'; '.join(errors[:5])}")
+        _fsync(tmp)
+        os.replace(tmp, path)
+    except Exception:
+        BACKUPS.inc(result="failed")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    copied = _sync_archive(archive.ARCHIVE_DIR, os.path.join(backup_dir, "archive"))
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(path)
+    BACKUPS.inc(result="ok")
+    BACKUP_SECONDS.observe(seconds)
+    LAST_BACKUP.set(time.time())
+    BACKUP_BYTES.set(size)
+    logger.info(f"Backup {name}: {size} bytes in {seconds:.2f}s, {restarts} restarts, {copied} archive files")
+    return {"path": path, "bytes": size, "seconds": seconds, "restarts": restarts, "archive_files": copied}
+
+
+# --- Retention ---
+
+def list_snapshots(backup_dir=None):
+    """[(taken_at, path)] newest first."""
+    backup_dir = backup_dir or BACKUP_DIR
+    if not os.path.isdir(backup_dir):
+        return []
+    found = []
+    for name in os.listdir(backup_dir):
+        m = SNAPSHOT_NAME.match(name)
+        if m:
+            found.append((time.mktime(time.strptime(m.group(1), "%Y%m%d-%H%M%S")), os.path.join(backup_dir, name)))
+    return sorted(found, reverse=True)
+
+
+def prune(backup_dir=None, keep=None, keep_days=None, now=None):
+    """Keeps the newest `keep` snapshots and the newest one of each of the last `keep_days` days."""
+    keep = KEEP if keep is None else keep
+    keep_days = KEEP_DAYS if keep_days is None else keep_days
+    now = time.time() if now is None else now
+    snapshots = list_snapshots(backup_dir)
+    kept, days = set(), set()
+    for i, (taken_at, path) in enumerate(snapshots):
+        day = time.strftime("%Y-%m-%d", time.localtime(taken_at))
+        if i < keep or (now - taken_at < keep_days * 86400 and day not in days):
+            kept.add(path)
+        days.add(day)
+    removed = [path for _, path in snapshots if path not in kept]
+    for path in removed:
+        os.remove(path)
+    if removed:
+        logger.info(f"Removed {len(removed)} old backups")
+    return removed
+
+
+# --- Restore ---
+
+def _last_change_seq(path):
+    """The highest trip version a client could have seen from this database"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'trip_changes'").fetchone()
+        version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM trips").fetchone()
+    except sqlite3.OperationalError:  # a database from before the change log
+        return 0
+    finally:
+        conn.close()
+    return max(seq[0] if seq else 0, version[0])
+
+
+def restore(path, backup_dir=None):
+    """
+    Replaces the live database with a snapshot, through the backup API (other connections
+    see either the old database or the restored one). The current database is saved as a
+    '-pre-restore' snapshot first. Archive files the snapshot refers to are copied back.
+    """
+    errors = integrity_errors(path)
+    if errors:
+        raise BackupFailed(f"{path}: integrity_check failed: {'; '.join(errors[:5])}")
+    backup_dir = backup_dir or os.path.dirname(os.path.abspath(path))
+    before = snapshot(backup_dir, pages=-1, sleep_ms=0, label="pre-restore") if os.path.exists(db.DB_PATH) else None
+    past_seq = _last_change_seq(before["path"]) if before else 0
+    _copy(path, db.DB_PATH, -1, 0)
+
+    conn = sqlite3.connect(db.DB_PATH)
+    try:
+        has_archive = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'trip_archive'").fetchone()
+        names = [r[0] for r in conn.execute("SELECT path FROM trip_archive")] if has_archive else []
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'trip_changes'").fetchone():
+            # The snapshot rolled versions back: clients must not keep the newer ones they saw
+            conn.execute("BEGIN IMMEDIATE")
+            db.restart_change_log(conn, past_seq)
+            conn.commit()
+    finally:
+        conn.close()
+    missing = []
+    for name in names:
+        target = os.path.join(archive.ARCHIVE_DIR, name)
+        if os.path.exists(target):
+            continue
+        source = os.path.join(backup_dir, "archive", name)
+        if os.path.exists(source):
+            os.makedirs(archive.ARCHIVE_DIR, exist_ok=True)
+            shutil.copy2(source, target)
+        else:
+            missing.append(name)
+    logger.info(f"Restored {db.DB_PATH} from {path}")
+    return {"previous": before["path"] if before else None, "missing_archive_files": missing}
+
+
+# --- Schedule ---
+
+class Scheduler:
+    """Background thread: a snapshot + prune every `interval` seconds, counted from the newest snapshot."""
+
+    def __init__(self, interval=INTERVAL_S, backup_dir=None):
+        self.interval = interval
+        self.backup_dir = backup_dir
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="backup", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def due_in(self):
+        snapshots = list_snapshots(self.backup_dir)
+        return self.interval - (time.time() - snapshots[0][0]) if snapshots else 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = self.due_in()
+            if wait > 0:
+                self._stop.wait(min(wait, 60))
+                continue
+            try:
+                snapshot(self.backup_dir)
+                prune(self.backup_dir)
+            except Exception as e:
+                logger.error(f"Backup failed: {e}")
+                # Don't retry in a tight loop against a broken disk
+                self._stop.wait(min(self.interval, 600))
+
+
+scheduler = Scheduler()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Online backups of the splitopus database")
+    parser.add_argument("--dir", help=f"backup directory (default {BACKUP_DIR})")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="take a backup now, then prune old ones")
+    run.add_argument("--pages", type=int, help=f"pages per step (default {PAGES}, -1 = all at once)")
+    run.add_argument("--sleep-ms", type=float, help=f"pause between steps (default {SLEEP_MS})")
+    run.add_argument("--no-prune", action="store_true")
+    sub.add_parser("list", help="backups, newest first")
+    sub.add_parser("prune", help=f"apply the retention policy (keep {KEEP}, daily for {KEEP_DAYS} days)")
+    verify = sub.add_parser("verify", help="PRAGMA integrity_check of a backup")
+    verify.add_argument("path")
+    back = sub.add_parser("restore", help="replace the database with a backup (stop the bot and the API first)")
+    back.add_argument("path")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "run":
+            if not os.path.exists(db.DB_PATH):
+                print(f"{db.DB_PATH} does not exist", file=sys.stderr)
+                return 1
+            info = snapshot(args.dir, args.pages, args.sleep_ms)
+            print(f"{info['path']}: {info['bytes']} bytes in {info['seconds']:.2f}s, {info['restarts']} restarts, "
+                  f"{info['archive_files']} archive files")
+            if not args.no_prune:
+                for path in prune(args.dir):
+                    print(f"removed {path}")
+        elif args.command == "list":
+            for taken_at, path in list_snapshots(args.dir):
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(taken_at))}  "
+                      f"{os.path.getsize(path):>12}  {path}")
+        elif args.command == "prune":
+            for path in prune(args.dir):
+                print(f"removed {path}")
+        elif args.command == "verify":
+            errors = integrity_errors(args.path)
+            print("\n".join(errors) if errors else "ok")
+            return 1 if errors else 0
+        else:
+            info = restore(args.path, args.dir)
+            print(f"Restored {db.DB_PATH} from {args.path}")
+            if info["previous"]:
+                print(f"Previous database saved as {info['previous']}")
+            for name in info["missing_archive_files"]:
+                print(f"archive file missing: {name}", file=sys.stderr)
+            print("Restart the bot and the API: their caches still hold the old data")
+    except (BackupFailed, sqlite3.Error, OSError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
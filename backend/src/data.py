@@ -1,7 +1,6 @@
 import json
 import os
-import time
-from . import db
+from . import archive, db, drafts, ids, logic
 
 # --- Initialization ---
 db.init_db()
@@ -60,14 +59,22 @@ def get_all_users_as_dict():
 # --- Trip Operations ---
 
 def create_trip(creator_id, name):
-    tid = f"trip_{int(time.time())}"
-    code = db.generate_trip_code()
-    db.create_trip(tid, code, creator_id, name)
+    tid = ids.new_id("trip_")
+    code = db.create_trip(tid, db.generate_trip_code(), creator_id, name)
     db.set_user_active_trip(creator_id, tid)
     return tid, code
 
 def get_trip(trip_id):
-    return db.get_trip(trip_id)
+    trip = db.get_trip(trip_id)
+    if trip and trip.get('archived_at'):
+        archive.fill_trip(trip)  # траты и заметки — из файла архива
+    return trip
+
+def get_trip_version(trip_id):
+    return db.get_trip_version(trip_id)
+
+def get_trip_creator(trip_id):
+    return db.get_trip_creator(trip_id)
 
 def get_trip_by_code(code):
     return db.get_trip_by_code(code)
@@ -75,8 +82,18 @@ def get_trip_by_code(code):
 def add_member_to_trip(trip_id, user_id):
     db.add_member_to_trip(trip_id, user_id)
 
-def get_user_trips(user_id):
-    return db.get_user_trips(user_id)
+def get_user_trips(user_id, archived=False):
+    return db.get_user_trips(user_id, archived)
+
+def archive_trip(trip_id):
+    users = db.get_all_users_as_dict()
+    return archive.archive_trip(trip_id, {uid: u['linked_to'] for uid, u in users.items() if u.get('linked_to')})
+
+def unarchive_trip(trip_id):
+    return archive.unarchive_trip(trip_id)
+
+def get_user_summary(user_id):
+    return logic.user_summary(*db.get_user_ledger(user_id))
 
 def update_trip_rate(trip_id, rate):
     db.update_trip_rate(trip_id, rate)
@@ -84,24 +101,41 @@ def update_trip_rate(trip_id, rate):
 def update_trip_currency(trip_id, currency):
     db.update_trip_currency(trip_id, currency)
 
+def set_fx_rate(day, base, quote, rate, source="manual"):
+    db.set_fx_rate(day, base, quote, rate, source)
+
+def get_fx_rate(base, quote, day):
+    return db.get_fx_rate(base, quote, day)
+
 # --- Expense & Note Operations ---
 
-def add_expense(trip_id, payer_id, amount, desc, category, split_map):
-    db.add_expense(trip_id, payer_id, amount, desc, category, split_map)
+def add_expense(trip_id, payer_id, amount, desc, category, split_map, currency=None):
+    return db.add_expense(trip_id, payer_id, amount, desc, category, split_map, currency)
+
+def get_expense(expense_id):
+    return db.get_expense(expense_id)
+
+def update_expense(expense_id, changes, user_id=None):
+    return db.update_expense(expense_id, changes, user_id)
+
+def delete_expense(expense_id, user_id=None):
+    return db.delete_expense(expense_id, user_id)
 
 def add_note(trip_id, author_name, text):
     db.add_note(trip_id, author_name, text)
 
 # --- Draft Operations ---
 
+# Через src/drafts.py: активные черновики в памяти, в базу - пачками
+
 def save_draft(draft_id, data):
-    db.save_draft(draft_id, data)
+    drafts.store.save(draft_id, data)
 
 def get_draft(draft_id):
-    return db.get_draft(draft_id)
+    return drafts.store.get(draft_id)
 
 def delete_draft(draft_id):
-    db.delete_draft(draft_id)
+    drafts.store.delete(draft_id)
 
 # --- Legacy Compat ---
 
@@ -1,32 +1,281 @@
 import sqlite3
 import json
+import logging
 import os
 import time
-import random
-import string
 
-DB_PATH = os.path.join("data", "splitopus.db")
+from . import fx, ids, logic, querystats, tripstore
+
+DB_PATH = os.getenv("DB_PATH", os.path.join("data", "splitopus.db"))
 SCHEMA_PATH = os.path.join(os.path.dirname(__file__), "schema.sql")
+# WAL: чтения не ждут записей другого процесса; чекпойнты делает src/maintenance.py
+JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "wal")
+
+logger = logging.getLogger(__name__)
 
 def get_connection():
     """Создает подключение к базе данных"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = querystats.connect(DB_PATH) # Считает и замеряет запросы (src/querystats.py)
     conn.row_factory = sqlite3.Row # Позволяет обращаться к колонкам по имени
     return conn
 
 def init_db():
     """Создает таблицы, если их нет"""
-    if not os.path.exists("data"):
-        os.makedirs("data")
+    data_dir = os.path.dirname(DB_PATH)
+    if data_dir and not os.path.exists(data_dir):
+        os.makedirs(data_dir)
         
     with open(SCHEMA_PATH, 'r') as f:
         schema = f.read()
         
     conn = get_connection()
+    _setup_storage(conn)
     conn.executescript(schema)
+    _migrate(conn)
     conn.commit()
     conn.close()
 
+def _setup_storage(conn):
+    """Режим журнала и auto_vacuum=INCREMENTAL (свободные страницы возвращает src/maintenance.py)"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Новой базе хватает pragma до первой таблицы (и до journal_mode: он уже пишет заголовок).
+        # Старую нужно перестроить полным VACUUM, а он держит всю базу на время перестройки:
+        # это делается руками, не при старте
+        if conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+            logger.warning(f"{DB_PATH} is not in auto_vacuum=INCREMENTAL, free pages stay in the file; "
+                           "run `python -m src.maintenance convert` once")
+        else:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    try:
+        conn.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
+    except sqlite3.OperationalError as e:
+        # База занята другим процессом (бот и API стартуют вместе): повторим при следующем запуске
+        logger.warning(f"journal_mode={JOURNAL_MODE} not set: {e}")
+
+def _add_column_if_missing(conn, table, column, decl):
+    cols = [r['name'] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _migrate(conn):
+    """Догоняет схему старых баз (CREATE TABLE IF NOT EXISTS не добавляет колонки)"""
+    _add_column_if_missing(conn, "trips", "version", "INTEGER DEFAULT 0")
+    _add_column_if_missing(conn, "expenses", "currency", "TEXT")
+    _add_column_if_missing(conn, "expenses", "original_amount", "REAL")
+    _add_column_if_missing(conn, "expenses", "fx_rate", "REAL")
+    _add_column_if_missing(conn, "drafts", "currency", "TEXT")
+    _add_column_if_missing(conn, "expenses", "updated_at", "INTEGER")
+    _add_column_if_missing(conn, "expenses", "deleted_at", "INTEGER")
+    _add_column_if_missing(conn, "trips", "archived_at", "INTEGER")
+    # Журнал изменений должен начинаться выше уже выданных версий, иначе они пойдут назад
+    if conn.execute("SELECT COUNT(*) FROM trip_changes").fetchone()[0] == 0:
+        max_version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM trips").fetchone()[0]
+        if max_version > 0:
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = 'trip_changes'")
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('trip_changes', ?)", (max_version,))
+    # Роллапы статистики и балансы появились позже трат: для старой базы считаем их один раз
+    if not conn.execute("SELECT 1 FROM trip_balances LIMIT 1").fetchone() and \
+            conn.execute("SELECT 1 FROM expenses LIMIT 1").fetchone():
+        rebuild_stats(conn)
+
+# --- Change Log & Trip Versions ---
+# Каждое изменение трат, заметок, участников или самой поездки пишется в trip_changes
+# в той же транзакции, что и само изменение. seq монотонно растет, и версия поездки
+# равна seq ее последнего изменения: API отдает ее как ETag и как точку для дельта-синка.
+
+def record_change(conn, trip_id, entity, entity_id, op="upsert"):
+    """Вызывается внутри транзакции, которая меняет данные поездки"""
+    cur = conn.execute(
+        "INSERT INTO trip_changes (trip_id, entity, entity_id, op, created_at) VALUES (?, ?, ?, ?, ?)",
+        (trip_id, entity, str(entity_id), op, int(time.time()))
+    )
+    conn.execute("UPDATE trips SET version = ? WHERE id = ?", (cur.lastrowid, trip_id))
+    return cur.lastrowid
+
+def record_changes(conn, trip_id, entity, entity_ids, op="upsert"):
+    """Как record_change, но для пачки объектов: один executemany и одно обновление версии"""
+    now = int(time.time())
+    conn.executemany(
+        "INSERT INTO trip_changes (trip_id, entity, entity_id, op, created_at) VALUES (?, ?, ?, ?, ?)",
+        [(trip_id, entity, str(entity_id), op, now) for entity_id in entity_ids]
+    )
+    seq = conn.execute("SELECT MAX(seq) FROM trip_changes WHERE trip_id = ?", (trip_id,)).fetchone()[0]
+    conn.execute("UPDATE trips SET version = ? WHERE id = ?", (seq, trip_id))
+    return seq
+
+def record_user_change(conn, user_id):
+    """Имя или привязка пользователя влияют на все его поездки"""
+    rows = conn.execute("SELECT trip_id FROM trip_members WHERE user_id = ?", (str(user_id),)).fetchall()
+    for r in rows:
+        record_change(conn, r['trip_id'], "member", user_id)
+
+def get_changes_floor(conn):
+    """Версии ниже этой были выданы до начала журнала: такому клиенту нужен полный снимок"""
+    row = conn.execute("SELECT MIN(seq) FROM trip_changes").fetchone()
+    return row[0] - 1 if row[0] is not None else None
+
+def restart_change_log(conn, past_seq):
+    """
+    После восстановления из снимка: клиенты могли видеть версии новее снимка (до past_seq).
+    Журнал очищается, seq продолжается после past_seq, а каждая поездка получает запись
+    "trip" — версии и ETag уходят дальше всего, что видели клиенты, а все старые версии
+    оказываются ниже floor, и клиент берёт полный снимок. created_at запоминается
+    последний из журнала, чтобы stale_trips не считал поездки свежими.
+    """
+    last = dict(conn.execute("SELECT trip_id, MAX(created_at) FROM trip_changes GROUP BY trip_id").fetchall())
+    past_seq = max(past_seq, conn.execute("SELECT COALESCE(MAX(seq), 0) FROM trip_changes").fetchone()[0],
+                   conn.execute("SELECT COALESCE(MAX(version), 0) FROM trips").fetchone()[0])
+    conn.execute("DELETE FROM trip_changes")
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'trip_changes'")
+    # +1: the first new entry is past_seq + 2, so the floor (MIN(seq) - 1) is above every old version
+    conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('trip_changes', ?)", (past_seq + 1,))
+    for (trip_id,) in conn.execute("SELECT id FROM trips").fetchall():
+        cur = conn.execute(
+            "INSERT INTO trip_changes (trip_id, entity, entity_id, op, created_at) VALUES (?, 'trip', ?, 'upsert', ?)",
+            (trip_id, trip_id, last.get(trip_id) or 0))
+        conn.execute("UPDATE trips SET version = ? WHERE id = ?", (cur.lastrowid, trip_id))
+
+def get_trip_changes(conn, trip_id, since):
+    """Возвращает {(entity, entity_id): op} с последней операцией по каждому объекту после since"""
+    rows = conn.execute(
+        "SELECT entity, entity_id, op FROM trip_changes WHERE trip_id = ? AND seq > ? ORDER BY seq",
+        (trip_id, since)
+    ).fetchall()
+    return {(r['entity'], r['entity_id']): r['op'] for r in rows}
+
+def get_trip_version(trip_id):
+    conn = get_connection()
+    row = conn.execute("SELECT version FROM trips WHERE id = ?", (trip_id,)).fetchone()
+    conn.close()
+    return row['version'] if row else None
+
+def get_trip_creator(trip_id):
+    conn = get_connection()
+    row = conn.execute("SELECT creator_id FROM trips WHERE id = ?", (trip_id,)).fetchone()
+    conn.close()
+    return row['creator_id'] if row else None
+
+# --- Stats Rollups ---
+# Статистика поездки лежит готовыми суммами: stats_by_category по (поездка, master_id,
+# категория) и stats_by_day по (поездка, день). Они обновляются в той же транзакции,
+# что и вставка траты, так что /api/stats — это выборка нескольких строк, а не проход
+# по всем тратам. Возвраты долга (REPAYMENT) в статистику не входят, как в logic.get_my_stats.
+# Там же копятся trip_balances (заплатил / потратил по user id) — из них собирается
+# сводка пользователя по всем поездкам без calculate_balance по каждой.
+
+TRIP_TOTAL = "*"  # master_id строки с итогом категории по всей поездке
+
+_ROLLUP_CATEGORY_SQL = (
+    "INSERT INTO stats_by_category (trip_id, master_id, category, amount, expenses) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(trip_id, master_id, category) DO UPDATE SET "
+    "amount = amount + excluded.amount, expenses = expenses + excluded.expenses"
+)
+_ROLLUP_DAY_SQL = (
+    "INSERT INTO stats_by_day (trip_id, day, amount, expenses) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(trip_id, day) DO UPDATE SET "
+    "amount = amount + excluded.amount, expenses = expenses + excluded.expenses"
+)
+
+def _stats_day(created_at):
+    return time.strftime("%Y-%m-%d", time.localtime(created_at))
+
+def _rollup_rows(trip_id, amount, category, split, created_at):
+    """Строки для stats_by_category и stats_by_day одной траты"""
+    category = category or "OTHER"
+    if category == "REPAYMENT":
+        return [], []
+    by_category = [(trip_id, TRIP_TOTAL, category, float(amount))]
+    # Как в get_my_stats: в долю участника идут только положительные доли
+    by_category += [(trip_id, str(uid), category, float(share)) for uid, share in (split or {}).items() if share > 0]
+    by_day = [(trip_id, _stats_day(created_at), float(amount))] if created_at is not None else []
+    return by_category, by_day
+
+_BALANCE_SQL = (
+    "INSERT INTO trip_balances (trip_id, user_id, paid, owed) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(trip_id, user_id) DO UPDATE SET paid = paid + excluded.paid, owed = owed + excluded.owed"
+)
+
+def rollup_expense(conn, trip_id, payer_id, amount, category, split, created_at, sign=1):
+    """Вызывается внутри транзакции, которая добавляет трату; sign=-1 вычитает ее обратно"""
+    rollup_expenses(conn, [(trip_id, payer_id, amount, category, split, created_at)], sign)
+
+def rollup_expenses(conn, expenses, sign=1):
+    """
+    То же для пачки трат (trip_id, payer_id, amount, category, split, created_at): суммы
+    копятся в памяти, и на каждый ключ роллапа уходит один upsert, а не по одному на трату.
+    """
+    # Порядок вставки = порядок первого появления категории, как в get_my_stats
+    by_category, by_day, balances = {}, {}, {}
+    for trip_id, payer_id, amount, category, split, created_at in expenses:
+        paid = balances.setdefault((trip_id, str(payer_id)), [0.0, 0.0])
+        paid[0] += float(amount or 0.0)
+        for uid, share in (split or {}).items():
+            owed = balances.setdefault((trip_id, str(uid)), [0.0, 0.0])
+            owed[1] += float(share)
+        cats, days = _rollup_rows(trip_id, amount or 0.0, category, split, created_at)
+        for *key, value in cats:
+            total = by_category.setdefault(tuple(key), [0.0, 0])
+            total[0] += value
+            total[1] += 1
+        for *key, value in days:
+            total = by_day.setdefault(tuple(key), [0.0, 0])
+            total[0] += value
+            total[1] += 1
+    conn.executemany(_ROLLUP_CATEGORY_SQL, [(*k, sign * v[0], sign * v[1]) for k, v in by_category.items()])
+    conn.executemany(_ROLLUP_DAY_SQL, [(*k, sign * v[0], sign * v[1]) for k, v in by_day.items()])
+    conn.executemany(_BALANCE_SQL, [(*k, sign * v[0], sign * v[1]) for k, v in balances.items()])
+
+def encode_split(split):
+    """
+    split_json для записи. API отдает его клиентам как есть (serialization.RawJSON), поэтому
+    в базу попадает только объект {user_id: конечное число}; иначе ValueError.
+    """
+    if not isinstance(split, dict) or not all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in split.values()):
+        raise ValueError("split must map user ids to numbers")
+    return json.dumps(split, allow_nan=False, separators=(",", ":"))
+
+def _decode_split(split_json):
+    try:
+        return json.loads(split_json) if split_json else {}
+    except ValueError:
+        return {}
+
+def rebuild_stats(conn, trip_id=None):
+    """Пересчитывает роллапы и trip_balances с нуля по таблице expenses (всей базы или одной поездки)"""
+    where, params = ("WHERE trip_id = ?", (trip_id,)) if trip_id else ("", ())
+    conn.execute(f"DELETE FROM stats_by_category {where}", params)
+    conn.execute(f"DELETE FROM stats_by_day {where}", params)
+    conn.execute(f"DELETE FROM trip_balances {where}", params)
+    rows = conn.execute(
+        f"SELECT trip_id, payer_id, amount, category, split_json, created_at FROM expenses "
+        f"{where + ' AND' if where else 'WHERE'} deleted_at IS NULL ORDER BY id", params
+    ).fetchall()
+    rollup_expenses(conn, ((r[0], r[1], r[2], r[3], _decode_split(r[4]), r[5]) for r in rows))
+
+def get_stats(conn, trip_id, user_id=None):
+    """Статистика поездки из роллапов: по категориям, доля user_id по категориям и по дням"""
+    rows = conn.execute(
+        "SELECT master_id, category, amount FROM stats_by_category "
+        "WHERE trip_id = ? AND master_id IN (?, ?) AND expenses > 0 ORDER BY rowid",
+        (trip_id, TRIP_TOTAL, str(user_id) if user_id is not None else TRIP_TOTAL)
+    ).fetchall()
+    by_category, my_category = {}, {}
+    for master_id, category, amount in rows:
+        (by_category if master_id == TRIP_TOTAL else my_category)[category] = amount
+    days = conn.execute(
+        "SELECT day, amount, expenses FROM stats_by_day WHERE trip_id = ? AND expenses > 0 ORDER BY day", (trip_id,)
+    ).fetchall()
+    stats = {
+        "by_category": by_category,
+        "total": sum(by_category.values()),
+        "daily": [{"day": day, "amount": amount, "expenses": n} for day, amount, n in days],
+    }
+    if user_id is not None:
+        stats["my_category"] = my_category
+        stats["my_total"] = sum(my_category.values())
+    return stats
+
 # --- Users ---
 
 def upsert_user(user_id, name):
@@ -36,6 +285,7 @@ def upsert_user(user_id, name):
         "INSERT INTO users (id, name) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET name=?",
         (str(user_id), name, name)
     )
+    record_user_change(conn, user_id)
     conn.commit()
     conn.close()
 
@@ -60,6 +310,7 @@ def set_user_active_trip(user_id, trip_id):
 def link_users(child_id, parent_id):
     conn = get_connection()
     conn.execute("UPDATE users SET linked_to = ? WHERE id = ?", (str(parent_id), str(child_id)))
+    record_user_change(conn, child_id)
     conn.commit()
     conn.close()
 
@@ -109,19 +360,46 @@ def get_linked_names(master_id, filter_ids=None):
 
 # --- Trips ---
 
+# Попыток вставить поездку, если код приглашения уже занят
+CODE_ATTEMPTS = 8
+
 def generate_trip_code():
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    return _code_pool.take()
+
+def taken_trip_codes(codes):
+    """Коды из списка, которые уже заняты поездками"""
+    conn = get_connection()
+    placeholders = ",".join("?" * len(codes))
+    rows = conn.execute(f"SELECT code FROM trips WHERE code IN ({placeholders})", list(codes)).fetchall()
+    conn.close()
+    return {r['code'] for r in rows}
+
+_code_pool = ids.CodePool(taken_trip_codes)
 
 def create_trip(trip_id, code, creator_id, name):
+    """
+    Создаёт поездку и возвращает её код приглашения. Если код занят (другой процесс
+    успел раньше), берётся следующий из пула.
+    """
     conn = get_connection()
-    conn.execute(
-        "INSERT INTO trips (id, code, creator_id, name) VALUES (?, ?, ?, ?)",
-        (trip_id, code, str(creator_id), name)
-    )
+    for attempt in range(CODE_ATTEMPTS):
+        try:
+            conn.execute(
+                "INSERT INTO trips (id, code, creator_id, name) VALUES (?, ?, ?, ?)",
+                (trip_id, code, str(creator_id), name)
+            )
+            break
+        except sqlite3.IntegrityError:
+            if attempt == CODE_ATTEMPTS - 1 or conn.execute("SELECT 1 FROM trips WHERE code = ?", (code,)).fetchone() is None:
+                conn.close()
+                raise
+            code = generate_trip_code()
     # Создатель сразу становится участником
     conn.execute("INSERT INTO trip_members (trip_id, user_id) VALUES (?, ?)", (trip_id, str(creator_id)))
+    record_change(conn, trip_id, "member", creator_id)
     conn.commit()
     conn.close()
+    return code
 
 def get_trip(trip_id):
     conn = get_connection()
@@ -135,14 +413,10 @@ def get_trip(trip_id):
     member_ids = [m['user_id'] for m in members]
     
     # Получаем расходы
-    expenses_rows = conn.execute("SELECT * FROM expenses WHERE trip_id = ?", (trip_id,)).fetchall()
-    expenses = []
-    for row in expenses_rows:
-        exp = dict(row)
-        exp['split'] = json.loads(row['split_json']) # Декодируем JSON обратно в словарь
-        exp['ts'] = row['created_at'] # Для совместимости с логикой бота
-        del exp['split_json']
-        expenses.append(exp)
+    expenses_rows = conn.execute(
+        "SELECT * FROM expenses WHERE trip_id = ? AND deleted_at IS NULL", (trip_id,)).fetchall()
+    # Колоночное хранение (src/tripstore.py); читается как список dict'ов со split и ts
+    expenses = tripstore.expenses_from_rows(expenses_rows, trip_id)
         
     # Получаем заметки
     notes_rows = conn.execute("SELECT * FROM notes WHERE trip_id = ?", (trip_id,)).fetchall()
@@ -170,29 +444,101 @@ def add_member_to_trip(trip_id, user_id):
     conn = get_connection()
     try:
         conn.execute("INSERT INTO trip_members (trip_id, user_id) VALUES (?, ?)", (trip_id, str(user_id)))
+        record_change(conn, trip_id, "member", user_id)
         conn.commit()
     except sqlite3.IntegrityError:
         pass # Уже участник
     conn.close()
 
-def get_user_trips(user_id):
+def get_user_trips(user_id, archived=False):
+    """Текущие поездки пользователя; archived=True — только архивные"""
     conn = get_connection()
     rows = conn.execute(
-        "SELECT t.id, t.name FROM trips t JOIN trip_members tm ON t.id = tm.trip_id WHERE tm.user_id = ?",
+        "SELECT t.id, t.name FROM trips t JOIN trip_members tm ON t.id = tm.trip_id "
+        f"WHERE tm.user_id = ? AND t.archived_at IS {'NOT ' if archived else ''}NULL",
         (str(user_id),)
     ).fetchall()
     conn.close()
     return [dict(row) for row in rows]
 
+# Поездки семьи пользователя: его мастера и всех, кто к нему привязан
+_FAMILY_TRIPS = (
+    "SELECT trip_id FROM trip_members WHERE user_id = :master "
+    "OR user_id IN (SELECT id FROM users WHERE linked_to = :master)"
+)
+
+def get_user_ledger(user_id):
+    """
+    Все, что нужно для сводки пользователя по поездкам (logic.user_summary), за пять
+    запросов независимо от числа поездок и трат: поездки семьи, их участники, строки
+    trip_balances и пользователи (имена, привязки). Возвращает (master_id, trips, link_map, names).
+    """
+    conn = get_connection()
+    try:
+        row = conn.execute("SELECT linked_to FROM users WHERE id = ?", (str(user_id),)).fetchone()
+        master = (row['linked_to'] if row else None) or str(user_id)
+        params = {"master": master}
+        trips = {r['id']: dict(r, members=[], balances={}) for r in conn.execute(
+            f"SELECT id, name, currency, rate FROM trips WHERE id IN ({_FAMILY_TRIPS}) ORDER BY created_at DESC",
+            params)}
+        for r in conn.execute(f"SELECT trip_id, user_id FROM trip_members WHERE trip_id IN ({_FAMILY_TRIPS})", params):
+            trips[r['trip_id']]['members'].append(r['user_id'])
+        for r in conn.execute(
+                f"SELECT trip_id, user_id, paid, owed FROM trip_balances WHERE trip_id IN ({_FAMILY_TRIPS})", params):
+            trips[r['trip_id']]['balances'][r['user_id']] = (r['paid'], r['owed'])
+        users = conn.execute(f"""
+            SELECT id, name, linked_to FROM users
+            WHERE id IN (SELECT user_id FROM trip_members WHERE trip_id IN ({_FAMILY_TRIPS}))
+               OR id IN (SELECT user_id FROM trip_balances WHERE trip_id IN ({_FAMILY_TRIPS}))
+               OR id = :master
+        """, params).fetchall()
+    finally:
+        conn.close()
+    link_map = {u['id']: u['linked_to'] for u in users if u['linked_to']}
+    names = {u['id']: u['name'] for u in users}
+    return master, list(trips.values()), link_map, names
+
+def get_trip_archive(trip_id):
+    conn = get_connection()
+    row = conn.execute("SELECT * FROM trip_archive WHERE trip_id = ?", (trip_id,)).fetchone()
+    conn.close()
+    if not row:
+        return None
+    info = dict(row)
+    info['balances'] = json.loads(info.pop('balances_json') or "{}")
+    return info
+
 def update_trip_rate(trip_id, rate):
     conn = get_connection()
     conn.execute("UPDATE trips SET rate = ? WHERE id = ?", (rate, trip_id))
+    # /setrate — это курс валюты поездки к рублю на сегодня: пригодится и для трат в рублях
+    curr = get_trip_currency(conn, trip_id)
+    if rate and rate > 0 and curr and curr != "RUB" and fx.CURRENCY_CODE.match(curr):
+        fx.set_rates(conn, [(fx.day_of(time.time()), curr, "RUB", rate)], source="setrate")
+    record_change(conn, trip_id, "trip", trip_id)
+    conn.commit()
+    conn.close()
+
+def set_fx_rate(day, base, quote, rate, source="manual"):
+    conn = get_connection()
+    fx.set_rates(conn, [(day, base, quote, rate)], source=source)
     conn.commit()
     conn.close()
+
+def get_fx_rate(base, quote, day):
+    """Курс base -> quote на день (None, если в fx_rates нет ни прямого, ни кросс-курса)"""
+    conn = get_connection()
+    try:
+        return fx.find_rate(conn, base, quote, day)
+    except fx.RateMissing:
+        return None
+    finally:
+        conn.close()
     
 def update_trip_currency(trip_id, currency):
     conn = get_connection()
     conn.execute("UPDATE trips SET currency = ? WHERE id = ?", (currency, trip_id))
+    record_change(conn, trip_id, "trip", trip_id)
     conn.commit()
     conn.close()
 
@@ -210,46 +556,299 @@ def get_all_trips_as_dict():
 
 # --- Expenses ---
 
-def add_expense(trip_id, payer_id, amount, desc, category, split_map):
+_INSERT_EXPENSE_SQL = (
+    "INSERT INTO expenses (trip_id, payer_id, amount, description, category, split_json, created_at, "
+    "currency, original_amount, fx_rate) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+class TripArchived(Exception):
+    """Запись в поездку, которая лежит в архиве (src/archive.py)"""
+
+def ensure_open(conn, trip_id):
+    row = conn.execute("SELECT archived_at FROM trips WHERE id = ?", (trip_id,)).fetchone()
+    if row and row['archived_at']:
+        raise TripArchived(trip_id)
+
+def get_trip_currency(conn, trip_id):
+    row = conn.execute("SELECT currency FROM trips WHERE id = ?", (trip_id,)).fetchone()
+    return row['currency'] if row else None
+
+def trip_converter(conn, trip_id):
+    """fx.Converter в валюту поездки (для пачки трат курсы берутся из базы один раз)"""
+    return fx.Converter(conn, get_trip_currency(conn, trip_id))
+
+def add_expense(trip_id, payer_id, amount, desc, category, split_map, currency=None):
+    """
+    amount и split_map — в currency (None — в валюте поездки); в базу они пишутся уже в
+    валюте поездки. Возвращает (amount, split_map) после пересчета. Без курса — fx.RateMissing.
+    """
+    exp = create_expense(trip_id, payer_id, amount, desc, category, split_map, currency)
+    return exp['amount'], exp['split']
+
+def create_expense(trip_id, payer_id, amount, desc, category, split_map, currency=None):
+    """Как add_expense, но возвращает всю новую трату (dict с id и created_at) — для API."""
     conn = get_connection()
+    try:
+        ensure_open(conn, trip_id)
+        created_at = int(time.time())
+        exp = trip_converter(conn, trip_id).convert(amount, split_map, currency, created_at)
+        cur = conn.execute(_INSERT_EXPENSE_SQL, (
+            trip_id, str(payer_id), exp['amount'], desc, category, encode_split(exp['split']),
+            created_at, exp['currency'], exp['original_amount'], exp['fx_rate']))
+        rollup_expense(conn, trip_id, payer_id, exp['amount'], category, exp['split'], created_at)
+        record_change(conn, trip_id, "expense", cur.lastrowid)
+        conn.commit()
+    finally:
+        conn.close()
+    return dict(exp, id=cur.lastrowid, trip_id=trip_id, payer_id=str(payer_id), description=desc,
+                category=category, created_at=created_at)
+
+IMPORT_CHUNK_SIZE = 500
+
+def import_expenses(trip_id, expenses, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Массовая вставка уже проверенных трат (dict с payer_id, amount, description, category,
+    split, created_at; amount и split в валюте поездки, currency / original_amount / fx_rate
+    — если платили в другой). Пачка = одна транзакция: executemany по тратам, журнал изменений
+    и роллапы одним проходом. Генератор: отдает id трат каждой закоммиченной пачки.
+    """
+    conn = get_connection()
+    try:
+        ensure_open(conn, trip_id)
+        for i in range(0, len(expenses), chunk_size):
+            chunk = expenses[i:i + chunk_size]
+            # IMMEDIATE: берем блокировку на запись сразу, чтобы id пачки шли подряд
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    _INSERT_EXPENSE_SQL,
+                    [(trip_id, str(e['payer_id']), e['amount'], e['description'], e['category'],
+                      encode_split(e['split']), e['created_at'],
+                      e.get('currency'), e.get('original_amount'), e.get('fx_rate')) for e in chunk]
+                )
+                # executemany не обновляет lastrowid; последний выданный id — в sqlite_sequence
+                last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'expenses'").fetchone()[0]
+                ids = list(range(last_id - len(chunk) + 1, last_id + 1))
+                record_changes(conn, trip_id, "expense", ids)
+                rollup_expenses(conn, ((trip_id, e['payer_id'], e['amount'], e['category'], e['split'], e['created_at'])
+                                       for e in chunk))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            yield ids
+    finally:
+        conn.close()
+
+# --- Expense Edits ---
+# Правка и удаление не пересчитывают поездку: старая версия траты вычитается из роллапов
+# и trip_balances (sign=-1), новая прибавляется — всё в одной транзакции с UPDATE, записью
+# в expense_audit и trip_changes (удаление уходит в синк как tombstone, op="delete").
+# Удаленная трата остается в таблице с deleted_at и не читается ни одним запросом.
+
+EXPENSE_FIELDS = ("payer_id", "amount", "description", "category", "split")
+
+def _live_expense(conn, expense_id):
+    row = conn.execute(
+        "SELECT id, trip_id, payer_id, amount, description, category, split_json, created_at, "
+        "currency, original_amount, fx_rate FROM expenses WHERE id = ? AND deleted_at IS NULL",
+        (expense_id,)
+    ).fetchone()
+    if not row:
+        return None
+    exp = dict(row)
+    exp['split'] = _decode_split(exp.pop('split_json'))
+    return exp
+
+def _audit(conn, op, before, after, user_id, now):
+    def snapshot(exp):
+        if exp is None:
+            return None
+        return json.dumps({k: exp[k] for k in EXPENSE_FIELDS + ("original_amount",)}, separators=(",", ":"))
     conn.execute(
-        "INSERT INTO expenses (trip_id, payer_id, amount, description, category, split_json, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
-        (trip_id, str(payer_id), amount, desc, category, json.dumps(split_map), int(time.time()))
+        "INSERT INTO expense_audit (expense_id, trip_id, op, user_id, before_json, after_json, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (before['id'], before['trip_id'], op, str(user_id) if user_id is not None else None,
+         snapshot(before), snapshot(after), now)
     )
-    conn.commit()
+
+def _unroll(conn, exp, sign):
+    rollup_expense(conn, exp['trip_id'], exp['payer_id'], exp['amount'], exp['category'],
+                   exp['split'], exp['created_at'], sign)
+
+def get_expense(expense_id):
+    conn = get_connection()
+    try:
+        return _live_expense(conn, expense_id)
+    finally:
+        conn.close()
+
+def _check_edit(conn, old, new, changes):
+    """
+    Правка идет прямо в trip_balances и роллапы, поэтому проверяется как импорт: платит
+    участник поездки, доли — участникам (или мастерам их семей) и в сумме дают amount,
+    категория из logic.CATEGORIES. Иначе ValueError.
+    """
+    trip_id = old['trip_id']
+    if 'category' in changes and new['category'] not in logic.CATEGORIES:
+        raise ValueError(f"unknown category {new['category']!r}")
+    if 'payer_id' not in changes and 'split' not in changes:
+        return
+    rows = conn.execute(
+        "SELECT tm.user_id, u.linked_to FROM trip_members tm LEFT JOIN users u ON u.id = tm.user_id "
+        "WHERE tm.trip_id = ?", (trip_id,)).fetchall()
+    members = {r['user_id'] for r in rows}
+    if 'payer_id' in changes and new['payer_id'] not in members:
+        raise ValueError(f"{new['payer_id']} is not a member of this trip")
+    if 'split' in changes:
+        allowed = members | {r['linked_to'] for r in rows if r['linked_to']}
+        strangers = [uid for uid in new['split'] if uid not in allowed]
+        if strangers:
+            raise ValueError(f"{strangers[0]} is not a member of this trip")
+        rate = old['fx_rate'] or 1.0
+        total = sum(new['split'].values())
+        if abs(total - new['amount']) > logic.SPLIT_TOLERANCE * rate:
+            raise ValueError(f"split adds up to {total / rate:.2f}, not {new['amount'] / rate:.2f}")
+
+def update_expense(expense_id, changes, user_id=None):
+    """
+    changes: любые из EXPENSE_FIELDS. amount и split — в валюте, в которой трату вводили
+    (для трат в другой валюте пересчитываются по ее же fx_rate). Если меняется только
+    amount, доли масштабируются пропорционально. Возвращает трату после правки или None,
+    если ее нет (или она удалена); правка, которая не сходится (_check_edit), — ValueError.
+    """
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        old = _live_expense(conn, expense_id)
+        if old is None:
+            conn.rollback()
+            return None
+        new = dict(old)
+        rate = old['fx_rate'] or 1.0
+        if 'amount' in changes:
+            amount = float(changes['amount'])
+            if old['currency']:
+                new['original_amount'] = amount
+            new['amount'] = amount * rate
+        if 'split' in changes:
+            new['split'] = {str(uid): float(share) * rate for uid, share in changes['split'].items()}
+        elif new['amount'] != old['amount'] and old['amount']:
+            scale = new['amount'] / old['amount']
+            new['split'] = {uid: share * scale for uid, share in old['split'].items()}
+        for field in ("payer_id", "description", "category"):
+            if field in changes:
+                new[field] = str(changes[field])
+        if new == old:
+            conn.rollback()
+            return old
+        _check_edit(conn, old, new, changes)
+        now = int(time.time())
+        conn.execute(
+            "UPDATE expenses SET payer_id = ?, amount = ?, description = ?, category = ?, split_json = ?, "
+            "original_amount = ?, updated_at = ? WHERE id = ?",
+            (new['payer_id'], new['amount'], new['description'], new['category'],
+             encode_split(new['split']), new['original_amount'], now, expense_id)
+        )
+        _unroll(conn, old, -1)
+        _unroll(conn, new, 1)
+        _audit(conn, "edit", old, new, user_id, now)
+        record_change(conn, old['trip_id'], "expense", expense_id)
+        conn.commit()
+        return new
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def delete_expense(expense_id, user_id=None):
+    """Мягкое удаление; возвращает удаленную трату или None, если удалять нечего"""
+    conn = get_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        old = _live_expense(conn, expense_id)
+        if old is None:
+            conn.rollback()
+            return None
+        now = int(time.time())
+        conn.execute("UPDATE expenses SET deleted_at = ? WHERE id = ?", (now, expense_id))
+        _unroll(conn, old, -1)
+        _audit(conn, "delete", old, None, user_id, now)
+        record_change(conn, old['trip_id'], "expense", expense_id, op="delete")
+        conn.commit()
+        return old
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def get_expense_history(expense_id):
+    conn = get_connection()
+    rows = conn.execute(
+        "SELECT op, user_id, before_json, after_json, created_at FROM expense_audit WHERE expense_id = ? ORDER BY id",
+        (expense_id,)
+    ).fetchall()
     conn.close()
+    return [{"op": r['op'], "user_id": r['user_id'], "created_at": r['created_at'],
+             "before": json.loads(r['before_json']) if r['before_json'] else None,
+             "after": json.loads(r['after_json']) if r['after_json'] else None} for r in rows]
 
 # --- Notes ---
 
 def add_note(trip_id, author_name, text):
     conn = get_connection()
-    conn.execute(
-        "INSERT INTO notes (trip_id, author_name, text, created_at) VALUES (?, ?, ?, ?)",
-        (trip_id, author_name, text, int(time.time()))
+    try:
+        ensure_open(conn, trip_id)
+        cur = conn.execute(
+            "INSERT INTO notes (trip_id, author_name, text, created_at) VALUES (?, ?, ?, ?)",
+            (trip_id, author_name, text, int(time.time()))
+        )
+        record_change(conn, trip_id, "note", cur.lastrowid)
+        conn.commit()
+    finally:
+        conn.close()
+
+# --- Drafts ---
+
+_SAVE_DRAFT_SQL = "INSERT OR REPLACE INTO drafts (id, user_id, trip_id, amount, description, category, selected_users_json, created_at, currency) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+def _draft_row(draft_id, data, now):
+    # data - это словарь. Разложим его по колонкам; created_at - время последней правки (по нему TTL)
+    return (
+        draft_id,
+        data.get('payer'),
+        data.get('trip_id'),
+        data.get('amount'),
+        data.get('desc'),
+        data.get('category'),
+        json.dumps(data.get('selected', {})),
+        now,
+        data.get('currency')
     )
+
+def save_draft(draft_id, data):
+    conn = get_connection()
+    conn.execute(_SAVE_DRAFT_SQL, _draft_row(draft_id, data, int(time.time())))
     conn.commit()
     conn.close()
 
-# --- Drafts ---
+def save_drafts(items):
+    """Пачка черновиков [(draft_id, data)] одной транзакцией (write-behind из src/drafts.py)"""
+    now = int(time.time())
+    conn = get_connection()
+    conn.executemany(_SAVE_DRAFT_SQL, [_draft_row(draft_id, data, now) for draft_id, data in items])
+    conn.commit()
+    conn.close()
 
-def save_draft(draft_id, data):
+def delete_drafts_before(ts):
+    """Удаляет черновики, которые не менялись с ts; возвращает их число"""
     conn = get_connection()
-    # data - это словарь. Разложим его по колонкам
-    conn.execute(
-        "INSERT OR REPLACE INTO drafts (id, user_id, trip_id, amount, description, category, selected_users_json, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        (
-            draft_id, 
-            data.get('payer'), 
-            data.get('trip_id'), 
-            data.get('amount'), 
-            data.get('desc'), 
-            data.get('category'), 
-            json.dumps(data.get('selected', {})), 
-            int(time.time())
-        )
-    )
+    removed = conn.execute("DELETE FROM drafts WHERE created_at < ?", (ts,)).rowcount
     conn.commit()
     conn.close()
+    return removed
 
 def get_draft(draft_id):
     conn = get_connection()
@@ -266,7 +865,8 @@ def get_draft(draft_id):
         "amount": d['amount'],
         "desc": d['description'],
         "category": d['category'],
-        "selected": json.loads(d['selected_users_json']) if d['selected_users_json'] else {}
+        "selected": json.loads(d['selected_users_json']) if d['selected_users_json'] else {},
+        "currency": d.get('currency')
     }
 
 def delete_draft(draft_id):
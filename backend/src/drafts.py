@@ -0,0 +1,150 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import db, metrics
+
+# --- Draft Store ---
+# Черновик траты живёт от текста "500 обед" до CONFIRM/CANCEL: между ними каждый тап
+# категории или TOGGLE раньше читал и переписывал строку drafts с JSON, а брошенные
+# черновики не удалялись никогда. Теперь активные черновики лежат в памяти (LRU на
+# DRAFT_CACHE_SIZE штук): новый пишется в базу сразу (его может подхватить другой
+# процесс или бот после рестарта), а правки — пачкой раз в DRAFT_FLUSH_S секунд из
+# фонового потока. Он же удаляет черновики, которых не трогали DRAFT_TTL_S секунд.
+
+CACHE_SIZE = int(os.getenv("DRAFT_CACHE_SIZE", "1000"))
+TTL_S = int(os.getenv("DRAFT_TTL_S", str(24 * 3600)))
+FLUSH_S = float(os.getenv("DRAFT_FLUSH_S", "5"))
+SWEEP_S = float(os.getenv("DRAFT_SWEEP_S", "300"))
+
+logger = logging.getLogger(__name__)
+
+DRAFT_OPS = metrics.counter(
+    "splitopus_draft_ops_total", "Draft store operations (get hit/miss, save, flush, expire)", ["op"])
+DRAFTS_ACTIVE = metrics.gauge("splitopus_drafts_active", "Drafts held in memory")
+
+
+def _copy(draft):
+    # Handlers mutate draft['selected'] before saving it back; they work on a copy so the
+    # flusher never serializes a dict that is changing under it
+    return dict(draft, selected=dict(draft.get('selected') or {}))
+
+
+class DraftStore:
+    """Bounded in-memory drafts with write-behind to the drafts table and TTL expiry."""
+
+    def __init__(self, cache_size=CACHE_SIZE, ttl=TTL_S, flush_interval=FLUSH_S, sweep_interval=SWEEP_S):
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self._drafts = OrderedDict()  # draft_id -> (draft, touched_at)
+        self._dirty = set()
+        self._lock = threading.Lock()
+        # Held while pending edits are written, so a delete cannot be undone by a flush
+        self._write_lock = threading.Lock()
+        self._thread = None
+        DRAFTS_ACTIVE.set_function(lambda: len(self._drafts))
+
+    def get(self, draft_id):
+        with self._lock:
+            entry = self._drafts.get(draft_id)
+            if entry is not None:
+                self._drafts.move_to_end(draft_id)
+                draft, touched = entry
+                if time.time() - touched <= self.ttl:
+                    DRAFT_OPS.inc(op="hit")
+                    return _copy(draft)
+        DRAFT_OPS.inc(op="miss")
+        with self._write_lock:
+            # An evicted draft may still be on its way to SQLite
+            draft = db.get_draft(draft_id)
+        if draft is not None and self.cache_size:
+            self._remember(draft_id, draft, dirty=False)
+        return draft
+
+    def save(self, draft_id, draft):
+        DRAFT_OPS.inc(op="save")
+        if not self.cache_size:
+            db.save_draft(draft_id, draft)
+            return
+        with self._lock:
+            new = draft_id not in self._drafts
+        if new:
+            # Write-through for a new draft, write-behind for its edits
+            db.save_draft(draft_id, draft)
+        self._remember(draft_id, _copy(draft), dirty=not new)
+        self._start()
+
+    def delete(self, draft_id):
+        with self._write_lock:
+            with self._lock:
+                self._drafts.pop(draft_id, None)
+                self._dirty.discard(draft_id)
+            db.delete_draft(draft_id)
+
+    def _remember(self, draft_id, draft, dirty):
+        evicted = []
+        with self._lock:
+            self._drafts[draft_id] = (draft, time.time())
+            self._drafts.move_to_end(draft_id)
+            if dirty:
+                self._dirty.add(draft_id)
+            while len(self._drafts) > self.cache_size:
+                old_id, (old, _) = self._drafts.popitem(last=False)
+                if old_id in self._dirty:
+                    self._dirty.discard(old_id)
+                    evicted.append((old_id, old))
+        if evicted:
+            db.save_drafts(evicted)
+
+    def flush(self):
+        """Writes pending edits to SQLite; returns how many."""
+        with self._write_lock:
+            with self._lock:
+                pending = [(i, self._drafts[i][0]) for i in self._dirty if i in self._drafts]
+                self._dirty.clear()
+            if pending:
+                db.save_drafts(pending)
+                DRAFT_OPS.inc(len(pending), op="flush")
+        return len(pending)
+
+    def sweep(self, now=None):
+        """Drops drafts untouched for longer than the TTL, in memory and in SQLite."""
+        cutoff = (time.time() if now is None else now) - self.ttl
+        with self._lock:
+            expired = [i for i, (_, touched) in self._drafts.items() if touched < cutoff]
+            for i in expired:
+                del self._drafts[i]
+                self._dirty.discard(i)
+        removed = db.delete_drafts_before(int(cutoff))
+        DRAFT_OPS.inc(max(removed, len(expired)), op="expire")
+        return removed
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="draft-store", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def _run(self):
+        last_sweep = 0.0
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.time() - last_sweep >= self.sweep_interval:
+                    last_sweep = time.time()
+                    removed = self.sweep()
+                    if removed:
+                        logger.info(f"Expired {removed} drafts older than {self.ttl}s")
+            except Exception as e:
+                logger.error(f"Draft store flush failed: {e}")
+
+
+store = DraftStore()
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+
+from . import db, metrics
+
+# --- Trip Change Push (SSE) ---
+# Один поллер на процесс читает хвост trip_changes и раздает события подписчикам.
+# Так приложение видит и траты из бота (другой процесс), и траты через API,
+# а клиентам больше не нужно опрашивать сервер самим.
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "1.0"))
+BUFFER_SIZE = int(os.getenv("EVENTS_BUFFER_SIZE", "64"))
+# Changes read per poll; a full page is followed by the next one without waiting
+POLL_LIMIT = 1000
+
+RESYNCS = metrics.counter("splitopus_sse_resyncs_total", "SSE buffers that overflowed and were replaced by a resync")
+
+
+class Subscription:
+    def __init__(self, trip_id, maxsize):
+        self.trip_id = trip_id
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def push(self, event):
+        """Never blocks the fan-out: a slow client gets its buffer replaced by a single resync."""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            RESYNCS.inc()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync", "v": event["v"]})
+
+
+class TripEventBroker:
+    def __init__(self, poll_interval=POLL_INTERVAL, buffer_size=BUFFER_SIZE):
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self._subs = {}  # trip_id -> set(Subscription)
+        self._last_seq = None
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+
+    def subscribe(self, trip_id):
+        sub = Subscription(trip_id, self.buffer_size)
+        self._subs.setdefault(trip_id, set()).add(sub)
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        return sub
+
+    def unsubscribe(self, sub):
+        subs = self._subs.get(sub.trip_id)
+        if subs:
+            subs.discard(sub)
+            if not subs:
+                del self._subs[sub.trip_id]
+
+    def subscriber_count(self):
+        return sum(len(s) for s in self._subs.values())
+
+    def buffered_events(self):
+        return sum(sub.queue.qsize() for subs in self._subs.values() for sub in subs)
+
+    def wake(self):
+        """Thread-safe: lets a write made in this process skip the poll interval."""
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def publish(self, trip_id, event):
+        for sub in list(self._subs.get(trip_id, ())):
+            sub.push(event)
+
+    async def _run(self):
+        if self._last_seq is None:
+            self._last_seq = await asyncio.to_thread(_max_seq)
+        while self._subs:
+            # Cleared before the query: a wake() from a commit that lands during it is kept
+            self._wakeup.clear()
+            rows = []
+            try:
+                rows = await asyncio.to_thread(_changes_after, self._last_seq, POLL_LIMIT)
+                for r in rows:
+                    self._last_seq = r['seq']
+                    if r['trip_id'] in self._subs:
+                        self.publish(r['trip_id'], {
+                            "type": "change",
+                            "v": r['seq'],
+                            "e": r['entity'],
+                            "id": r['entity_id'],
+                            "op": r['op']
+                        })
+            except Exception as e:
+                logger.error(f"Event poller error: {e}")
+            if len(rows) >= POLL_LIMIT:
+                continue  # a full page: more rows are waiting
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+        # Nobody listens anymore: the next poller starts from the then-current tail
+        self._last_seq = None
+
+
+def _max_seq():
+    conn = db.get_connection()
+    row = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM trip_changes").fetchone()
+    conn.close()
+    return row[0]
+
+def _changes_after(seq, limit=POLL_LIMIT):
+    conn = db.get_connection()
+    rows = conn.execute(
+        "SELECT seq, trip_id, entity, entity_id, op FROM trip_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+        (seq, limit)
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+broker = TripEventBroker()
+
+metrics.gauge("splitopus_sse_subscribers", "Open SSE connections", function=broker.subscriber_count)
+metrics.gauge("splitopus_sse_queued_events", "Events buffered for SSE clients, not yet sent",
+              function=broker.buffered_events)
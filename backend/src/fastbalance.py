@@ -0,0 +1,228 @@
+import os
+import threading
+from collections import OrderedDict
+from itertools import chain
+
+from . import tripstore
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, logic.py keeps the pure-Python path
+    np = None
+
+# --- Vectorized Balances ---
+# Для больших поездок (тысячи трат, 100+ участников) трата раскладывается в колонки:
+# индекс плательщика, сумма, код категории и CSR-массивы сплитов. Балансы считаются
+# через np.add.at, который складывает повторяющиеся индексы по порядку — тем же
+# порядком, что и цикл в logic.py, поэтому результат совпадает до бита.
+
+# Building the columns costs about as much as one pass of the Python loop; the win
+# comes from reusing them. They are cached per (trip id, version), so every update
+# after the first one on an unchanged trip skips straight to the array math.
+
+# logic.py switches to this engine from this many expenses (see benchmarks/logic.py)
+MIN_EXPENSES = int(os.getenv("FASTBALANCE_MIN_EXPENSES", "1000"))
+CACHE_SIZE = int(os.getenv("FASTBALANCE_CACHE_SIZE", "16"))
+ENABLED = np is not None and os.getenv("FASTBALANCE", "1") != "0"
+
+
+def should_use(trip, link_map=None, cold_ok=True):
+    """
+    cold_ok=False: only when the columns are already cached. get_my_stats does so little
+    per expense in Python that it is only worth it on columns built for calculate_balance.
+    """
+    if not ENABLED or not trip or len(trip['expenses']) < MIN_EXPENSES:
+        return False
+    return cold_ok or _cached(trip, link_map or {}) is not None
+
+
+class Columns:
+    """A trip's expenses as arrays; rows keep the order of trip['expenses']."""
+
+    def __init__(self, trip, link_map):
+        members = trip['members']
+        # Same construction as logic.calculate_balance, so the result dict has the same key order
+        self.masters = list(set(link_map.get(str(uid), str(uid)) for uid in members))
+        index = {m: i for i, m in enumerate(self.masters)}
+        expenses = trip['expenses']
+        n = len(expenses)
+        self.n = n
+
+        if isinstance(expenses, tripstore.ExpenseList):
+            # Already columns: amounts and shares are read straight from the arrays
+            payers = expenses.payers
+            self.amount = np.frombuffer(expenses.amounts, np.float64)
+            self.categories = expenses.categories
+            split_keys = expenses.split_keys
+            counts = np.diff(np.frombuffer(expenses.split_offsets, np.int64))
+            keys = list(chain.from_iterable(split_keys))
+            self.share = np.frombuffer(expenses.split_values, np.float64)
+        else:
+            payers = [e['payer_id'] for e in expenses]
+            self.amount = np.fromiter((float(e['amount']) for e in expenses), np.float64, n)
+            self.categories = [e.get('category', 'OTHER') for e in expenses]
+            splits = [e.get('split') or {} for e in expenses]
+            counts = np.fromiter(map(len, splits), np.int64, n)
+            keys = list(chain.from_iterable(splits))
+            self.share = np.fromiter(chain.from_iterable(s.values() for s in splits), np.float64, len(keys))
+
+        self.payer_master = [link_map.get(str(p), str(p)) for p in payers]
+        self.payer = np.fromiter((index.get(m, -1) for m in self.payer_master), np.int64, n)
+        self.category_names = list(dict.fromkeys(self.categories))
+        codes = {c: i for i, c in enumerate(self.category_names)}
+        self.category = np.fromiter(map(codes.__getitem__, self.categories), np.int64, n)
+        self.repayment = self.category == codes.get("REPAYMENT", -1)
+
+        # CSR: split entries of row i are entries[offsets[i]:offsets[i + 1]], in dict order
+        self.offsets = np.zeros(n + 1, np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        size = int(self.offsets[-1])
+        self.row = np.repeat(np.arange(n, dtype=np.int64), counts)
+        # Split keys are few distinct ids (nearly always masters or members): map them
+        # once, then per entry through an int code
+        self.keys = list(dict.fromkeys(chain(self.masters, map(str, members))))
+        key_codes = {k: i for i, k in enumerate(self.keys)}
+        codes = list(map(key_codes.get, keys))
+        if None in codes:
+            self.keys = list(dict.fromkeys(chain(self.keys, keys)))
+            key_codes = {k: i for i, k in enumerate(self.keys)}
+            codes = list(map(key_codes.__getitem__, keys))
+        self.key = np.array(codes, np.int64) if size else np.zeros(0, np.int64)
+        self.key_master = [link_map.get(str(k), str(k)) for k in self.keys]
+        consumer_of_key = np.fromiter((index.get(m, -1) for m in self.key_master), np.int64, len(self.keys))
+        self.consumer = consumer_of_key[self.key] if size else np.zeros(0, np.int64)
+
+        # One stream of balance updates in loop order: payer credit, then that row's debits
+        ops = n + size
+        self.op_index = np.empty(ops, np.int64)
+        self.op_value = np.empty(ops, np.float64)
+        payer_pos = self.offsets[:-1] + np.arange(n, dtype=np.int64)
+        entry_pos = np.arange(size, dtype=np.int64) + self.row + 1
+        self.op_index[payer_pos] = self.payer
+        self.op_value[payer_pos] = self.amount
+        self.op_index[entry_pos] = self.consumer
+        self.op_value[entry_pos] = -self.share
+        keep = self.op_index >= 0
+        self.op_index = self.op_index[keep]
+        self.op_value = self.op_value[keep]
+
+
+# (trip id, version) -> (expense count, link_map copy, Columns). Trips without an id or
+# version (hand-built dicts) are keyed by the dict object itself.
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_key(trip):
+    if trip.get('id') is not None and trip.get('version') is not None:
+        return (trip['id'], trip['version'])
+    return ("object", id(trip))
+
+
+def _cached(trip, link_map):
+    key = _cache_key(trip)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        # Guards against a snapshot racing a write under the same version, and id() reuse
+        if entry[0] != len(trip['expenses']) or entry[1] != link_map or (key[0] == "object" and entry[3] is not trip):
+            return None
+        _cache.move_to_end(key)
+        return entry[2]
+
+
+def columns(trip, link_map):
+    """Columns for trip, built once per trip version."""
+    cols = _cached(trip, link_map)
+    if cols is not None:
+        return cols
+    cols = Columns(trip, link_map)
+    key = _cache_key(trip)
+    with _cache_lock:
+        # Object-keyed entries hold the trip so its id() is not reused while cached
+        _cache[key] = (len(trip['expenses']), dict(link_map), cols, trip if key[0] == "object" else None)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return cols
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def _running_total(values):
+    """Left-to-right float sum starting from 0.0, like `total += x` (np.sum is pairwise)."""
+    if not len(values):
+        return 0.0
+    return float(np.cumsum(values)[-1])
+
+
+def calculate_balance(trip, link_map=None):
+    """Same contract and result as logic.calculate_balance."""
+    if not trip: return {}, 0, {}
+    if link_map is None: link_map = {}
+    cols = columns(trip, link_map)
+    k = len(cols.masters)
+
+    balances = np.zeros(k, np.float64)
+    np.add.at(balances, cols.op_index, cols.op_value)
+
+    paid = np.zeros(k, np.float64)
+    has_payer = cols.payer >= 0
+    np.add.at(paid, cols.payer[has_payer], cols.amount[has_payer])
+
+    total_spent = _running_total(cols.amount[~cols.repayment])
+    return ({m: float(balances[i]) for i, m in enumerate(cols.masters)}, total_spent,
+            {m: float(paid[i]) for i, m in enumerate(cols.masters)})
+
+
+def get_my_stats(trip, my_uid, link_map=None):
+    """Same contract and result as logic.get_my_stats."""
+    if not trip: return {}
+    if link_map is None: link_map = {}
+    cols = columns(trip, link_map)
+    my_master = link_map.get(str(my_uid), str(my_uid))
+
+    stats = {
+        "total_share": 0.0,
+        "cats": {},
+        "my_repayments": [],
+        "received_repayments": []
+    }
+
+    # Repayments are rare: walk them in Python, in order
+    expenses = trip['expenses']
+    for i in np.flatnonzero(cols.repayment).tolist():
+        exp = expenses[i]
+        target_master = link_map.get(str(list(exp['split'].keys())[0]), str(list(exp['split'].keys())[0]))
+        payer_master = cols.payer_master[i]
+        if payer_master == my_master:
+            stats["my_repayments"].append({"to": target_master, "amount": float(cols.amount[i]), "ts": exp['ts']})
+        elif target_master == my_master:
+            stats["received_repayments"].append({"from": payer_master, "amount": float(cols.amount[i]), "ts": exp['ts']})
+
+    # my_share = split.get(my_master) or, if that is 0, the sum of my linked ids' shares
+    direct_key = np.array([k == my_master for k in cols.keys], bool)[cols.key]
+    mine_key = np.array([m == my_master for m in cols.key_master], bool)[cols.key]
+    direct = np.zeros(cols.n, np.float64)
+    direct[cols.row[direct_key]] = cols.share[direct_key]
+    fallback = np.zeros(cols.n, np.float64)
+    np.add.at(fallback, cols.row[mine_key], cols.share[mine_key])
+    my_share = np.where(direct != 0, direct, fallback)
+
+    counted = ~cols.repayment & (my_share > 0)
+    shares = my_share[counted]
+    stats["total_share"] = _running_total(shares)
+
+    codes = cols.category[counted]
+    if len(codes):
+        totals = np.zeros(len(cols.category_names), np.float64)
+        np.add.at(totals, codes, shares)
+        # Categories in order of first appearance, as the dict fills in the loop
+        present, first = np.unique(codes, return_index=True)
+        for code in present[np.argsort(first)].tolist():
+            stats["cats"][cols.category_names[code]] = float(totals[code])
+    return stats
@@ -0,0 +1,191 @@
+import argparse
+import csv
+import io
+import json
+import re
+import sys
+import time
+from datetime import date
+
+# --- FX Rates ---
+# Курсы валют по дням в таблице fx_rates: 1 base = rate quote. Заполняется из файлов
+# (python -m src.fx load rates.csv), вручную (/fx в боте, python -m src.fx set) и из
+# /setrate. Трата в чужой валюте пересчитывается в валюту поездки один раз, при вставке:
+# amount и split_json хранятся уже пересчитанными, а исходные сумма, валюта и курс —
+# рядом (original_amount, currency, fx_rate). Балансы и статистика ничего не конвертируют.
+
+CURRENCY_CODE = re.compile(r"^[A-Z]{3}$")
+# Cross rates go through these when there is no direct or inverse pair
+PIVOTS = ("USD", "EUR", "RUB")
+
+
+class RateMissing(LookupError):
+    """No rate between the two currencies in fx_rates."""
+
+
+def day_of(ts):
+    """YYYY-MM-DD of a unix timestamp in server local time (same days as the stats rollups)."""
+    return time.strftime("%Y-%m-%d", time.localtime(ts))
+
+
+def currency_code(value):
+    """'usd ' -> 'USD'; None / '' -> None; anything but three letters is a ValueError."""
+    code = str(value or "").strip().upper()
+    if not code:
+        return None
+    if not CURRENCY_CODE.match(code):
+        raise ValueError(f"bad currency code {value!r}")
+    return code
+
+
+def set_rates(conn, rows, source="manual"):
+    """rows: (day, base, quote, rate). The caller commits."""
+    conn.executemany(
+        "INSERT INTO fx_rates (day, base, quote, rate, source) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(base, quote, day) DO UPDATE SET rate = excluded.rate, source = excluded.source",
+        [(d, b, q, float(r), source) for d, b, q, r in rows])
+
+
+def _pair(conn, base, quote, day):
+    """(day, rate) of base->quote closest to `day`: on or before it, else the first after it."""
+    for direction in ("<=", ">"):
+        order = "DESC" if direction == "<=" else "ASC"
+        row = conn.execute(f"""
+            SELECT day, rate FROM (
+                SELECT day, rate FROM fx_rates WHERE base = ? AND quote = ? AND day {direction} ?
+                UNION ALL
+                SELECT day, 1.0 / rate FROM fx_rates WHERE base = ? AND quote = ? AND day {direction} ? AND rate > 0
+            ) ORDER BY day {order} LIMIT 1
+        """, (base, quote, day, quote, base, day)).fetchone()
+        if row:
+            return row[0], row[1]
+    return None
+
+
+def find_rate(conn, base, quote, day):
+    """Units of `quote` for one `base` on `day`: direct, inverse or through a PIVOTS currency."""
+    if base == quote:
+        return 1.0
+    found = _pair(conn, base, quote, day)
+    if found:
+        return found[1]
+    for pivot in PIVOTS:
+        if pivot in (base, quote):
+            continue
+        first, second = _pair(conn, base, pivot, day), _pair(conn, pivot, quote, day)
+        if first and second:
+            return first[1] * second[1]
+    raise RateMissing(f"no {base}->{quote} rate for {day}")
+
+
+class Converter:
+    """Converts amounts into one trip currency; rates are memoized by (currency, day) for a batch."""
+
+    def __init__(self, conn, base):
+        self.conn = conn
+        self.base = base
+        self._rates = {}
+
+    def rate(self, currency, ts):
+        key = (currency, day_of(ts))
+        if key not in self._rates:
+            self._rates[key] = find_rate(self.conn, currency, self.base, key[1])
+        return self._rates[key]
+
+    def convert(self, amount, split, currency, ts):
+        """
+        {'amount', 'split', 'currency', 'original_amount', 'fx_rate'} with amount and split in
+        the trip currency. An expense already in it keeps currency/original_amount/fx_rate None.
+        """
+        if not currency or currency == self.base:
+            return {"amount": amount, "split": split, "currency": None, "original_amount": None, "fx_rate": None}
+        rate = self.rate(currency, ts)
+        return {
+            # Not rounded: the shares must keep adding up to the amount
+            "amount": amount * rate,
+            "split": {k: v * rate for k, v in split.items()},
+            "currency": currency,
+            "original_amount": amount,
+            "fx_rate": rate,
+        }
+
+
+# --- Rate Files ---
+
+def parse_rates(text):
+    """
+    Rate rows from a file: CSV with a date,base,quote,rate header (',' or ';'), or JSON:
+    a list of {"date", "base", "quote", "rate"} or {"date": {"USD/THB": 36.5, ...}}.
+    """
+    text = text.strip()
+    if text.startswith(("[", "{")):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            items = [{"date": d, "base": pair.split("/")[0], "quote": pair.split("/")[1], "rate": r}
+                     for d, pairs in data.items() for pair, r in pairs.items()]
+        else:
+            items = data
+    else:
+        delimiter = ";" if text.split("\n", 1)[0].count(";") > text.split("\n", 1)[0].count(",") else ","
+        items = list(csv.DictReader(io.StringIO(text), delimiter=delimiter))
+    rows = []
+    for n, item in enumerate(items, 1):
+        try:
+            day = date.fromisoformat(str(item["date"]).strip()).isoformat()
+            rate = float(str(item["rate"]).replace(",", "."))
+            if rate <= 0:
+                raise ValueError("rate must be positive")
+            rows.append((day, currency_code(item["base"]), currency_code(item["quote"]), rate))
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            raise ValueError(f"rate row {n}: {e}") from None
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the fx_rates table")
+    sub = parser.add_subparsers(dest="command", required=True)
+    load = sub.add_parser("load", help="load rates from CSV/JSON files")
+    load.add_argument("files", nargs="+")
+    load.add_argument("--source", default="file")
+    put = sub.add_parser("set", help="set one rate: DATE BASE QUOTE RATE (1 BASE = RATE QUOTE)")
+    put.add_argument("day")
+    put.add_argument("base")
+    put.add_argument("quote")
+    put.add_argument("rate", type=float)
+    show = sub.add_parser("show", help="rate of BASE in QUOTE on a day (default today)")
+    show.add_argument("base")
+    show.add_argument("quote")
+    show.add_argument("day", nargs="?")
+    args = parser.parse_args(argv)
+
+    from . import data  # creates / migrates the database
+    conn = data.db.get_connection()
+    try:
+        if args.command == "load":
+            total = 0
+            for path in args.files:
+                with open(path, encoding="utf-8-sig") as f:
+                    rows = parse_rates(f.read())
+                set_rates(conn, rows, args.source)
+                total += len(rows)
+                print(f"{path}: {len(rows)} rates")
+            conn.commit()
+            print(f"Loaded {total} rates")
+        elif args.command == "set":
+            set_rates(conn, [(date.fromisoformat(args.day).isoformat(), currency_code(args.base),
+                              currency_code(args.quote), args.rate)])
+            conn.commit()
+        else:
+            day = args.day or date.today().isoformat()
+            base, quote = currency_code(args.base), currency_code(args.quote)
+            print(f"1 {base} = {find_rate(conn, base, quote, day):.6g} {quote} ({day})")
+    except (ValueError, RateMissing) as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
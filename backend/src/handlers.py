@@ -5,7 +5,7 @@ import os
 from datetime import datetime
 
 # Import modules from src
-from src import data, logic
+from src import data, db, fx, ids, logic, parsing, querystats, metrics, render, tracing
 from src.telegram import TelegramClient
 
 # --- Configuration ---
@@ -35,6 +35,11 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- Tracing ---
+# Спаны на каждый вызов db.* и расчеты из logic внутри трейса апдейта
+tracing.instrument_module(db, exclude=("get_connection", "init_db"))
+tracing.instrument_module(logic, names=("calculate_balance", "get_my_stats", "simplify_debts"))
+
 # --- Initialize Client ---
 bot = TelegramClient(TOKEN)
 
@@ -48,6 +53,35 @@ def get_link_map():
     users = data.get_all_users_as_dict() 
     return {uid: u['linked_to'] for uid, u in users.items() if u.get('linked_to')}
 
+def split_members(member_ids):
+    """
+    Семьи поездки для меню разделения: [[id мастера, "Мастер + дети"], ...]. Считается один
+    раз, когда создаётся черновик, и хранится в нём: TOGGLE перерисовывает меню по черновику
+    """
+    ids = [str(m) for m in member_ids]
+    masters = []
+    for m in ids:
+        u = data.get_user(m)
+        master_id = u.get('linked_to') if u and u.get('linked_to') else m
+        if master_id not in masters:
+            masters.append(master_id)
+    return [[mid, data.get_linked_names(mid, filter_ids=ids)] for mid in masters]
+
+def can_archive(tid, uid_str):
+    """Архив — решение создателя поездки (у старых поездок без creator_id — любого участника)"""
+    creator = data.get_trip_creator(tid)
+    return creator is None or str(creator) == uid_str
+
+def get_trip_view(user_id):
+    """
+    (id активной поездки, мастер пользователя, версия поездки) по строкам users и trips,
+    без загрузки трат: этого хватает, чтобы найти экран в render.screens
+    """
+    u = data.get_user(str(user_id))
+    tid = u.get('active_trip_id') if u else None
+    if not tid: return None, None, None
+    return tid, u.get('linked_to') or str(user_id), data.get_trip_version(tid)
+
 def refresh_menu_msg(chat_id, user_id, text, reply_markup=None): # Добавил дефолт None
     old_msg_id = data.get_user_menu_id(user_id)
     if old_msg_id:
@@ -61,6 +95,11 @@ def refresh_menu_msg(chat_id, user_id, text, reply_markup=None): # Добави
         new_msg_id = resp['result']['message_id']
         data.set_user_menu_id(user_id, new_msg_id)
 
+def converted_note(draft, amount, trip):
+    """' (= 1 095 THB)' after an amount typed in another currency."""
+    if not draft.get('currency'): return ""
+    return f" {draft['currency']} (= {amount:,.0f} {trip.get('currency', 'THB')})".replace(",", " ")
+
 def notify_others(tid, payer_id, amount, desc, category, split_map):
     trip = data.get_trip(tid)
     if not trip: return
@@ -99,25 +138,37 @@ def notify_others(tid, payer_id, amount, desc, category, split_map):
 
 def send_trip_dashboard(chat_id, user_id, message_id=None):
     uid_str = str(user_id)
-    tid = data.get_active_trip_id(uid_str)
+    tid, master_id, version = get_trip_view(uid_str)
+    if not tid or version is None:
+        return handle_command(chat_id, user_id, "User", "/start")
+
+    msg, keyboard = render.screens.get_or_build(
+        "dashboard", tid, version, lambda: dashboard_screen(tid, uid_str, master_id), viewer=uid_str)
+
+    if message_id:
+        bot.edit_message(chat_id, message_id, msg, reply_markup=keyboard)
+    else:
+        refresh_menu_msg(chat_id, user_id, msg, reply_markup=keyboard)
+
+def dashboard_screen(tid, uid_str, master_id):
     trip = data.get_trip(tid)
-    
-    if not tid or not trip:
-        return handle_command(chat_id, user_id, "User", "/start") 
-        
     name = trip.get('name', 'Trip')
     code = trip.get('code')
-    
-    link_map = get_link_map()
-    master_id = logic.get_master(user_id, link_map)
-    is_linked = (master_id != uid_str)
-    
+
     role_info = ""
-    if is_linked:
+    if master_id != uid_str:
         master_user = data.get_user(master_id)
         master_name = master_user.get('name', 'Master') if master_user else 'Master'
         role_info = f"\n🔗 Вы привязаны к: *{master_name}*"
     
+    if trip.get('archived_at'):
+        msg = (
+            f"🗄 *Поездка: {name}* (в архиве)\n"
+            f"🔑 Код: `{code}`{role_info}\n\n"
+            "Траты и заметки доступны только для просмотра. Вернуть из архива: /unarchive\n\n"
+            "👇 *Инструменты:*"
+        )
+        return msg, render.DASHBOARD_KEYBOARD
     msg = (
         f"🌴 *Поездка: {name}*\n"
         f"🔑 Код: `{code}`{role_info}\n\n"
@@ -126,38 +177,17 @@ def send_trip_dashboard(chat_id, user_id, message_id=None):
         "Пример: `500 Обед` или `200 Такси`\n\n"
         "👇 *Инструменты:*"
     )
-    
-    keyboard = {
-        "inline_keyboard": [
-            [{"text": "📊 Баланс", "callback_data": "MENU_BALANCE"}, {"text": "👤 Моя статистика", "callback_data": "MENU_ME"}],
-            [{"text": "💸 Вернуть долг", "callback_data": "MENU_REPAY"}, {"text": "🎲 Рулетка", "callback_data": "MENU_ROULETTE"}],
-            [{"text": "📜 История трат", "callback_data": "MENU_ALL_EXPENSES"}],
-            [{"text": "📝 Заметки", "callback_data": "MENU_NOTES"}, {"text": "💾 Скачать отчет", "callback_data": "MENU_EXPORT"}],
-            [{"text": "🔙 Назад к списку", "callback_data": "MENU_TRIPS"}, {"text": "📖 Инструкция", "callback_data": "SHOW_HELP"}],
-        ]
-    }
-    
-    if message_id:
-        bot.edit_message(chat_id, message_id, msg, reply_markup=keyboard)
-    else:
-        refresh_menu_msg(chat_id, user_id, msg, reply_markup=keyboard)
+    return msg, render.DASHBOARD_KEYBOARD
 
 def send_category_menu(chat_id, draft_id, curr, message_id=None):
-    keyboard = []
-    row = []
-    for key, label in logic.CATEGORIES.items():
-        if key == "REPAYMENT": continue
-        row.append({"text": label, "callback_data": f"CAT|{draft_id}|{label}"})
-        if len(row) == 2: keyboard.append(row); row = []
-    if row: keyboard.append(row)
-    
     draft = data.get_draft(draft_id)
     if not draft: return
 
     amount = draft['amount']
     desc = draft['desc']
+    curr = draft.get('currency') or curr
     text = f"💸 *{amount} {curr}* ({desc})\n🏷 Выберите категорию:"
-    markup = {"inline_keyboard": keyboard}
+    markup = render.category_keyboard(draft_id)
     
     if message_id: 
         bot.edit_message(chat_id, message_id, text, reply_markup=markup)
@@ -167,9 +197,14 @@ def send_category_menu(chat_id, draft_id, curr, message_id=None):
 def send_split_menu(chat_id, draft_id, message_id=None):
     draft = data.get_draft(draft_id)
     if not draft: return
-    
-    trip = data.get_trip(draft['trip_id'])
-    curr = trip.get('currency', 'THB')
+
+    if 'members' not in draft:
+        # Черновик из базы, созданный до того, как семьи стали храниться в нём
+        trip = data.get_trip(draft['trip_id'])
+        draft['members'] = split_members(trip['members'])
+        draft['trip_currency'] = trip.get('currency', 'THB')
+        data.save_draft(draft_id, draft)
+    curr = draft.get('currency') or draft.get('trip_currency', 'THB')
     
     amount = draft['amount']
     desc = draft['desc']
@@ -179,16 +214,7 @@ def send_split_menu(chat_id, draft_id, message_id=None):
     keyboard = []
     row = []
     
-    members = trip['members']
-    masters = set()
-    for m in members:
-        # Получаем мастера для каждого участника
-        u = data.get_user(str(m))
-        master_id = u.get('linked_to') if u and u.get('linked_to') else str(m)
-        masters.add(master_id)
-        
-    for mid in masters:
-        display_name = data.get_linked_names(mid, filter_ids=[str(m) for m in members])
+    for mid, display_name in draft['members']:
         is_active = selected.get(mid, True)
         status = "✅" if is_active else "⬜️"
         keyboard.append([{"text": f"{status} {display_name}", "callback_data": f"TOGGLE|{draft_id}|{mid}"}])
@@ -198,7 +224,8 @@ def send_split_menu(chat_id, draft_id, message_id=None):
     
     keyboard.append([{"text": f"💾 Сохранить (по {share:.0f})", "callback_data": f"CONFIRM|{draft_id}"}])
     keyboard.append([{"text": "✏️ Ввести вручную", "callback_data": f"CUSTOM|{draft_id}"}])
-    keyboard.append([{"text": "❌ Отмена", "callback_data": f"CANCEL|{draft_id}"}])
+    keyboard.append([{"text": "🏷 Категория", "callback_data": f"RECAT|{draft_id}"},
+                     {"text": "❌ Отмена", "callback_data": f"CANCEL|{draft_id}"}])
     
     text = f"💸 *{amount} {curr}* ({desc})\n🏷 {cat}\nКто участвует (семьями)?"
     markup = {"inline_keyboard": keyboard}
@@ -207,11 +234,17 @@ def send_split_menu(chat_id, draft_id, message_id=None):
     else: bot.send_message(chat_id, text, reply_markup=markup)
 
 def send_all_expenses_list(chat_id, user_id, message_id=None, page=0):
-    uid_str = str(user_id)
-    tid = data.get_active_trip_id(uid_str)
-    trip = data.get_trip(tid)
-    if not trip: return
+    tid, _, version = get_trip_view(user_id)
+    if not tid or version is None: return
+
+    msg, keyboard = render.screens.get_or_build(
+        "expenses", tid, version, lambda: expenses_screen(tid, page), page=page)
+
+    if message_id: bot.edit_message(chat_id, message_id, msg, reply_markup=keyboard)
+    else: bot.send_message(chat_id, msg, reply_markup=keyboard)
 
+def expenses_screen(tid, page):
+    trip = data.get_trip(tid)
     expenses = sorted(trip.get('expenses', []), key=lambda x: x['ts'], reverse=True)
     curr = trip.get('currency', 'THB')
     
@@ -223,19 +256,19 @@ def send_all_expenses_list(chat_id, user_id, message_id=None, page=0):
 
     PAGE_SIZE = 10
     total_pages = (len(expenses) + PAGE_SIZE - 1) // PAGE_SIZE
+    page = min(page, max(total_pages - 1, 0))  # the last one on a page may have been deleted
     start_idx = page * PAGE_SIZE
     end_idx = min(start_idx + PAGE_SIZE, len(expenses))
     
     if not expenses:
-        msg = "📝 В этой поездке пока нет трат."
-        keyboard = {"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]}
-        if message_id: bot.edit_message(chat_id, message_id, msg, reply_markup=keyboard)
-        else: bot.send_message(chat_id, msg, reply_markup=keyboard)
-        return
+        return "📝 В этой поездке пока нет трат.", render.BACK_TO_TRIP
 
     msg = f"🧾 *Все траты ({trip.get('name')}):*\n\n"
+    edit_buttons = []
     for i in range(start_idx, end_idx):
         exp = expenses[i]
+        n = i - start_idx + 1
+        edit_buttons.append({"text": f"✏️ {n}", "callback_data": f"EXP|{exp['id']}|{page}"})
         date = datetime.fromtimestamp(exp['ts']).strftime('%d.%m %H:%M')
         payer_name = names.get(str(exp['payer_id']), 'Unknown')
         amount = exp['amount']
@@ -243,24 +276,121 @@ def send_all_expenses_list(chat_id, user_id, message_id=None, page=0):
         category_label = logic.CATEGORIES.get(exp.get('category', 'OTHER'), exp.get('category', 'Другое'))
         
         if exp.get('category') != "REPAYMENT":
-             msg += (f"*{date}* ({category_label})\n"
+             msg += (f"*{n}.* *{date}* ({category_label})\n"
                      f"👤 {payer_name} потратил: *{amount:,.0f} {curr}*\n"
                      f"📝 {desc}\n\n")
         else:
             repay_to_id = list(exp['split'].keys())[0]
             repay_to_name = names.get(str(repay_to_id), 'Unknown')
-            msg += (f"*{date}* ({category_label})\n"
+            msg += (f"*{n}.* *{date}* ({category_label})\n"
                     f"💸 {payer_name} вернул {repay_to_name}: *{amount:,.0f} {curr}*\n\n")
 
-    keyboard_rows = []
+    # Edit/delete buttons, five per row, numbered like the list
+    keyboard_rows = [edit_buttons[i:i + 5] for i in range(0, len(edit_buttons), 5)]
     nav_row = []
     if page > 0: nav_row.append({"text": "◀️ Назад", "callback_data": f"ALL_EXPENSES_PAGE|{page-1}"})
     if page < total_pages - 1: nav_row.append({"text": "Вперед ▶️", "callback_data": f"ALL_EXPENSES_PAGE|{page+1}"})
     if nav_row: keyboard_rows.append(nav_row)
     keyboard_rows.append([{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}])
+    return msg, {"inline_keyboard": keyboard_rows}
+
+def expense_card(exp, page=0):
+    """One expense with edit / delete buttons (from the history screen)"""
+    trip = data.get_trip(exp['trip_id'])
+    curr = trip.get('currency', 'THB') if trip else ''
+    payer = data.get_user(str(exp['payer_id']))
+    date = datetime.fromtimestamp(exp['created_at']).strftime('%d.%m %H:%M')
+    amount = f"{exp['amount']:,.0f} {curr}".replace(",", " ")
+    if exp.get('currency'):
+        amount = f"{exp['original_amount']:g} {exp['currency']} (= {amount})"
+    text = (f"🧾 *{exp['description']}*\n"
+            f"📅 {date} · {logic.CATEGORIES.get(exp['category'], exp['category'])}\n"
+            f"👤 {payer.get('name', 'Unknown') if payer else 'Unknown'}: *{amount}*")
+    eid = exp['id']
+    markup = {"inline_keyboard": [
+        [{"text": "💰 Сумма", "callback_data": f"EXP_AMOUNT|{eid}|{page}"},
+         {"text": "📝 Описание", "callback_data": f"EXP_DESC|{eid}|{page}"}],
+        [{"text": "🏷 Категория", "callback_data": f"EXP_CAT|{eid}|{page}"},
+         {"text": "🗑 Удалить", "callback_data": f"EXP_DEL|{eid}|{page}"}],
+        [{"text": "🔙 К истории", "callback_data": f"ALL_EXPENSES_PAGE|{page}"}],
+    ]}
+    return text, markup
+
+def editable_expense(user_id, expense_id):
+    """(expense, None) if this user (or their family) paid it, else (None, why not)"""
+    exp = data.get_expense(int(expense_id))
+    if not exp: return None, "Трата не найдена: её уже удалили."
+    link_map = get_link_map()
+    if logic.get_master(str(exp['payer_id']), link_map) != logic.get_master(str(user_id), link_map):
+        return None, "Изменить трату может только тот, кто платил."
+    return exp, None
+
+def balance_screen(tid):
+    trip = data.get_trip(tid)
+    link_map = get_link_map()
+    balances, total_spent, total_paid = logic.calculate_balance(trip, link_map)
     
-    if message_id: bot.edit_message(chat_id, message_id, msg, reply_markup={"inline_keyboard": keyboard_rows})
-    else: bot.send_message(chat_id, msg, reply_markup={"inline_keyboard": keyboard_rows})
+    # Фильтр: показываем в связке только тех, кто есть в этой поездке
+    trip_members_str = [str(m) for m in trip['members']]
+    
+    names = {}
+    for uid in balances.keys():
+        names[uid] = data.get_linked_names(uid, filter_ids=trip_members_str)
+    curr = trip.get('currency', 'THB')
+    report = f"📊 *Баланс ({trip.get('name')}):*\n"
+    report += f"💰 Всего: *{total_spent:,.0f} {curr}*\n\n"
+    for uid, bal in balances.items():
+        name = names.get(uid, uid)
+        emoji = "🟢" if bal >= 0 else "🔴"
+        report += f"{name}: {emoji} *{bal:+.0f} {curr}*\n"
+    txs = logic.simplify_debts(balances, names)
+    if txs:
+        report += "\n🤝 *Расчеты:*\n"
+        for t in txs:
+            report += f"{t['from']} -> {t['to']}: *{t['amount']:,.0f} {curr}*\n"
+    else:
+        report += "\n✅ Все чисто!"
+    return report, render.BALANCE_KEYBOARD
+
+def my_stats_screen(tid, uid_str):
+    trip = data.get_trip(tid)
+    link_map = get_link_map()
+    stats = logic.get_my_stats(trip, uid_str, link_map)
+    curr = trip.get('currency', 'THB')
+    report = f"👤 *Ваша статистика ({trip.get('name')}):*\n\n"
+    report += f"💰 *Всего потрачено (на семью): {stats['total_share']:.0f} {curr}*\n"
+    if stats['cats']:
+        report += "*Траты по категориям:*\n"
+        for cat, amt in stats['cats'].items():
+            label = logic.CATEGORIES.get(cat, cat)
+            report += f"- {label}: {amt:.0f}\n"
+    return report, render.BACK_TO_TRIP
+
+# Counterparties listed in /summary (the largest first), to stay under Telegram's 4096 chars
+SUMMARY_PEOPLE = 20
+
+def summary_screen(user_id):
+    """Все поездки сразу: где я в плюсе/минусе и кто кому должен, из trip_balances"""
+    summary = data.get_user_summary(str(user_id))
+    markup = {"inline_keyboard": [[{"text": "📂 Мои поездки", "callback_data": "MENU_TRIPS"}]]}
+    if not summary['trips']:
+        return "📒 Поездок пока нет.", markup
+    text = "📒 *Сводка по всем поездкам*\n\n"
+    for t in summary['trips']:
+        sign = "🟢" if t['balance'] > 0.01 else "🔴" if t['balance'] < -0.01 else "⚪️"
+        text += f"{sign} *{t['name']}*: {t['balance']:+,.0f} {t['currency']}\n".replace(",", " ")
+    owed = [c for c in summary['counterparties'] if abs(c['amount']) > 0.01]
+    if owed:
+        text += "\n👥 *По людям:*\n"
+        for c in owed[:SUMMARY_PEOPLE]:
+            if c['amount'] > 0:
+                text += f"• {c['name']} должен вам {c['amount']:,.0f} {c['currency']}\n".replace(",", " ")
+            else:
+                text += f"• Вы должны {c['name']} {-c['amount']:,.0f} {c['currency']}\n".replace(",", " ")
+        if len(owed) > SUMMARY_PEOPLE:
+            text += f"…и еще {len(owed) - SUMMARY_PEOPLE}\n"
+    text += "\n*Итого:* " + ", ".join(f"{v:+,.0f} {k}".replace(",", " ") for k, v in summary['totals'].items())
+    return text, markup
 
 # --- Handlers ---
 
@@ -306,6 +436,26 @@ def handle_command(chat_id, user_id, user_name, text):
     elif cmd == "/menu":
         send_trip_dashboard(chat_id, user_id)
 
+    elif cmd in ("/archive", "/unarchive"):
+        # Законченная поездка уходит в архив (только чтение), /unarchive возвращает её.
+        # Это меняет поездку для всех, поэтому — только создатель и с подтверждением
+        tid = data.get_active_trip_id(uid_str)
+        if not tid: return bot.send_message(chat_id, "Нет активной поездки.")
+        if not can_archive(tid, uid_str):
+            return bot.send_message(chat_id, "🗄 Архивировать поездку и возвращать её может только создатель.",
+                                    reply_markup=render.BACK_TO_TRIP)
+        if cmd == "/archive":
+            text = "🗄 Отправить поездку в архив? Смотреть её можно будет, а менять — никому, пока её не вернут."
+            markup = {"inline_keyboard": [[{"text": "🗄 Да, в архив", "callback_data": f"ARCHIVE_OK|{tid}"},
+                                           {"text": "🔙 Нет", "callback_data": "OPEN_DASHBOARD"}]]}
+            return bot.send_message(chat_id, text, reply_markup=markup)
+        text = "✅ Поездка возвращена из архива." if data.unarchive_trip(tid) else "Поездка не в архиве."
+        bot.send_message(chat_id, text, reply_markup=render.BACK_TO_TRIP)
+
+    elif cmd == "/summary":
+        text, markup = summary_screen(uid_str)
+        bot.send_message(chat_id, text, reply_markup=markup)
+
     elif cmd == "/app":
         markup = {
             "inline_keyboard": [[
@@ -322,10 +472,30 @@ def handle_command(chat_id, user_id, user_name, text):
             data.update_trip_rate(tid, rate)
             trip = data.get_trip(tid)
             curr = trip.get('currency', 'UNIT')
-            bot.send_message(chat_id, f"✅ Курс установлен: 1 {curr} = {rate} RUB.", reply_markup={"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]})
+            bot.send_message(chat_id, f"✅ Курс установлен: 1 {curr} = {rate} RUB.", reply_markup=render.BACK_TO_TRIP)
         except:
             bot.send_message(chat_id, "❌ Пример: `/setrate 2.8`")
 
+    elif cmd == "/fx":
+        # Курс на сегодня для трат в другой валюте: /fx USD 36.5 -> 1 USD = 36.5 в валюте поездки
+        tid = data.get_active_trip_id(uid_str)
+        if not tid: return bot.send_message(chat_id, "Нет активной поездки.")
+        curr = data.get_trip(tid).get('currency', 'THB')
+        today = fx.day_of(time.time())
+        try:
+            code = fx.currency_code(args[0])
+            if len(args) > 1:
+                rate = float(args[1].replace(',', '.'))
+                if rate <= 0: raise ValueError(rate)
+                data.set_fx_rate(today, code, curr, rate)
+            else:
+                rate = data.get_fx_rate(code, curr, today)
+                if rate is None:
+                    return bot.send_message(chat_id, f"Курса {code} → {curr} нет. Пример: `/fx {code} 36.5`")
+            bot.send_message(chat_id, f"💱 1 {code} = {rate:g} {curr} ({today}).", reply_markup=render.BACK_TO_TRIP)
+        except (IndexError, ValueError):
+            bot.send_message(chat_id, f"❌ Пример: `/fx USD 36.5` (1 USD = 36.5 {curr})")
+
 def handle_text(chat_id, user_id, user_name, text):
     user = data.get_user(user_id)
     if not user:
@@ -364,13 +534,14 @@ def handle_text(chat_id, user_id, user_name, text):
                 
             split_map = {m_id: amt for m_id, amt in zip(masters, amounts) if amt > 0}
             
-            data.add_expense(draft['trip_id'], draft['payer'], draft['amount'], draft['desc'], draft['category'], split_map)
+            amount, split_map = data.add_expense(draft['trip_id'], draft['payer'], draft['amount'], draft['desc'],
+                                                 draft['category'], split_map, currency=draft.get('currency'))
             data.delete_draft(draft_id)
             data.update_user_state(user_id, "IDLE", user_name=user_name)
             
-            bot.send_message(chat_id, f"✅ Сохранено (вручную): *{draft['amount']}*")
+            bot.send_message(chat_id, f"✅ Сохранено (вручную): *{draft['amount']}*{converted_note(draft, amount, trip)}")
             send_trip_dashboard(chat_id, user_id)
-            notify_others(draft['trip_id'], draft['payer'], draft['amount'], draft['desc'], draft['category'], split_map)
+            notify_others(draft['trip_id'], draft['payer'], amount, draft['desc'], draft['category'], split_map)
             
         except ValueError:
             refresh_menu_msg(chat_id, user_id, "❌ Введите числа через пробел:", reply_markup={"inline_keyboard": [[{"text": "🔙 Отмена", "callback_data": "OPEN_DASHBOARD"}]]})
@@ -420,6 +591,26 @@ def handle_text(chat_id, user_id, user_name, text):
             refresh_menu_msg(chat_id, user_id, "❌ Неверный код. Попробуйте еще раз:", reply_markup={"inline_keyboard": [[{"text": "🔙 Отмена", "callback_data": "BACK_MAIN"}]]})
         return
 
+    # --- Expense Edit ---
+    if state in ("WAITING_EXPENSE_AMOUNT", "WAITING_EXPENSE_DESC"):
+        expense_id, page = user.get('edit_expense_id'), user.get('edit_expense_page', 0)
+        if state == "WAITING_EXPENSE_AMOUNT":
+            try:
+                amount = float(text.replace(',', '.').replace(' ', ''))
+                if amount <= 0: raise ValueError(amount)
+            except ValueError:
+                return bot.send_message(chat_id, "❌ Введите число больше нуля.")
+            changes = {"amount": amount}
+        else:
+            changes = {"description": text.strip()[:200]}
+        exp = data.update_expense(expense_id, changes, uid_str) if expense_id else None
+        data.update_user_state(user_id, "IDLE", user_name=user_name)
+        if not exp:
+            return bot.send_message(chat_id, "⚠️ Трата не найдена.", reply_markup=render.BACK_TO_TRIP)
+        text, markup = expense_card(exp, page)
+        refresh_menu_msg(chat_id, user_id, "✅ Сохранено.\n\n" + text, reply_markup=markup)
+        return
+
     # --- Repayment Amount ---
     if state == "WAITING_REPAYMENT_AMOUNT":
         try:
@@ -485,41 +676,79 @@ def handle_text(chat_id, user_id, user_name, text):
 
     # --- Expense Entry (Default) ---
     if state == "IDLE":
+        # "500 обед", "1.2k такси", "обед 500 на себя" (see src/parsing.py)
+        tid = data.get_active_trip_id(user_id)
+        if not tid:
+            # Nothing to add the expense to: only the regex stage decides whether to answer, no model call
+            if parsing.RegexStage()(text):
+                bot.send_message(chat_id, "Сначала создайте или вступите в поездку! /start")
+            return
         try:
-            parts = text.split()
-            amount = float(parts[0])
-            desc = " ".join(parts[1:]) if len(parts) > 1 else "Расход"
-            tid = data.get_active_trip_id(user_id)
-            if not tid: return bot.send_message(chat_id, "Сначала создайте или вступите в поездку! /start")
-            
-            trip = data.get_trip(tid)
-            curr = trip.get('currency', 'THB')
-            draft_id = f"{user_id}_{int(time.time())}"
-            members = trip['members']
-            link_map = get_link_map()
-            masters = set(logic.get_master(m, link_map) for m in members)
-            selected = {m: True for m in masters}
-            
-            draft_data = {
-                "amount": amount,
-                "desc": desc,
-                "payer": uid_str,
-                "trip_id": tid,
-                "selected": selected,
-                "category": "OTHER"
-            }
-            data.save_draft(draft_id, draft_data)
-            send_category_menu(chat_id, draft_id, curr) 
-        except ValueError:
-            pass 
+            parsed = parsing.parse(text)
+        except parsing.ParseTimeout:
+            return bot.send_message(chat_id, "⏳ Не успел разобрать сумму, отправьте сообщение ещё раз.")
+        if not parsed: return
 
-def handle_callback(chat_id, user_id, message_id, data_str):
+        trip = data.get_trip(tid)
+        if trip.get('archived_at'): raise db.TripArchived(tid)
+        curr = trip.get('currency', 'THB')
+        currency = parsed.currency if parsed.currency != curr else None
+        if currency and data.get_fx_rate(currency, curr, fx.day_of(time.time())) is None:
+            return bot.send_message(chat_id, f"💱 Нет курса {currency} → {curr}. Задайте его: `/fx {currency} 36.5` "
+                                             f"(1 {currency} = 36.5 {curr}) и отправьте трату ещё раз.")
+        draft_id = ids.new_id()
+        members = trip['members']
+        link_map = get_link_map()
+        masters = set(logic.get_master(m, link_map) for m in members)
+        selected = {m: True for m in masters}
+        if parsed.people == 1:
+            # "на себя": only the payer's family
+            my_master = logic.get_master(uid_str, link_map)
+            selected = {m: m == my_master for m in masters}
+
+        draft_data = {
+            "amount": parsed.amount,
+            "desc": parsed.description or "Расход",
+            "payer": uid_str,
+            "trip_id": tid,
+            "selected": selected,
+            "category": parsed.category or "OTHER",
+            "currency": currency,
+            "trip_currency": curr,
+            "members": split_members(members)
+        }
+        data.save_draft(draft_id, draft_data)
+        # A recognized category skips its menu; "🏷 Категория" in the split menu goes back to it
+        if parsed.category:
+            send_split_menu(chat_id, draft_id)
+        else:
+            send_category_menu(chat_id, draft_id, curr)
+
+# handle_callback answered the tap itself (with a text); process_update must not answer again
+ANSWERED = object()
+
+def answer(callback_id, text):
+    """Всплывающая подсказка на тап по кнопке (на один callback Telegram принимает один ответ)"""
+    bot.answer_callback_query(callback_id, text)
+    return ANSWERED
+
+def handle_callback(chat_id, user_id, message_id, data_str, callback_id=None):
     parts = data_str.split("|")
     cmd = parts[0]
     uid_str = str(user_id)
     # Нужно получить user_name, но в колбэке его нет. 
     # В update_user_state передадим None, чтобы имя не затерлось
     
+    if cmd == "ARCHIVE_OK":
+        tid = parts[1]
+        if not can_archive(tid, uid_str):
+            return answer(callback_id, "Архивировать поездку может только создатель.")
+        info = data.archive_trip(tid)
+        text = (f"🗄 Поездка в архиве: {info['expenses']} трат, {info['notes']} заметок. Вернуть: /unarchive"
+                if info else "Поездка уже в архиве.")
+        bot.edit_message(chat_id, message_id, text, reply_markup=render.BACK_TO_TRIP)
+        return
+
     if cmd == "OPEN_DASHBOARD":
         send_trip_dashboard(chat_id, user_id, message_id)
         return
@@ -623,10 +852,26 @@ def handle_callback(chat_id, user_id, message_id, data_str):
         for t in trips_list:
             mark = "✅ " if t['id'] == active else ""
             keyboard.append([{"text": f"{mark}{t['name']}", "callback_data": f"SWITCH_TRIP|{t['id']}"}])
+        if trips_list:
+            keyboard.append([{"text": "📒 Сводка по всем поездкам", "callback_data": "MENU_SUMMARY"}])
+        keyboard.append([{"text": "🗄 Архив", "callback_data": "MENU_ARCHIVE"}])
         keyboard.append([{"text": "🔙 В главное меню", "callback_data": "BACK_MAIN"}])
         bot.edit_message(chat_id, message_id, "🗂 *Ваши поездки*:", reply_markup={"inline_keyboard": keyboard})
         return
 
+    if cmd == "MENU_ARCHIVE":
+        keyboard = [[{"text": f"🗄 {t['name']}", "callback_data": f"SWITCH_TRIP|{t['id']}"}]
+                    for t in data.get_user_trips(user_id, archived=True)]
+        keyboard.append([{"text": "🔙 Мои поездки", "callback_data": "MENU_TRIPS"}])
+        text = "🗄 *Архив поездок*:" if len(keyboard) > 1 else "🗄 В архиве пока ничего нет."
+        bot.edit_message(chat_id, message_id, text, reply_markup={"inline_keyboard": keyboard})
+        return
+
+    if cmd == "MENU_SUMMARY":
+        text, markup = summary_screen(uid_str)
+        bot.edit_message(chat_id, message_id, text, reply_markup=markup)
+        return
+
     if cmd == "SWITCH_TRIP":
         target_tid = parts[1]
         data.set_user_active_trip(user_id, target_tid)
@@ -645,19 +890,14 @@ def handle_callback(chat_id, user_id, message_id, data_str):
             data.update_trip_currency(tid, curr_code)
             trip = data.get_trip(tid)
             bot.send_message(chat_id, f"✅ Поездка создана!\nВалюта: *{curr_code}*\n🔑 Код: `{trip['code']}`", 
-                             reply_markup={"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]})
+                             reply_markup=render.BACK_TO_TRIP)
             data.update_user_state(user_id, "IDLE")
             send_trip_dashboard(chat_id, user_id)
         return
 
     if cmd == "CAT":
         draft_id = parts[1]
-        category_label = parts[2]
-        cat_key = "OTHER"
-        for k, v in logic.CATEGORIES.items():
-            if v == category_label:
-                cat_key = k
-                break
+        cat_key = render.CATEGORY_BY_LABEL.get(parts[2], "OTHER")
         draft = data.get_draft(draft_id)
         if draft:
             draft['category'] = cat_key
@@ -665,6 +905,13 @@ def handle_callback(chat_id, user_id, message_id, data_str):
             send_split_menu(chat_id, draft_id, message_id)
         return
 
+    if cmd == "RECAT":
+        draft = data.get_draft(parts[1])
+        if draft:
+            curr = draft.get('trip_currency') or data.get_trip(draft['trip_id']).get('currency', 'THB')
+            send_category_menu(chat_id, parts[1], curr, message_id)
+        return
+
     if cmd == "TOGGLE":
         draft_id = parts[1]
         target_mid = parts[2]
@@ -683,8 +930,7 @@ def handle_callback(chat_id, user_id, message_id, data_str):
         
         draft = data.get_draft(draft_id)
         if not draft:
-             bot.answer_callback_query(message_id, "Ошибка: черновик не найден.")
-             return
+             return answer(callback_id, "Ошибка: черновик не найден.")
 
         trip = data.get_trip(draft['trip_id'])
         link_map = get_link_map()
@@ -699,7 +945,7 @@ def handle_callback(chat_id, user_id, message_id, data_str):
             hint_lines.append(f"{i+1}. *{name}*")
         
         hint_text = "\n".join(hint_lines)
-        curr = trip.get('currency', 'THB')
+        curr = draft.get('currency') or trip.get('currency', 'THB')
         
         msg = (
             f"✏️ *Ручной ввод* (Всего: {draft['amount']} {curr})\n\n"
@@ -718,16 +964,17 @@ def handle_callback(chat_id, user_id, message_id, data_str):
         tid = draft['trip_id']
         selected = draft['selected']
         count = sum(1 for v in selected.values() if v)
-        if count == 0: return bot.answer_callback_query(message_id, "Выберите хотя бы одного участника!")
-        amount = draft['amount']
-        share = amount / count
+        if count == 0: return answer(callback_id, "Выберите хотя бы одного участника!")
+        share = draft['amount'] / count
         split_map = {mid: share for mid, active in selected.items() if active}
         
-        data.add_expense(tid, draft['payer'], amount, draft['desc'], draft['category'], split_map)
+        amount, split_map = data.add_expense(tid, draft['payer'], draft['amount'], draft['desc'], draft['category'],
+                                             split_map, currency=draft.get('currency'))
         data.delete_draft(draft_id)
         
-        bot.edit_message(chat_id, message_id, f"✅ Сохранено: *{amount}* ({draft['desc']})", 
-                         reply_markup={"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]})
+        note = converted_note(draft, amount, data.get_trip(tid)) if draft.get('currency') else ""
+        bot.edit_message(chat_id, message_id, f"✅ Сохранено: *{draft['amount']}*{note} ({draft['desc']})", 
+                         reply_markup=render.BACK_TO_TRIP)
         notify_others(tid, draft['payer'], amount, draft['desc'], draft['category'], split_map)
         return
 
@@ -735,40 +982,13 @@ def handle_callback(chat_id, user_id, message_id, data_str):
         draft_id = parts[1]
         data.delete_draft(draft_id)
         bot.edit_message(chat_id, message_id, "❌ Отменено.", 
-                         reply_markup={"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]})
+                         reply_markup=render.BACK_TO_TRIP)
         return
 
     if cmd == "MENU_BALANCE":
-        tid = data.get_active_trip_id(user_id)
+        tid, _, version = get_trip_view(user_id)
         if not tid: return
-        trip = data.get_trip(tid)
-        link_map = get_link_map()
-        balances, total_spent, total_paid = logic.calculate_balance(trip, link_map)
-        
-        # Фильтр: показываем в связке только тех, кто есть в этой поездке
-        trip_members_str = [str(m) for m in trip['members']]
-        
-        names = {}
-        for uid in balances.keys():
-            names[uid] = data.get_linked_names(uid, filter_ids=trip_members_str)
-        curr = trip.get('currency', 'THB')
-        report = f"📊 *Баланс ({trip.get('name')}):*\n"
-        report += f"💰 Всего: *{total_spent:,.0f} {curr}*\n\n"
-        for uid, bal in balances.items():
-            name = names.get(uid, uid)
-            emoji = "🟢" if bal >= 0 else "🔴"
-            report += f"{name}: {emoji} *{bal:+.0f} {curr}*\n"
-        txs = logic.simplify_debts(balances, names)
-        if txs:
-            report += "\n🤝 *Расчеты:*\n"
-            for t in txs:
-                report += f"{t['from']} -> {t['to']}: *{t['amount']:,.0f} {curr}*\n"
-        else:
-            report += "\n✅ Все чисто!"
-        keyboard = {"inline_keyboard": [
-            [{"text": "⚙️ Сделать расчет", "callback_data": "MENU_SETTLE"}],
-            [{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]
-        ]}
+        report, keyboard = render.screens.get_or_build("balance", tid, version, lambda: balance_screen(tid))
         bot.edit_message(chat_id, message_id, report, reply_markup=keyboard)
         return
 
@@ -787,7 +1007,7 @@ def handle_callback(chat_id, user_id, message_id, data_str):
         rate = trip.get('rate', 0)
         txs = logic.simplify_debts(balances, names)
         if not txs:
-            bot.edit_message(chat_id, message_id, "✅ Балансы уже выровнены!", reply_markup={"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]})
+            bot.edit_message(chat_id, message_id, "✅ Балансы уже выровнены!", reply_markup=render.BACK_TO_TRIP)
             return
         
         # Чтобы найти ID по имени для отправки сообщений, нужен обратный поиск
@@ -812,24 +1032,16 @@ def handle_callback(chat_id, user_id, message_id, data_str):
             if to_id:
                 bot.send_message(to_id, f"💰 Пользователь *{from_name}* должен вам *{amount_str}*.")
                 
-        bot.edit_message(chat_id, message_id, "✅ Расчеты отправлены участникам в ЛС!", reply_markup={"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]})
+        bot.edit_message(chat_id, message_id, "✅ Расчеты отправлены участникам в ЛС!", reply_markup=render.BACK_TO_TRIP)
         return
 
     if cmd == "MENU_ME":
-        tid = data.get_active_trip_id(user_id)
+        tid, master_id, version = get_trip_view(user_id)
         if not tid: return
-        trip = data.get_trip(tid)
-        link_map = get_link_map()
-        stats = logic.get_my_stats(trip, uid_str, link_map)
-        curr = trip.get('currency', 'THB')
-        report = f"👤 *Ваша статистика ({trip.get('name')}):*\n\n"
-        report += f"💰 *Всего потрачено (на семью): {stats['total_share']:.0f} {curr}*\n"
-        if stats['cats']:
-            report += "*Траты по категориям:*\n"
-            for cat, amt in stats['cats'].items():
-                label = logic.CATEGORIES.get(cat, cat)
-                report += f"- {label}: {amt:.0f}\n"
-        bot.edit_message(chat_id, message_id, report, reply_markup={"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]})
+        # Статистика считается на семью, поэтому общая для всех, кто привязан к одному мастеру
+        report, keyboard = render.screens.get_or_build(
+            "me", tid, version, lambda: my_stats_screen(tid, uid_str), viewer=master_id)
+        bot.edit_message(chat_id, message_id, report, reply_markup=keyboard)
         return
 
     if cmd == "MENU_REPAY":
@@ -889,7 +1101,7 @@ def handle_callback(chat_id, user_id, message_id, data_str):
         data.update_user_state(victim_id, "WAITING_ROULETTE_AMOUNT", roulette_trip_id=tid, roulette_payer_id=victim_id)
         
         bot.edit_message(chat_id, message_id, f"🎯 Сегодня платит: *{victim_name.upper()}*! 🎉", 
-                         reply_markup={"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]})
+                         reply_markup=render.BACK_TO_TRIP)
         
         refresh_menu_msg(victim_id, victim_id, "🎉 Вы проиграли в рулетку! Введите сумму, которую оплатили:", reply_markup={"inline_keyboard": [[{"text": "🔙 Отмена", "callback_data": "OPEN_DASHBOARD"}]]})
         return
@@ -903,6 +1115,39 @@ def handle_callback(chat_id, user_id, message_id, data_str):
         send_all_expenses_list(chat_id, user_id, message_id, page)
         return
 
+    if cmd.startswith("EXP"):
+        exp, error = editable_expense(user_id, parts[1])
+        page = int(parts[2]) if len(parts) > 2 else 0
+        if not exp:
+            return answer(callback_id, error)
+        eid = exp['id']
+        if cmd == "EXP":
+            text, markup = expense_card(exp, page)
+        elif cmd in ("EXP_AMOUNT", "EXP_DESC"):
+            state = "WAITING_EXPENSE_AMOUNT" if cmd == "EXP_AMOUNT" else "WAITING_EXPENSE_DESC"
+            data.update_user_state(user_id, state, edit_expense_id=eid, edit_expense_page=page)
+            prompt = (f"💰 Новая сумма{' в ' + exp['currency'] if exp.get('currency') else ''}:"
+                      if cmd == "EXP_AMOUNT" else "📝 Новое описание:")
+            text, markup = prompt, {"inline_keyboard": [[{"text": "🔙 Отмена", "callback_data": f"EXP|{eid}|{page}"}]]}
+        elif cmd == "EXP_CAT":
+            text = "🏷 Новая категория:"
+            markup = {"inline_keyboard": [
+                [{"text": label, "callback_data": f"EXP_SETCAT|{eid}|{page}|{render.CATEGORY_BY_LABEL[label]}"} for label in row]
+                for row in render.CATEGORY_LAYOUT] + [[{"text": "🔙 Отмена", "callback_data": f"EXP|{eid}|{page}"}]]}
+        elif cmd == "EXP_SETCAT":
+            text, markup = expense_card(data.update_expense(eid, {"category": parts[3]}, uid_str) or exp, page)
+        elif cmd == "EXP_DEL":
+            text = f"🗑 Удалить *{exp['description']}* ({exp['amount']:,.0f})?".replace(",", " ")
+            markup = {"inline_keyboard": [[{"text": "🗑 Да, удалить", "callback_data": f"EXP_DEL_OK|{eid}|{page}"},
+                                           {"text": "🔙 Нет", "callback_data": f"EXP|{eid}|{page}"}]]}
+        elif cmd == "EXP_DEL_OK":
+            data.delete_expense(eid, uid_str)
+            return send_all_expenses_list(chat_id, user_id, message_id, page)
+        else:
+            return
+        bot.edit_message(chat_id, message_id, text, reply_markup=markup)
+        return
+
     if cmd == "MENU_NOTES":
         tid = data.get_active_trip_id(user_id)
         if not tid: return
@@ -973,7 +1218,23 @@ def handle_callback(chat_id, user_id, message_id, data_str):
 
 # --- Main Loop ---
 
+COMMANDS = ("/start", "/menu", "/app", "/setrate", "/fx", "/summary", "/archive", "/unarchive")
+
+UPDATE_SECONDS = metrics.histogram("splitopus_update_seconds", "Time to handle one update", ["kind"])
+UPDATE_ERRORS = metrics.counter("splitopus_update_errors_total", "Updates that raised", ["kind"])
+
 def process_update(u):
+    # Все SQL-запросы апдейта попадают в один scope: видно их число и N+1
+    kind = querystats.update_name(u, COMMANDS)
+    try:
+        with UPDATE_SECONDS.time(kind=kind), querystats.scope(kind), \
+                tracing.trace(kind, update_id=u.get('update_id')):
+            _dispatch_update(u)
+    except Exception:
+        UPDATE_ERRORS.inc(kind=kind)
+        raise
+
+def _dispatch_update(u):
     if 'message' in u:
         msg = u['message']
         chat_id = msg['chat']['id']
@@ -983,10 +1244,13 @@ def process_update(u):
         text = msg.get('text', '')
         
         logger.info(f"WEBHOOK MSG: {text}")
-        if text.startswith('/'):
-            handle_command(chat_id, user_id, user_name, text)
-        else:
-            handle_text(chat_id, user_id, user_name, text)
+        try:
+            if text.startswith('/'):
+                handle_command(chat_id, user_id, user_name, text)
+            else:
+                handle_text(chat_id, user_id, user_name, text)
+        except db.TripArchived:
+            archived_reply(chat_id, user_id)
             
     elif 'callback_query' in u:
         cb = u['callback_query']
@@ -995,5 +1259,16 @@ def process_update(u):
         msg_id = cb['message']['message_id']
         data_str = cb['data']
         
-        handle_callback(chat_id, user_id, msg_id, data_str)
-        bot.answer_callback_query(cb['id'])
+        result = None
+        try:
+            result = handle_callback(chat_id, user_id, msg_id, data_str, cb['id'])
+        except db.TripArchived:
+            archived_reply(chat_id, user_id)
+        if result is not ANSWERED:
+            bot.answer_callback_query(cb['id'])
+
+def archived_reply(chat_id, user_id):
+    """Any write into an archived trip (expense, note, repayment) ends up here"""
+    data.update_user_state(user_id, "IDLE")
+    bot.send_message(chat_id, "🗄 Поездка в архиве, изменить её нельзя. Вернуть из архива: /unarchive",
+                     reply_markup=render.BACK_TO_TRIP)
@@ -0,0 +1,86 @@
+import os
+import secrets
+import threading
+import time
+from collections import deque
+
+# --- IDs & Invite Codes ---
+# Раньше id поездки был trip_{секунды}, id черновика — {user}_{секунды}: две поездки
+# (или два сообщения) за одну секунду давали один ключ. Здесь ULID-подобные id:
+# 48 бит миллисекунд + 80 бит случайности, в Crockford base32, сортируются по
+# времени. Случайная часть делает их уникальными между процессами бота и API без
+# общего счётчика; внутри процесса id одной миллисекунды монотонно растут.
+# Коды приглашений короткие, поэтому уникальность проверяется в базе: CodePool
+# заранее набирает свободные коды одной выборкой, а вставка всё равно повторяется
+# при конфликте (другой процесс мог занять код между проверкой и INSERT).
+
+CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+# Invite codes are read off a screen and typed in: no 0/O, 1/I/L
+CODE_ALPHABET = "23456789ABCDEFGHJKMNPQRSTUVWXYZ"
+CODE_LENGTH = 6
+CODE_POOL_SIZE = int(os.getenv("INVITE_CODE_POOL", "32"))
+
+_RANDOM_BITS = 80
+_lock = threading.Lock()
+_last_ms = -1
+_last_random = 0
+
+
+def _encode(value, length):
+    chars = []
+    for _ in range(length):
+        value, r = divmod(value, 32)
+        chars.append(CROCKFORD[r])
+    return "".join(reversed(chars))
+
+
+def new_id(prefix=""):
+    """26-char time-ordered id (ULID layout), e.g. new_id("trip_") -> "trip_01J9...". """
+    global _last_ms, _last_random
+    ms = time.time_ns() // 1_000_000
+    with _lock:
+        if ms <= _last_ms:
+            # Same millisecond (or the clock stepped back): keep ordering by bumping the random part
+            ms = _last_ms
+            _last_random = (_last_random + 1) % (1 << _RANDOM_BITS)
+        else:
+            _last_ms = ms
+            _last_random = secrets.randbits(_RANDOM_BITS)
+        value = (ms << _RANDOM_BITS) | _last_random
+    return prefix + _encode(value, 26)
+
+
+def id_time(id_, prefix=""):
+    """Unix seconds encoded in an id from new_id()."""
+    ms = 0
+    for ch in id_[len(prefix):len(prefix) + 10]:
+        ms = ms * 32 + CROCKFORD.index(ch)
+    return ms / 1000
+
+
+def invite_code(length=CODE_LENGTH):
+    return "".join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+
+
+class CodePool:
+    """
+    Invite codes checked against the database in batches. `taken(codes)` returns the
+    subset already in use; take() hands out the rest and refills when empty.
+    """
+
+    def __init__(self, taken, size=CODE_POOL_SIZE):
+        self.taken = taken
+        self.size = size
+        self._codes = deque()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            if not self._codes:
+                self._refill()
+            return self._codes.popleft() if self._codes else invite_code()
+
+    def _refill(self):
+        candidates = list(dict.fromkeys(invite_code() for _ in range(self.size)))
+        used = self.taken(candidates)
+        self._codes.extend(c for c in candidates if c not in used)
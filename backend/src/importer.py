@@ -0,0 +1,289 @@
+import csv
+import io
+import math
+import os
+import time
+from datetime import datetime
+
+from . import fx, logic
+
+# --- Bulk Import ---
+# Перенос трат из Splitwise или таблицы: JSON-массив или CSV. Сначала проверяется всё
+# целиком (плательщик и участники должны быть в поездке, суммы сходятся), и только
+# если ошибок нет, траты пишутся пачками через db.import_expenses. Траты в другой
+# валюте (колонка currency) пересчитываются в валюту поездки по fx_rates на их дату.
+
+MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "5000"))
+# Errors reported back per request; the rest are only counted
+MAX_ERRORS = 50
+SPLIT_TOLERANCE = logic.SPLIT_TOLERANCE
+
+# CSV header (lowercased) -> field. Splitwise exports Date, Description, Category, Cost,
+# Currency and then one net-balance column per person.
+HEADERS = {
+    "date": "date", "дата": "date",
+    "payer": "payer", "paid by": "payer", "плательщик": "payer", "кто платил": "payer",
+    "amount": "amount", "cost": "amount", "сумма": "amount",
+    "description": "description", "описание": "description",
+    "category": "category", "категория": "category",
+    "split": "split", "участники": "split",
+    "currency": "currency", "валюта": "currency",
+}
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                "%d.%m.%Y", "%d.%m.%Y %H:%M", "%d.%m.%y", "%d/%m/%Y")
+# Category names as people type them, on top of the keys and labels in logic.CATEGORIES
+CATEGORY_ALIASES = {
+    "еда": "FOOD", "food and drink": "FOOD", "dining out": "FOOD", "groceries": "SHOP",
+    "алкоголь": "ALCOHOL", "liquor": "ALCOHOL",
+    "транспорт": "TRANSPORT", "taxi": "TRANSPORT", "transportation": "TRANSPORT",
+    "магазин": "SHOP", "покупки": "SHOP",
+    "развлечения": "FUN", "entertainment": "FUN",
+    "жилье": "HOME", "жильё": "HOME", "home": "HOME", "rent": "HOME",
+    "payment": "REPAYMENT", "возврат долга": "REPAYMENT",
+}
+
+
+class RowError(ValueError):
+    """A row that cannot be imported; the message goes back to the client."""
+
+
+def _categories():
+    known = dict(CATEGORY_ALIASES)
+    for key, label in logic.CATEGORIES.items():
+        known[key.lower()] = key
+        known[label.lower()] = key
+        known[label.split(" ", 1)[-1].lower()] = key  # label without the emoji
+    return known
+
+
+CATEGORY_KEYS = _categories()
+
+
+def _number(value):
+    """Float from a spreadsheet cell: 1234.5, 1 234,50, 1,234.50."""
+    text = str(value or "").strip().replace(" ", "").replace("\u00a0", "")
+    if "," in text and "." not in text:
+        text = text.replace(",", ".")
+    try:
+        return float(text.replace(",", ""))
+    except ValueError:
+        raise RowError(f"bad number {value!r}") from None
+
+
+def parse_amount(value):
+    if isinstance(value, bool):
+        raise RowError("amount must be a number")
+    amount = float(value) if isinstance(value, (int, float)) else _number(value)
+    if not math.isfinite(amount) or amount <= 0:
+        raise RowError(f"amount must be positive, got {value!r}")
+    return amount
+
+
+def parse_date(value, default):
+    """Unix seconds, or one of DATE_FORMATS in server local time; empty -> default."""
+    if value is None or value == "":
+        return default
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    text = str(value).strip()
+    if text.isdigit():
+        return int(text)
+    for fmt in DATE_FORMATS:
+        try:
+            return int(datetime.strptime(text, fmt).timestamp())
+        except ValueError:
+            continue
+    raise RowError(f"bad date {value!r}")
+
+
+class Members:
+    """Trip members, addressable by user id or (unambiguous, case-insensitive) name."""
+
+    def __init__(self, names):
+        self.names = {str(uid): name for uid, name in names.items()}
+        self.by_name = {}
+        for uid, name in self.names.items():
+            key = (name or "").strip().lower()
+            if key:
+                self.by_name.setdefault(key, []).append(uid)
+
+    def resolve(self, value):
+        text = str(value).strip()
+        if text in self.names:
+            return text
+        ids = self.by_name.get(text.lower(), [])
+        if len(ids) == 1:
+            return ids[0]
+        if ids:
+            raise RowError(f"several members are called {text!r}, use the user id")
+        raise RowError(f"{text!r} is not a member of this trip")
+
+
+def parse_split(value, amount, members):
+    """
+    {member: share}; "Аня;Боря" (equal shares); "Аня:300;Боря:200"; empty -> all members equally.
+    Shares must add up to the amount.
+    """
+    if value is None or value == "" or value == {}:
+        shared = list(members.names)
+        return {uid: amount / len(shared) for uid in shared}
+    if isinstance(value, dict):
+        split = {}
+        for who, share in value.items():
+            uid = members.resolve(who)
+            split[uid] = split.get(uid, 0.0) + parse_amount(share)
+    elif isinstance(value, (list, tuple)):
+        shared = list(dict.fromkeys(members.resolve(who) for who in value))
+        if not shared:
+            raise RowError("empty split")
+        return {uid: amount / len(shared) for uid in shared}
+    else:
+        text = str(value)
+        # "Аня;Боря" or "Аня, Боря"; with ';' present commas stay decimal separators
+        parts = [p.strip() for p in text.split(";" if ";" in text else ",") if p.strip()]
+        if not parts:
+            raise RowError("empty split")
+        if not any(":" in p for p in parts):
+            return parse_split(parts, amount, members)
+        split = {}
+        for part in parts:
+            who, sep, share = part.rpartition(":")
+            if not sep:
+                raise RowError(f"split entry {part!r} has no share")
+            uid = members.resolve(who)
+            split[uid] = split.get(uid, 0.0) + parse_amount(share)
+    if abs(sum(split.values()) - amount) > SPLIT_TOLERANCE:
+        raise RowError(f"split adds up to {sum(split.values()):.2f}, not {amount:.2f}")
+    return split
+
+
+def normalize(item, members, now=None, converter=None):
+    """
+    One raw row (JSON object or CSV line) -> expense dict for db.import_expenses.
+    converter (fx.Converter) brings amounts in another currency to the trip currency.
+    """
+    if not isinstance(item, dict):
+        raise RowError("expected an object")
+    if item.get("_error"):
+        raise RowError(item["_error"])
+    now = int(time.time()) if now is None else now
+    payer = item.get("payer_id", item.get("payer"))
+    if payer is None or payer == "":
+        raise RowError("payer is missing")
+    amount = parse_amount(item.get("amount"))
+    category = str(item.get("category") or "OTHER").strip()
+    category = CATEGORY_KEYS.get(category.lower(), "OTHER")
+    split = parse_split(item.get("split"), amount, members)
+    if category == "REPAYMENT" and len(split) != 1:
+        raise RowError("a repayment goes to exactly one member")
+    try:
+        currency = fx.currency_code(item.get("currency"))
+    except ValueError:
+        raise RowError(f"bad currency {item.get('currency')!r}") from None
+    created_at = parse_date(item.get("created_at", item.get("date")), now)
+    expense = {
+        "payer_id": members.resolve(payer),
+        "amount": amount,
+        "description": str(item.get("description") or "").strip() or "Импорт",
+        "category": category,
+        "split": split,
+        "created_at": created_at,
+    }
+    if converter is not None:
+        try:
+            expense.update(converter.convert(amount, split, currency, created_at))
+        except fx.RateMissing:
+            raise RowError(f"no {currency} rate for {fx.day_of(created_at)}, load it with python -m src.fx") from None
+    return expense
+
+
+def validate(items, members, converter=None):
+    """
+    Returns (expenses, errors). errors is a list of {"row": n, "error": msg} with 1-based
+    rows (None for the whole import); nothing should be written unless it is empty.
+    """
+    if len(items) > MAX_ROWS:
+        return [], [{"row": None, "error": f"at most {MAX_ROWS} expenses per import, got {len(items)}"}]
+    if not members.names:
+        return [], [{"row": None, "error": "the trip has no members"}]
+    now = int(time.time())
+    expenses, errors = [], []
+    for n, item in enumerate(items, 1):
+        try:
+            expenses.append(normalize(item, members, now, converter))
+        except RowError as e:
+            # CSV rows carry their line number in the file
+            errors.append({"row": item.get("_line", n) if isinstance(item, dict) else n, "error": str(e)})
+    if not items:
+        errors.append({"row": None, "error": "nothing to import"})
+    return expenses, errors
+
+
+# --- CSV ---
+
+def decode(data):
+    """CSV bytes from Excel / Google Sheets: UTF-8 (with or without BOM), else cp1251."""
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1251")
+
+
+def rows_from_csv(text, members):
+    """
+    CSV -> raw rows for validate(). Needs a header; see HEADERS for the column names.
+    Splitwise exports (no payer column, one net-balance column per person) are turned
+    into payer + split: the one person with a positive balance paid, everyone's share is
+    what they paid minus their balance.
+    """
+    # Excel with a Russian locale writes ';', Google Sheets ',', some tools tabs: the
+    # header line has no quoted numbers, so its most common separator is the delimiter
+    first_line = text.split("\n", 1)[0]
+    delimiter = max(",;\t", key=first_line.count)
+    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+    header = next(reader, None)
+    if not header:
+        raise RowError("empty CSV")
+    fields = [HEADERS.get(h.strip().lower()) for h in header]
+    person_columns = []
+    if "payer" not in fields:
+        # Splitwise: the remaining columns are people
+        for i, h in enumerate(header):
+            if fields[i] is None and h.strip():
+                person_columns.append((i, members.resolve(h)))
+        if not person_columns:
+            raise RowError("CSV needs a payer column (or Splitwise person columns)")
+    if "amount" not in fields:
+        raise RowError("CSV needs an amount column")
+
+    rows = []
+    for cells in reader:
+        if not any(c.strip() for c in cells):
+            continue
+        row = {f: cells[i].strip() for i, f in enumerate(fields) if f and i < len(cells)}
+        row["_line"] = reader.line_num
+        if person_columns:
+            # Splitwise appends a "Total balance" line without a date
+            if not row.get("date") and row.get("description", "").lower() == "total balance":
+                continue
+            row.update(_splitwise_payer(cells, person_columns, row.get("amount")))
+        rows.append(row)
+    return rows
+
+
+def _splitwise_payer(cells, person_columns, cost):
+    try:
+        cost = parse_amount(cost)
+        balances = {uid: _number(cells[i]) if i < len(cells) and cells[i].strip() else 0.0
+                    for i, uid in person_columns}
+    except RowError as e:
+        return {"_error": str(e)}
+    payers = [uid for uid, b in balances.items() if b > 0]
+    if len(payers) != 1:
+        return {"_error": f"{len(payers)} people paid for this one, split it into separate expenses"}
+    payer = payers[0]
+    split = {uid: -b for uid, b in balances.items() if b < 0}
+    own_share = cost - balances[payer]
+    if own_share > SPLIT_TOLERANCE:
+        split[payer] = own_share
+    return {"payer": payer, "split": split}
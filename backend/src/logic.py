@@ -1,5 +1,7 @@
 from datetime import datetime
 
+from . import fastbalance
+
 # --- Constants ---
 CATEGORIES = {
     "FOOD": "🍔 Еда",
@@ -12,6 +14,9 @@ CATEGORIES = {
     "OTHER": "📦 Другое"
 }
 
+# Split shares may differ from the amount by this much (rounding in spreadsheets and clients)
+SPLIT_TOLERANCE = 0.01
+
 CURRENCIES = {
     "THB": "🇹🇭 THB",
     "RUB": "🇷🇺 RUB",
@@ -30,7 +35,13 @@ def calculate_balance(trip, link_map=None):
     """
     Calculates balances aggregating linked users.
     link_map: { 'child_id': 'master_id', ... }
+    Large trips go to the NumPy engine in fastbalance.py (same result, bit for bit).
     """
+    if fastbalance.should_use(trip):
+        return fastbalance.calculate_balance(trip, link_map)
+    return calculate_balance_py(trip, link_map)
+
+def calculate_balance_py(trip, link_map=None):
     if not trip: return {}, 0, {}
     if link_map is None: link_map = {}
     
@@ -74,6 +85,11 @@ def calculate_balance(trip, link_map=None):
     return balances, total_spent_on_trip, total_paid_by_member
 
 def get_my_stats(trip, my_uid, link_map=None):
+    if fastbalance.should_use(trip, link_map, cold_ok=False):
+        return fastbalance.get_my_stats(trip, my_uid, link_map)
+    return get_my_stats_py(trip, my_uid, link_map)
+
+def get_my_stats_py(trip, my_uid, link_map=None):
     if not trip: return {}
     if link_map is None: link_map = {}
     
@@ -121,6 +137,47 @@ def get_my_stats(trip, my_uid, link_map=None):
             
     return stats
 
+def user_summary(master_id, trips, link_map, names):
+    """
+    Net position of one user (their master) in every trip and per counterparty across
+    trips, from the stored paid/owed per user (db.get_user_ledger) instead of the
+    expenses. Same rules as calculate_balance: shares of non-members' families are dropped.
+    Amounts stay in each trip's currency, so totals and counterparties are per currency.
+    """
+    summary = {"master_id": master_id, "trips": [], "totals": {}, "counterparties": []}
+    counterparties = {}
+    for trip in trips:
+        masters = set(get_master(uid, link_map) for uid in trip['members'])
+        balances = {m: 0.0 for m in masters}
+        paid = 0.0
+        for uid, (credit, debit) in trip['balances'].items():
+            m = get_master(uid, link_map)
+            if m in balances:
+                balances[m] += credit - debit
+            if m == master_id:
+                paid += credit
+        if master_id not in balances:
+            continue
+        curr = trip.get('currency') or 'THB'
+        debts = []
+        for t in simplify_debts(balances, {}):
+            if master_id not in (t['from'], t['to']):
+                continue
+            other = t['to'] if t['from'] == master_id else t['from']
+            amount = t['amount'] if t['to'] == master_id else -t['amount']
+            debts.append({"user_id": other, "name": names.get(other, other), "amount": amount})
+            entry = counterparties.setdefault((other, curr), {
+                "user_id": other, "name": names.get(other, other), "currency": curr, "amount": 0.0, "trips": 0})
+            entry["amount"] += amount
+            entry["trips"] += 1
+        summary["trips"].append({
+            "trip_id": trip['id'], "name": trip['name'], "currency": curr, "rate": trip.get('rate'),
+            "balance": balances[master_id], "paid": paid, "debts": debts})
+        summary["totals"][curr] = summary["totals"].get(curr, 0.0) + balances[master_id]
+    # Positive: they owe the user; negative: the user owes them
+    summary["counterparties"] = sorted(counterparties.values(), key=lambda c: -abs(c["amount"]))
+    return summary
+
 def simplify_debts(balances, user_names):
     creditors = []
     debtors = []
@@ -0,0 +1,228 @@
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from . import db, metrics
+
+# --- Database Maintenance ---
+# Раньше по базе никто не запускал ANALYZE, не возвращал свободные страницы и не делал
+# чекпойнтов. Теперь процесс API раз в MAINTENANCE_POLL_S секунд смотрит PRAGMA
+# data_version: она меняется при коммите любого другого подключения, в том числе из
+# бота. Если записей не было MAINTENANCE_QUIET_S секунд, база считается свободной и по
+# ней проходят ограниченные задачи:
+#   - checkpoint: PRAGMA wal_checkpoint(PASSIVE) не ждёт читателей и писателей; WAL
+#     больше WAL_TRUNCATE_BYTES обрезается через TRUNCATE, только если никто не мешает;
+#   - vacuum: PRAGMA incremental_vacuum(VACUUM_PAGES), когда в freelist не меньше
+#     VACUUM_MIN_FREE_PAGES страниц (auto_vacuum=INCREMENTAL ставит db.init_db);
+#   - optimize: PRAGMA optimize с analysis_limit раз в MAINTENANCE_OPTIMIZE_S (если
+#     статистики нет совсем — один ANALYZE).
+# Старую базу (auto_vacuum=NONE) в INCREMENTAL переводит один полный VACUUM. Он держит
+# базу всё время перестройки, поэтому запускается только руками: python -m src.maintenance convert.
+# Подключение работает с busy_timeout=0: занятая база — повод пропустить проход, а не ждать.
+
+ENABLED = os.getenv("MAINTENANCE", "1") != "0"
+POLL_S = float(os.getenv("MAINTENANCE_POLL_S", "10"))
+QUIET_S = float(os.getenv("MAINTENANCE_QUIET_S", "30"))
+OPTIMIZE_S = float(os.getenv("MAINTENANCE_OPTIMIZE_S", str(6 * 3600)))
+ANALYSIS_LIMIT = int(os.getenv("ANALYSIS_LIMIT", "1000"))
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "500"))
+VACUUM_MIN_FREE_PAGES = int(os.getenv("VACUUM_MIN_FREE_PAGES", "100"))
+WAL_TRUNCATE_BYTES = int(os.getenv("WAL_TRUNCATE_BYTES", str(16 * 1024 * 1024)))
+
+logger = logging.getLogger(__name__)
+
+DB_BYTES = metrics.gauge("splitopus_db_file_bytes", "Size of the database file")
+WAL_BYTES = metrics.gauge("splitopus_db_wal_bytes", "Size of the -wal file")
+DB_PAGES = metrics.gauge("splitopus_db_pages", "Pages in the database")
+FREELIST_PAGES = metrics.gauge("splitopus_db_freelist_pages", "Free pages incremental_vacuum can return to the OS")
+TASKS = metrics.counter(
+    "splitopus_db_maintenance_total", "Maintenance tasks by result (ok / busy / failed)", ["task", "result"])
+TASK_SECONDS = metrics.histogram(
+    "splitopus_db_maintenance_seconds", "Time spent in a maintenance task", ["task"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+VACUUMED_PAGES = metrics.counter("splitopus_db_vacuumed_pages_total", "Pages released by incremental_vacuum")
+CHECKPOINTED_FRAMES = metrics.counter("splitopus_db_checkpointed_frames_total", "WAL frames copied into the database")
+
+
+def storage_stats(conn, path=None):
+    path = path or db.DB_PATH
+    wal = f"{path}-wal"
+    return {
+        "file_bytes": os.path.getsize(path) if os.path.exists(path) else 0,
+        "wal_bytes": os.path.getsize(wal) if os.path.exists(wal) else 0,
+        "pages": conn.execute("PRAGMA page_count").fetchone()[0],
+        "freelist_pages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+        "journal_mode": conn.execute("PRAGMA journal_mode").fetchone()[0],
+        "auto_vacuum": conn.execute("PRAGMA auto_vacuum").fetchone()[0],
+    }
+
+
+class Maintenance:
+    """Runs checkpoint / vacuum / optimize on a private connection when the database is quiet."""
+
+    def __init__(self, path=None, poll_interval=POLL_S, quiet=QUIET_S, optimize_interval=OPTIMIZE_S):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.quiet = quiet
+        self.optimize_interval = optimize_interval
+        self._conn = None
+        self._data_version = None
+        self._changed_at = time.time()
+        self._checkpointed = True
+        self._optimized_at = 0.0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _connection(self):
+        if self._conn is None:
+            # Plain sqlite3: background statements are not an update or a request for querystats
+            self._conn = sqlite3.connect(self.path or db.DB_PATH, check_same_thread=False)
+            self._conn.execute("PRAGMA busy_timeout = 0")
+        return self._conn
+
+    def _run_task(self, name, fn):
+        start = time.perf_counter()
+        try:
+            result = fn(self._connection())
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                TASKS.inc(task=name, result="busy")
+                return None
+            TASKS.inc(task=name, result="failed")
+            logger.error(f"Maintenance {name} failed: {e}")
+            return None
+        TASKS.inc(task=name, result="ok")
+        TASK_SECONDS.observe(time.perf_counter() - start, task=name)
+        return result
+
+    # --- Tasks ---
+
+    def checkpoint(self, conn):
+        busy, frames, done = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        if done > 0:
+            CHECKPOINTED_FRAMES.inc(done)
+        wal = f"{self.path or db.DB_PATH}-wal"
+        if not busy and frames == done and os.path.exists(wal) and os.path.getsize(wal) > WAL_TRUNCATE_BYTES:
+            # Everything is in the database already; TRUNCATE gives up at once if a reader is in the WAL
+            busy = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]
+        return {"frames": frames, "checkpointed": done, "busy": bool(busy)}
+
+    def vacuum(self, conn, pages=None):
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if before < VACUUM_MIN_FREE_PAGES and pages is None:
+            return {"released": 0}
+        # incremental_vacuum frees one page per step, and execute() steps a statement without
+        # result columns only once; executescript runs it to the end
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages or VACUUM_PAGES)})")
+        released = before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        VACUUMED_PAGES.inc(max(released, 0))
+        return {"released": released}
+
+    def convert(self, conn):
+        """One full VACUUM that switches an older database to auto_vacuum=INCREMENTAL."""
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return {"converted": False}
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return {"converted": conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2}
+
+    def optimize(self, conn):
+        conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+            conn.execute("ANALYZE")
+        else:
+            # 0x10000: look at every table, not only the ones this connection has queried (SQLite 3.46+)
+            conn.execute("PRAGMA optimize = 0x10002")
+        self._optimized_at = time.time()
+        return {}
+
+    # --- Schedule ---
+
+    def tick(self, now=None):
+        """One poll: refreshes the gauges and, when the database is quiet, runs what is due."""
+        now = time.time() if now is None else now
+        conn = self._connection()
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            if self._data_version is not None:
+                self._changed_at = now
+                self._checkpointed = False
+            self._data_version = version
+        stats = storage_stats(conn, self.path)
+        DB_BYTES.set(stats["file_bytes"])
+        WAL_BYTES.set(stats["wal_bytes"])
+        DB_PAGES.set(stats["pages"])
+        FREELIST_PAGES.set(stats["freelist_pages"])
+        if now - self._changed_at < self.quiet:
+            return {}
+
+        done = {}
+        if not self._checkpointed and stats["journal_mode"] == "wal":
+            done["checkpoint"] = self._run_task("checkpoint", self.checkpoint)
+            self._checkpointed = done["checkpoint"] is not None and not done["checkpoint"]["busy"]
+        if stats["freelist_pages"] >= VACUUM_MIN_FREE_PAGES and stats["auto_vacuum"] == 2:
+            done["vacuum"] = self._run_task("vacuum", self.vacuum)
+        if now - self._optimized_at >= self.optimize_interval:
+            done["optimize"] = self._run_task("optimize", self.optimize)
+        if any(done.values()):
+            logger.info(f"Maintenance: {done}")
+        return done
+
+    def start(self):
+        if not ENABLED or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="db-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Maintenance pass failed: {e}")
+
+
+scheduler = Maintenance()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SQLite maintenance for the splitopus database")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="file, WAL and freelist sizes")
+    run = sub.add_parser("run", help="checkpoint, incremental vacuum and optimize now")
+    run.add_argument("--vacuum-pages", type=int, help=f"pages to release (default {VACUUM_PAGES}, 0 = all free)")
+    sub.add_parser("convert", help="switch an older database to auto_vacuum=INCREMENTAL (one full VACUUM)")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(db.DB_PATH):
+        print(f"{db.DB_PATH} does not exist", file=sys.stderr)
+        return 1
+    maintenance = Maintenance()
+    conn = maintenance._connection()
+    if args.command == "convert":
+        # VACUUM needs the database to itself for a moment: wait for the bot's and API's writes
+        conn.execute("PRAGMA busy_timeout = 30000")
+        print(f"convert: {maintenance._run_task('convert', maintenance.convert)}")
+    if args.command == "run":
+        print(f"checkpoint: {maintenance._run_task('checkpoint', maintenance.checkpoint)}")
+        if args.vacuum_pages is not None:
+            # incremental_vacuum(0) releases the whole freelist
+            print(f"vacuum: {maintenance._run_task('vacuum', lambda c: maintenance.vacuum(c, args.vacuum_pages or -1))}")
+        else:
+            print(f"vacuum: {maintenance._run_task('vacuum', maintenance.vacuum)}")
+        print(f"optimize: {maintenance._run_task('optimize', maintenance.optimize)}")
+    for key, value in storage_stats(conn).items():
+        print(f"{key:<16} {value}")
+    conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
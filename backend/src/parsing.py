@@ -0,0 +1,366 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from dataclasses import dataclass, replace
+from typing import Optional
+
+from . import metrics, tracing
+
+try:
+    import openai
+except ImportError:  # only the LLM stage needs it
+    openai = None
+
+# --- Expense Text Parsing ---
+# Текст сообщения -> сумма, валюта, описание, категория, "на себя". Этапы идут по
+# порядку: сначала регулярки для частых форм ("500 обед", "1.2k такси", "обед 500 на
+# себя"), потом, если включена, LLM (OpenAI или локальная модель с тем же API).
+# Сумма берётся только в начале сообщения или в конце; в конце — если рядом есть валюта,
+# множитель или слово категории, иначе "встретимся в 7" тоже стало бы тратой.
+# Результат кэшируется по нормализованному тексту, так что повторная фраза ничего не
+# стоит, а медленный этап ограничен бюджетом времени и не держит обработку апдейта.
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = int(os.getenv("PARSE_CACHE_SIZE", "4096"))
+# Longer messages are not expenses (and not worth a model call)
+MAX_LENGTH = 200
+# How long handle_text waits for a slow stage; a late result still lands in the cache
+BUDGET_MS = float(os.getenv("PARSE_BUDGET_MS", "2500"))
+
+LLM_ENABLED = os.getenv("PARSE_LLM", "1") != "0"
+LLM_MODEL = os.getenv("PARSE_LLM_MODEL", "gpt-4o-mini")
+# OpenAI-compatible server for a local model (llama.cpp, Ollama: http://localhost:11434/v1)
+LLM_BASE_URL = os.getenv("PARSE_LLM_BASE_URL")
+LLM_TIMEOUT_S = float(os.getenv("PARSE_LLM_TIMEOUT_S", "10"))
+
+PARSES = metrics.counter(
+    "splitopus_parse_total", "Expense texts by the stage that answered (cache, regex, llm, none, failed, timeout)", ["stage"])
+LLM_SECONDS = metrics.histogram(
+    "splitopus_parse_llm_seconds", "Latency of the LLM parsing stage",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10))
+
+
+@dataclass(frozen=True)
+class ParsedExpense:
+    amount: float
+    description: Optional[str] = None  # None: the text had only the amount
+    category: Optional[str] = None     # logic.CATEGORIES key when the text names one
+    people: Optional[int] = None       # "на себя" -> 1: only the payer's share
+    stage: str = "regex"
+    currency: Optional[str] = None     # ISO code when the text names one ("300 бат" -> THB)
+
+
+class ParseTimeout(Exception):
+    """A slow stage did not answer within the budget; asking again later hits the cache."""
+
+
+def normalize(text):
+    """Cache key: lowercased, ё -> е, whitespace collapsed."""
+    return " ".join(text.lower().replace("ё", "е").split())
+
+
+# --- Regex Stage ---
+
+_MULTIPLIERS = {"k": 1000, "к": 1000, "тыс": 1000, "тыс.": 1000, "тысяч": 1000, "тысячи": 1000, "тысяча": 1000}
+# Not after ":" or a letter ("12:30 500" is not 30 500), not glued to a letter ("1e5")
+# unless that is a multiplier or a currency, not a time ("12:30")
+_AMOUNT = re.compile(
+    r"(?<![\w.,:/-])(?:(?P<prefix>[$€₽])\s?)?"
+    r"(?P<number>\d{1,3}(?:[  ]\d{3})+(?![\d.,])|\d+(?:[.,]\d+)?)"
+    r"(?:\s*(?P<mult>k|к|тыс\.?|тысяч[аи]?)(?!\w))?"
+    r"(?:\s*(?P<currency>₽|р\.?|руб\.?|рублей|бат|бата|thb|\$|usd|доллар(?:ов|а)?|€|eur|евро|aed|дирхам\w*)(?![\w]))?"
+    r"(?![\w:/])",
+    re.IGNORECASE)
+_CURRENCIES = {"₽": "RUB", "р": "RUB", "р.": "RUB", "руб": "RUB", "руб.": "RUB", "рублей": "RUB",
+               "бат": "THB", "бата": "THB", "thb": "THB", "$": "USD", "usd": "USD", "доллар": "USD",
+               "долларов": "USD", "доллара": "USD", "€": "EUR", "eur": "EUR", "евро": "EUR", "aed": "AED"}
+# "на себя" turns the split into the payer's family only. "на троих" is not applied: the
+# split menu picks members, and a bare count cannot say which ones
+_SELF = re.compile(r"(?<!\w)на\s+(?:себя|одного(?:\s*(?:человека|чел\.?))?)(?!\w)", re.IGNORECASE)
+# "обед 500 на троих": the count may follow a trailing amount and stays in the description
+_HEADCOUNT = re.compile(
+    r"(?<!\w)на\s+(?:двоих|троих|четверых|пятерых|шестерых|семерых|восьмерых|\d{1,2}(?:\s*(?:человек[а]?|чел\.?))?)$",
+    re.IGNORECASE)
+# Word stems -> category; the first word of the description that matches wins
+CATEGORY_STEMS = (
+    ("FOOD", ("обед", "ужин", "завтрак", "кафе", "ресторан", "еда", "еду", "перекус", "пицц", "суши",
+              "кофе", "бургер", "шаурм", "ланч", "lunch", "dinner", "breakfast", "food", "cafe", "coffee")),
+    ("ALCOHOL", ("пиво", "пива", "вино", "вина", "бар", "коктейл", "виски", "beer", "wine")),
+    ("TRANSPORT", ("такси", "метро", "автобус", "бензин", "поезд", "самолет", "байк", "скутер",
+                   "grab", "bolt", "uber", "taxi")),
+    ("SHOP", ("продукт", "магазин", "супермаркет", "рынок", "shop", "market")),
+    ("HOME", ("отель", "гостиниц", "жилье", "квартир", "хостел", "airbnb", "hotel")),
+    ("FUN", ("кино", "экскурс", "музей", "массаж", "дайвинг", "парк")),
+)
+_SEPARATORS = " \t-—–:;,."
+
+
+def _category(description):
+    for word in normalize(description).split():
+        for key, stems in CATEGORY_STEMS:
+            if word.startswith(stems):
+                return key
+    return None
+
+
+class RegexStage:
+    """
+    Amount with optional k / тыс multiplier and currency at the start of the text, or at
+    its end when a currency, a multiplier or a category word comes with it.
+    """
+
+    name = "regex"
+    slow = False
+
+    def __call__(self, text):
+        text = " ".join(text.split())
+        people = None
+        p = _SELF.search(text)
+        if p:
+            people = 1
+            text = " ".join((text[:p.start()] + " " + text[p.end():]).split())
+        head = _HEADCOUNT.search(text)
+        end = head.start() if head else len(text)
+        matches = [m for m in _AMOUNT.finditer(text) if m.end() <= end]
+        if not matches:
+            return None
+        # Several numbers ("2 пива 300"): the leading one, as the bot always did, else the last
+        m = matches[0]
+        if m.start() != 0:
+            m = matches[-1]
+            if text[m.end():end].strip(_SEPARATORS):
+                return None
+        amount = float(re.sub(r"[\s\u00a0]", "", m.group("number")).replace(",", "."))
+        amount *= _MULTIPLIERS.get((m.group("mult") or "").lower(), 1)
+        if not math.isfinite(amount) or amount <= 0:
+            return None
+
+        description = " ".join((text[:m.start()] + " " + text[m.end():]).split()).strip(_SEPARATORS) or None
+        category = _category(description) if description else None
+        currency = (m.group("currency") or m.group("prefix") or "").lower()
+        if m.start() != 0 and not (category or currency or m.group("mult")):
+            # "привет, нас будет 5", "встретимся в 7": a bare trailing number is not an expense
+            return None
+        return ParsedExpense(amount=amount, description=description, category=category,
+                             people=people, stage=self.name,
+                             currency=_CURRENCIES.get(currency, "AED" if currency.startswith("дирхам") else None))
+
+
+# --- LLM Stage ---
+
+LLM_PROMPT = (
+    "You extract a shared expense from a short chat message (usually Russian). "
+    "Reply with JSON only: {\"amount\": number or null, \"description\": string, "
+    "\"category\": one of FOOD, ALCOHOL, TRANSPORT, SHOP, FUN, HOME, OTHER, "
+    "\"people\": 1 if the payer spent only on themselves (\"на себя\"), else null, "
+    "\"currency\": ISO 4217 code if the message names a currency, else null}. "
+    "amount is null when the message is not an expense. Keep the description short, "
+    "in the language of the message, without the amount."
+)
+# Cheap gate before a model call: digits or a Russian number word somewhere in the text
+_NUMBER_HINT = re.compile(
+    r"\d|сто|двест|трист|четырест|пятьсот|шестьсот|семьсот|восемьсот|девятьсот|тысяч|полтор|"
+    r"десят|двадцат|тридцат|сорок|пятьдесят|шестьдесят|семьдесят|восемьдесят|девяносто",
+    re.IGNORECASE)
+
+
+def openai_complete(system, text):
+    """prompt -> reply text through the OpenAI client (also fits local OpenAI-compatible servers)."""
+    client = _openai_client()
+    response = client.chat.completions.create(
+        model=LLM_MODEL, temperature=0, max_tokens=100,
+        messages=[{"role": "system", "content": system}, {"role": "user", "content": text}])
+    return response.choices[0].message.content or ""
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _openai_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = openai.OpenAI(
+                    api_key=os.getenv("OPENAI_API_KEY") or "local",
+                    base_url=LLM_BASE_URL, timeout=LLM_TIMEOUT_S, max_retries=0)
+    return _client
+
+
+class LLMStage:
+    """
+    Any `complete(system, text) -> str` callable: openai_complete by default, a stub in
+    benchmarks or when trying other models.
+    """
+
+    name = "llm"
+    slow = True
+
+    def __init__(self, complete=None):
+        self.complete = complete or openai_complete
+
+    def __call__(self, text):
+        if not _NUMBER_HINT.search(text):
+            return None
+        start = time.perf_counter()
+        try:
+            reply = self.complete(LLM_PROMPT, text)
+        finally:
+            LLM_SECONDS.observe(time.perf_counter() - start)
+        return self.from_reply(reply)
+
+    def from_reply(self, reply):
+        match = re.search(r"\{.*\}", reply or "", re.DOTALL)
+        if not match:
+            return None
+        try:
+            data = json.loads(match.group(0))
+            amount = float(data.get("amount") or 0)
+        except (ValueError, TypeError, AttributeError):
+            return None
+        if not math.isfinite(amount) or amount <= 0:
+            return None
+        category = str(data.get("category") or "").upper()
+        people = data.get("people")
+        return ParsedExpense(
+            amount=amount,
+            description=str(data.get("description") or "").strip() or None,
+            category=category if category in dict(CATEGORY_STEMS) else None,
+            people=1 if people == 1 else None,
+            stage=self.name,
+            currency=currency_code(data.get("currency")))
+
+
+def currency_code(value):
+    code = str(value or "").strip().upper()
+    return code if re.fullmatch(r"[A-Z]{3}", code) else None
+
+
+def llm_available():
+    return LLM_ENABLED and openai is not None and bool(os.getenv("OPENAI_API_KEY") or LLM_BASE_URL)
+
+
+# --- Pipeline ---
+
+_MISS = object()
+
+
+class Pipeline:
+    """Stages in order, an LRU of results by normalized text, a time budget for slow stages."""
+
+    def __init__(self, stages, cache_size=CACHE_SIZE, budget_ms=BUDGET_MS):
+        self.stages = list(stages)
+        self.cache_size = cache_size
+        self.budget = budget_ms / 1000
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> Future of a slow stage
+        self._executor = None
+
+    def parse(self, text):
+        """ParsedExpense, None when the text is not an expense, or raises ParseTimeout."""
+        key = normalize(text or "")
+        if not key or len(key) > MAX_LENGTH:
+            return None
+        cached = self._get(key)
+        if cached is not _MISS:
+            PARSES.inc(stage="cache")
+            return _restore_case(cached, text)
+
+        deadline = time.perf_counter() + self.budget
+        failed = False
+        for stage in self.stages:
+            if stage.slow:
+                with tracing.span(f"parse.{stage.name}"):
+                    try:
+                        result = self._run_slow(stage, key, text, deadline)
+                    except ParseTimeout:
+                        raise
+                    except Exception as e:
+                        logger.error(f"Parse stage {stage.name} failed: {e}")
+                        failed, result = True, None
+            else:
+                result = stage(text)
+            if result is not None:
+                self._put(key, result)
+                PARSES.inc(stage=stage.name)
+                return result
+        # A failed model call says nothing about the text: the next message asks again
+        if not failed:
+            self._put(key, None)
+        PARSES.inc(stage="failed" if failed else "none")
+        return None
+
+    def _run_slow(self, stage, key, text, deadline):
+        submitted = False
+        with self._lock:
+            future = self._pending.get((stage.name, key))
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="parse")
+                future = self._executor.submit(stage, text)
+                self._pending[(stage.name, key)] = future
+                submitted = True
+        if submitted:
+            # Outside the lock: a future that is already done runs the callback right here
+            future.add_done_callback(lambda f: self._finish_slow(stage.name, key, f))
+        try:
+            return future.result(timeout=max(0.0, deadline - time.perf_counter()))
+        except FutureTimeout:
+            PARSES.inc(stage="timeout")
+            raise ParseTimeout(f"{stage.name} stage over {self.budget * 1000:.0f} ms") from None
+
+    def _finish_slow(self, name, key, future):
+        with self._lock:
+            self._pending.pop((name, key), None)
+        # Late answers are kept, so the same text asked again is instant
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            self._put(key, future.result())
+
+    def _get(self, key):
+        with self._lock:
+            if key not in self._cache:
+                return _MISS
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+    def _put(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+
+def _restore_case(result, text):
+    """A cached result came from a differently cased text: take the description from this one."""
+    if result is None or not result.description or result.stage != "regex":
+        return result
+    flat = " ".join(text.split())
+    i = flat.lower().replace("ё", "е").find(result.description.lower().replace("ё", "е"))
+    if i < 0:
+        return result
+    return replace(result, description=flat[i:i + len(result.description)])
+
+
+def default_stages():
+    return [RegexStage()] + ([LLMStage()] if llm_available() else [])
+
+
+pipeline = Pipeline(default_stages())
+
+
+def parse(text):
+    return pipeline.parse(text)
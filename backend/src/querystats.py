@@ -0,0 +1,234 @@
+import contextvars
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+
+from . import metrics
+
+# --- SQL Instrumentation ---
+# Все подключения db.get_connection / api.get_db создаются с factory=InstrumentedConnection.
+# Каждый запрос замеряется и сводится к "отпечатку" (литералы -> ?), а апдейт бота или
+# HTTP-запрос открывает scope: в конце видно, сколько SQL он сделал и не было ли N+1.
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("QUERY_STATS", "1") != "0"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# Same statement repeated this many times inside one update/request is reported as N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "5"))
+# Updates/requests above this many statements are logged even without a repeat
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "30"))
+
+DB_SECONDS = metrics.histogram("splitopus_db_seconds", "SQL time per update/request", ["scope"])
+DB_QUERIES = metrics.histogram(
+    "splitopus_db_queries", "SQL statements per update/request", ["scope"], buckets=(1, 2, 5, 10, 20, 50, 100, 200))
+SLOW_QUERIES = metrics.counter("splitopus_db_slow_queries_total", "Statements slower than SLOW_QUERY_MS")
+N_PLUS_ONE = metrics.counter("splitopus_db_n_plus_one_total", "Updates/requests with a repeated statement", ["scope"])
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """Normalizes a statement so the same query with different values groups together."""
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = _IN_LIST.sub("(...)", sql)
+    return _SPACE.sub(" ", sql).strip()
+
+
+class QueryScope:
+    """Statements run while handling one update or request."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+
+    def repeated(self, threshold=None):
+        threshold = threshold or N_PLUS_ONE_THRESHOLD
+        return [(fp, n) for fp, n in self.fingerprints.most_common() if n >= threshold]
+
+
+_current = contextvars.ContextVar("query_scope", default=None)
+
+# Process-wide totals per fingerprint: [count, total seconds, max seconds]
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def current_scope():
+    return _current.get()
+
+
+def record(sql, seconds):
+    fp = fingerprint(sql)
+    scope = _current.get()
+    if scope is not None:
+        scope.count += 1
+        scope.seconds += seconds
+        scope.fingerprints[fp] += 1
+    with _totals_lock:
+        entry = _totals.get(fp)
+        if entry is None:
+            _totals[fp] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        SLOW_QUERIES.inc()
+        where = scope.name if scope is not None else "-"
+        logger.warning(f"Slow query {seconds * 1000:.1f} ms [{where}]: {fp}")
+
+
+@contextmanager
+def scope(name):
+    """Tags every statement run inside the block (same thread or copied context) with name."""
+    if not ENABLED:
+        yield None
+        return
+    qs = QueryScope(name)
+    token = _current.set(qs)
+    try:
+        yield qs
+    finally:
+        _current.reset(token)
+        report(qs)
+
+
+def report(qs):
+    DB_SECONDS.observe(qs.seconds, scope=qs.name)
+    DB_QUERIES.observe(qs.count, scope=qs.name)
+    repeated = qs.repeated()
+    if repeated:
+        N_PLUS_ONE.inc(scope=qs.name)
+    for fp, n in repeated:
+        logger.warning(f"N+1 in {qs.name}: {n}x {fp}")
+    if repeated or qs.count > QUERY_BUDGET:
+        logger.warning(f"{qs.name}: {qs.count} queries, {qs.seconds * 1000:.1f} ms in SQL")
+    else:
+        logger.debug(f"{qs.name}: {qs.count} queries, {qs.seconds * 1000:.1f} ms in SQL")
+
+
+def top(n=20, key="total"):
+    """The n heaviest fingerprints as dicts, by total time ('total'), 'count' or 'max'."""
+    index = {"count": 0, "total": 1, "max": 2}[key]
+    with _totals_lock:
+        items = sorted(_totals.items(), key=lambda kv: kv[1][index], reverse=True)[:n]
+    return [{"query": fp, "count": c, "total_ms": t * 1000, "max_ms": m * 1000} for fp, (c, t, m) in items]
+
+
+def reset():
+    with _totals_lock:
+        _totals.clear()
+
+
+# --- Instrumented sqlite3 classes ---
+# Connection.execute() creates its cursor in C without going through cursor(),
+# so both classes time their own execute* calls. For SELECTs this covers running
+# the statement up to the first row; fetching the rest is not included.
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record(sql, time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record("<script>", time.perf_counter() - start)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record(sql, time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record("<script>", time.perf_counter() - start)
+
+
+def connect(path):
+    """sqlite3.connect with instrumentation (plain connection when QUERY_STATS=0)."""
+    if not ENABLED:
+        return sqlite3.connect(path)
+    return sqlite3.connect(path, factory=InstrumentedConnection)
+
+
+# --- Scope names ---
+
+def update_name(u, commands=None):
+    """
+    'msg:/start', 'msg:text' or 'cb:MENU_BALANCE' (callback args after '|' dropped).
+    Commands not in `commands` become 'msg:/other', so typos don't create new series.
+    """
+    if 'message' in u:
+        text = u['message'].get('text', '')
+        if not text.startswith('/'):
+            return "msg:text"
+        cmd = text.split()[0].split('@')[0]
+        return f"msg:{cmd}" if commands is None or cmd in commands else "msg:/other"
+    if 'callback_query' in u:
+        return f"cb:{u['callback_query'].get('data', '').split('|')[0]}"
+    return "update"
+
+
+class QueryStatsMiddleware:
+    """Opens a scope per HTTP request, named after the matched route once routing is done."""
+
+    def __init__(self, app, skip_paths=("/metrics",)):
+        self.app = app
+        self.skip_paths = set(skip_paths)
+
+    async def __call__(self, scope_, receive, send):
+        if scope_["type"] != "http" or not ENABLED or scope_["path"] in self.skip_paths:
+            await self.app(scope_, receive, send)
+            return
+        with scope(f"{scope_['method']} {scope_['path']}") as qs:
+            try:
+                await self.app(scope_, receive, send)
+            finally:
+                route = scope_.get("route")
+                if route is not None and getattr(route, "path", None):
+                    qs.name = f"{scope_['method']} {route.path}"
@@ -0,0 +1,85 @@
+import os
+import threading
+from collections import OrderedDict
+
+from . import logic, metrics
+
+# --- Render Cache ---
+# Клавиатуры, которые не зависят от данных, собираются один раз при импорте. Экраны,
+# которые зависят (баланс, моя статистика, история трат, меню поездки), кэшируются по
+# (экран, trip_id, версия поездки, мастер смотрящего, страница): версия меняется при
+# любой правке поездки, её участников и их имён/привязок (trip_changes), так что
+# повторный тап по неизменной поездке не читает трат из базы и не форматирует отчёт.
+# Готовые клавиатуры общие — их нельзя менять на месте.
+
+SCREEN_CACHE_SIZE = int(os.getenv("SCREEN_CACHE_SIZE", "512"))
+
+RENDERS = metrics.counter("splitopus_render_cache_total", "Cached screen lookups by screen and result", ["screen", "result"])
+
+
+BACK_TO_TRIP = {"inline_keyboard": [[{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}]]}
+
+DASHBOARD_KEYBOARD = {"inline_keyboard": [
+    [{"text": "📊 Баланс", "callback_data": "MENU_BALANCE"}, {"text": "👤 Моя статистика", "callback_data": "MENU_ME"}],
+    [{"text": "💸 Вернуть долг", "callback_data": "MENU_REPAY"}, {"text": "🎲 Рулетка", "callback_data": "MENU_ROULETTE"}],
+    [{"text": "📜 История трат", "callback_data": "MENU_ALL_EXPENSES"}],
+    [{"text": "📝 Заметки", "callback_data": "MENU_NOTES"}, {"text": "💾 Скачать отчет", "callback_data": "MENU_EXPORT"}],
+    [{"text": "🔙 Назад к списку", "callback_data": "MENU_TRIPS"}, {"text": "📖 Инструкция", "callback_data": "SHOW_HELP"}],
+]}
+
+BALANCE_KEYBOARD = {"inline_keyboard": [
+    [{"text": "⚙️ Сделать расчет", "callback_data": "MENU_SETTLE"}],
+    [{"text": "🔙 К меню поездки", "callback_data": "OPEN_DASHBOARD"}],
+]}
+
+# Category buttons two per row (no REPAYMENT: that one comes from the repay flow)
+CATEGORY_LAYOUT = []
+for _key, _label in logic.CATEGORIES.items():
+    if _key == "REPAYMENT":
+        continue
+    if not CATEGORY_LAYOUT or len(CATEGORY_LAYOUT[-1]) == 2:
+        CATEGORY_LAYOUT.append([])
+    CATEGORY_LAYOUT[-1].append(_label)
+CATEGORY_LAYOUT = tuple(tuple(row) for row in CATEGORY_LAYOUT)
+CATEGORY_BY_LABEL = {label: key for key, label in logic.CATEGORIES.items()}
+
+
+def category_keyboard(draft_id):
+    return {"inline_keyboard": [[{"text": label, "callback_data": f"CAT|{draft_id}|{label}"} for label in row]
+                                for row in CATEGORY_LAYOUT]}
+
+
+class ScreenCache:
+    """LRU of (text, reply_markup) by (screen, trip_id, version, viewer, page)."""
+
+    def __init__(self, size=SCREEN_CACHE_SIZE):
+        self.size = size
+        self._screens = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, screen, trip_id, version, build, viewer=None, page=0):
+        """build() -> (text, reply_markup) runs only when this version was not rendered yet."""
+        if version is None or not self.size:
+            return build()
+        key = (screen, trip_id, version, viewer, page)
+        with self._lock:
+            cached = self._screens.get(key)
+            if cached is not None:
+                self._screens.move_to_end(key)
+        if cached is not None:
+            RENDERS.inc(screen=screen, result="hit")
+            return cached
+        RENDERS.inc(screen=screen, result="miss")
+        result = build()
+        with self._lock:
+            self._screens[key] = result
+            while len(self._screens) > self.size:
+                self._screens.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._screens.clear()
+
+
+screens = ScreenCache()
@@ -18,6 +18,8 @@ CREATE TABLE IF NOT EXISTS trips (
     name TEXT,                    -- Название ("Тай 2026")
     rate REAL DEFAULT 0,          -- Курс валюты к рублю
     currency TEXT DEFAULT 'THB',  -- Валюта поездки
+    version INTEGER DEFAULT 0,    -- Растет при каждом изменении трат/участников/заметок (= seq последнего изменения в trip_changes)
+    archived_at INTEGER,          -- Поездка в архиве: траты и заметки в файле (см. trip_archive, src/archive.py)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY(creator_id) REFERENCES users(id)
 );
@@ -32,6 +34,8 @@ CREATE TABLE IF NOT EXISTS trip_members (
     FOREIGN KEY(trip_id) REFERENCES trips(id),
     FOREIGN KEY(user_id) REFERENCES users(id)
 );
+-- Поездки пользователя (/api/users/{id}/summary, get_user_trips)
+CREATE INDEX IF NOT EXISTS idx_trip_members_user ON trip_members(user_id);
 
 -- Таблица расходов
 CREATE TABLE IF NOT EXISTS expenses (
@@ -50,6 +54,15 @@ CREATE TABLE IF NOT EXISTS expenses (
     -- Для начала, чтобы не усложнять миграцию, сохраним split как JSON-текст.
     -- Это компромисс, но рабочий для нашего масштаба.
     split_json TEXT,                      -- Например: '{"5976186394": 500, "12345": 500}'
+
+    -- Трата в другой валюте: amount и split_json уже в валюте поездки (src/fx.py)
+    currency TEXT,                        -- В чем платили (NULL — в валюте поездки)
+    original_amount REAL,                 -- Сумма в этой валюте
+    fx_rate REAL,                         -- amount = original_amount * fx_rate
+
+    -- Правки и удаление (история — в expense_audit)
+    updated_at INTEGER,
+    deleted_at INTEGER,                   -- Удалена: не видна нигде, в синке — как tombstone
     
     FOREIGN KEY(trip_id) REFERENCES trips(id),
     FOREIGN KEY(payer_id) REFERENCES users(id)
@@ -74,5 +87,87 @@ CREATE TABLE IF NOT EXISTS drafts (
     description TEXT,
     category TEXT,
     selected_users_json TEXT, -- JSON со списком выбранных участников
+    created_at INTEGER,
+    currency TEXT             -- Валюта суммы, если не валюта поездки
+);
+
+
+-- Журнал изменений поездок (для дельта-синхронизации Mini App)
+-- Пишется в той же транзакции, что и само изменение. seq монотонно растет.
+CREATE TABLE IF NOT EXISTS trip_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    trip_id TEXT,
+    entity TEXT,                  -- expense / note / member / trip
+    entity_id TEXT,
+    op TEXT,                      -- upsert / delete
+    created_at INTEGER,
+    FOREIGN KEY(trip_id) REFERENCES trips(id)
+);
+CREATE INDEX IF NOT EXISTS idx_trip_changes_trip ON trip_changes(trip_id, seq);
+
+-- Предрасчитанная статистика (роллапы), обновляется в транзакции вставки траты.
+-- master_id — ключ сплита (доли хранятся по master id); '*' — итог категории по поездке.
+CREATE TABLE IF NOT EXISTS stats_by_category (
+    trip_id TEXT,
+    master_id TEXT,
+    category TEXT,
+    amount REAL DEFAULT 0,
+    expenses INTEGER DEFAULT 0,           -- Сколько трат вошло в сумму
+    PRIMARY KEY (trip_id, master_id, category)
+);
+
+-- Траты поездки по дням (локальная дата created_at), без возвратов долга
+CREATE TABLE IF NOT EXISTS stats_by_day (
+    trip_id TEXT,
+    day TEXT,                             -- YYYY-MM-DD
+    amount REAL DEFAULT 0,
+    expenses INTEGER DEFAULT 0,
+    PRIMARY KEY (trip_id, day)
+);
+
+-- Журнал правок и удалений трат: что было и что стало (JSON), кто и когда
+CREATE TABLE IF NOT EXISTS expense_audit (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    expense_id INTEGER,
+    trip_id TEXT,
+    op TEXT,                              -- edit / delete
+    user_id TEXT,                         -- Кто правил (NULL — неизвестно)
+    before_json TEXT,
+    after_json TEXT,                      -- NULL для delete
     created_at INTEGER
 );
+CREATE INDEX IF NOT EXISTS idx_expense_audit_expense ON expense_audit(expense_id, id);
+
+-- Сколько каждый заплатил и потратил в поездке (ключи как в payer_id и split_json, без
+-- схлопывания семей: привязки меняются, мастер определяется при чтении). Обновляется
+-- в транзакции вставки траты, как и роллапы; баланс = paid - owed.
+CREATE TABLE IF NOT EXISTS trip_balances (
+    trip_id TEXT,
+    user_id TEXT,
+    paid REAL DEFAULT 0,
+    owed REAL DEFAULT 0,
+    PRIMARY KEY (trip_id, user_id)
+);
+
+-- Архивные поездки: где лежат их траты и заметки и итоговые балансы на момент архивации
+CREATE TABLE IF NOT EXISTS trip_archive (
+    trip_id TEXT PRIMARY KEY,
+    archived_at INTEGER,
+    path TEXT,                            -- Имя файла в ARCHIVE_DIR
+    expenses INTEGER,
+    notes INTEGER,
+    bytes INTEGER,
+    total_spent REAL,
+    balances_json TEXT,                   -- {master_id: баланс}
+    FOREIGN KEY(trip_id) REFERENCES trips(id)
+);
+
+-- Курсы валют по дням: 1 base = rate quote (файлы, /fx, /setrate; см. src/fx.py)
+CREATE TABLE IF NOT EXISTS fx_rates (
+    day TEXT,                             -- YYYY-MM-DD
+    base TEXT,
+    quote TEXT,
+    rate REAL,
+    source TEXT,                          -- file / manual / setrate
+    PRIMARY KEY (base, quote, day)
+);
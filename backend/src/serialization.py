@@ -0,0 +1,146 @@
+import gzip
+import json
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, stdlib json is the fallback
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# --- Fast JSON Responses ---
+# split_json is already stored as JSON text. Wrapping it in RawJSON lets a list of
+# expenses be written out without json.loads + re-encoding every split dict.
+
+
+class RawJSON:
+    """An already-encoded JSON fragment that is emitted verbatim."""
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        self.raw = raw or "{}"
+
+
+def _orjson_default(obj):
+    if isinstance(obj, RawJSON):
+        return orjson.Fragment(obj.raw)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def _std_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+
+def _encode_std(obj):
+    if isinstance(obj, RawJSON):
+        return obj.raw
+    if isinstance(obj, dict):
+        if any(isinstance(v, (dict, list, tuple)) for v in obj.values()):
+            return "{" + ",".join(f"{_std_dumps(str(k))}:{_encode_std(v)}" for k, v in obj.items()) + "}"
+        raw = [(k, v) for k, v in obj.items() if isinstance(v, RawJSON)]
+        if not raw:
+            return _std_dumps(obj)
+        # Flat object (e.g. one expense): encode the plain part once, append the fragments
+        plain = _std_dumps({k: v for k, v in obj.items() if not isinstance(v, RawJSON)})
+        tail = ",".join(f"{_std_dumps(str(k))}:{v.raw}" for k, v in raw)
+        return plain[:-1] + ("," if len(plain) > 2 else "") + tail + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(map(_encode_std, obj)) + "]"
+    return _std_dumps(obj)
+
+
+def dumps(obj):
+    """Encodes obj to compact UTF-8 JSON bytes, splicing RawJSON fragments in as-is."""
+    if orjson is not None and hasattr(orjson, "Fragment"):
+        return orjson.dumps(obj, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+    return _encode_std(obj).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+
+# --- Compression ---
+
+COMPRESSIBLE_TYPES = ("application/json", "text/csv", "text/plain")
+# Bigger bodies are compressed in the threadpool so the event loop (and SSE streams) keep moving
+THREADPOOL_THRESHOLD = 64 * 1024
+
+
+def negotiate_encoding(accept_encoding):
+    accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6)
+
+
+class CompressionMiddleware:
+    """
+    gzip/brotli for complete (non-streaming) responses, chosen from Accept-Encoding.
+    Streaming bodies such as server-sent events are passed through untouched.
+    """
+
+    def __init__(self, app, minimum_size=1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            return await self.app(scope, receive, send)
+
+        start = None
+
+        async def send_wrapper(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            pending_start, start = start, None
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=list(pending_start["headers"]))
+            content_type = headers.get("content-type", "")
+            if (message.get("more_body", False) or "content-encoding" in headers
+                    or len(body) < self.minimum_size
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)):
+                await send(pending_start)
+                await send(message)
+                return
+
+            if len(body) >= THREADPOOL_THRESHOLD:
+                body = await run_in_threadpool(compress, body, encoding)
+            else:
+                body = compress(body, encoding)
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            # A strong ETag promises byte-identical bodies, which no longer holds per encoding
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["etag"] = f"W/{etag}"
+            await send({**pending_start, "headers": headers.raw})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -1,11 +1,153 @@
+import hashlib
 import json
 import logging
+import os
+import threading
 import time
+from collections import OrderedDict
+
 import requests
 
+from . import metrics, tracing
+
 # --- Logging Setup ---
 logger = logging.getLogger(__name__)
 
+# --- Metrics ---
+REQUEST_SECONDS = metrics.histogram(
+    "splitopus_telegram_request_seconds", "Telegram Bot API call latency per attempt", ["method"])
+RESPONSES = metrics.counter(
+    "splitopus_telegram_responses_total", "Telegram Bot API responses by HTTP status ('error' = network failure)",
+    ["method", "status"])
+RATE_LIMITED = metrics.counter("splitopus_telegram_rate_limited_total", "429 responses from Telegram", ["method"])
+WAIT_SECONDS = metrics.counter(
+    "splitopus_telegram_wait_seconds_total", "Time spent sleeping before Telegram calls", ["reason"])
+# Callers inside _request (waiting on the rate limiter, retrying or in flight)
+PENDING = metrics.gauge("splitopus_telegram_pending_requests", "Outbound Telegram calls not yet finished")
+EDITS = metrics.counter(
+    "splitopus_telegram_edits_total", "editMessageText calls by outcome (sent, coalesced, unchanged)", ["outcome"])
+
+# Edits of one message closer than this are merged into the latest one; 0 sends every edit
+EDIT_WINDOW_S = float(os.getenv("TELEGRAM_EDIT_WINDOW_MS", "400")) / 1000
+# How many messages we remember the on-screen content of (to skip no-op edits)
+EDIT_MEMORY = 4096
+
+
+def _fingerprint(payload):
+    markup = payload.get('reply_markup')
+    content = json.dumps([payload.get('text'), payload.get('parse_mode'), markup], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+
+class EditCoalescer:
+    """
+    editMessageText per (chat_id, message_id): the first edit goes out at once, edits
+    arriving within `window` after it are held and only the latest is sent when the
+    window ends. An edit that would leave the message as it already is is dropped.
+    """
+
+    def __init__(self, send, window=EDIT_WINDOW_S):
+        self.send = send  # payload -> response (None on failure)
+        self.window = window
+        self._pending = {}             # key -> [payload, due]
+        self._inflight = set()
+        self._last_sent = {}           # key -> monotonic time of the last send
+        self._on_screen = OrderedDict()  # key -> fingerprint of the last content sent
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def edit(self, payload):
+        key = (str(payload['chat_id']), payload['message_id'])
+        fp = _fingerprint(payload)
+        now = time.monotonic()
+        with self._cond:
+            if key in self._pending:
+                EDITS.inc(outcome="coalesced")
+                if self._on_screen.get(key) == fp and key not in self._inflight:
+                    del self._pending[key]  # tapped back to what is already shown
+                else:
+                    self._pending[key][0] = payload
+                return None
+            if self._on_screen.get(key) == fp and key not in self._inflight:
+                EDITS.inc(outcome="unchanged")
+                return None
+            held = key in self._inflight or now - self._last_sent.get(key, float("-inf")) < self.window
+            if held:
+                self._pending[key] = [payload, self._last_sent.get(key, now) + self.window]
+                self._cond.notify()
+            else:
+                self._inflight.add(key)
+        if held:
+            self._start()
+            return None
+        return self._deliver(key, payload, fp)
+
+    def flush(self, chat_id=None):
+        """Sends held edits now (of one chat, or all), e.g. before a new message to that chat."""
+        with self._cond:
+            keys = [k for k in self._pending if chat_id is None or k[0] == str(chat_id)]
+            due = [(k, self._pending.pop(k)[0]) for k in keys if k not in self._inflight]
+            self._inflight.update(k for k, _ in due)
+        for key, payload in due:
+            self._deliver(key, payload, _fingerprint(payload))
+
+    def forget(self, chat_id, message_id):
+        """The message is gone (deleted): drop what we know about it."""
+        key = (str(chat_id), message_id)
+        with self._cond:
+            self._pending.pop(key, None)
+            self._on_screen.pop(key, None)
+            self._last_sent.pop(key, None)
+
+    def _deliver(self, key, payload, fp):
+        try:
+            resp = self.send(payload)
+        finally:
+            with self._cond:
+                self._inflight.discard(key)
+                self._last_sent[key] = time.monotonic()
+                # Held edits are timed from the end of this send
+                if key in self._pending:
+                    self._pending[key][1] = self._last_sent[key] + self.window
+                    self._cond.notify()
+        EDITS.inc(outcome="sent")
+        with self._cond:
+            if resp is not None:
+                self._on_screen[key] = fp
+                self._on_screen.move_to_end(key)
+                while len(self._on_screen) > EDIT_MEMORY:
+                    old, _ = self._on_screen.popitem(last=False)
+                    self._last_sent.pop(old, None)
+            else:
+                self._on_screen.pop(key, None)
+        return resp
+
+    def _start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="telegram-edits", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    ready = [k for k, (_, due) in self._pending.items() if due <= now and k not in self._inflight]
+                    if ready:
+                        break
+                    waits = [due - now for k, (_, due) in self._pending.items() if k not in self._inflight]
+                    self._cond.wait(max(0.0, min(waits)) if waits else None)
+                due = [(k, self._pending.pop(k)[0]) for k in ready]
+                self._inflight.update(ready)
+            for key, payload in due:
+                try:
+                    self._deliver(key, payload, _fingerprint(payload))
+                except Exception as e:
+                    logger.error(f"Coalesced edit of {key} failed: {e}")
+
+
 class TelegramClient:
     def __init__(self, token):
         self.token = token
@@ -14,22 +156,36 @@ class TelegramClient:
         
         # --- Rate Limiting ---
         self.last_request_time = 0
+        self._throttle_lock = threading.Lock()
         self.min_interval = 0.05  # Global limit: ~20 req/s (max is 30)
+        self.edits = EditCoalescer(lambda payload: self._request("POST", "editMessageText", json_data=payload))
 
     def _request(self, method, endpoint, params=None, files=None, json_data=None):
         """
         Internal request wrapper with Rate Limiting and Retry logic.
         """
+        PENDING.inc()
+        try:
+            with tracing.span(f"telegram.{endpoint}"):
+                return self._send(method, endpoint, params, files, json_data)
+        finally:
+            PENDING.dec()
+
+    def _send(self, method, endpoint, params, files, json_data):
         url = f"{self.base_url}/{endpoint}"
         
-        # Simple Global Rate Limiting
-        elapsed = time.time() - self.last_request_time
-        if elapsed < self.min_interval:
-            time.sleep(self.min_interval - elapsed)
-        
-        self.last_request_time = time.time()
+        # Simple Global Rate Limiting. The polling thread and the telegram-edits thread both
+        # send: each reserves the next free slot under the lock, then sleeps outside it
+        with self._throttle_lock:
+            now = time.time()
+            wait = max(0.0, self.last_request_time + self.min_interval - now)
+            self.last_request_time = now + wait
+        if wait > 0:
+            time.sleep(wait)
+            WAIT_SECONDS.inc(wait, reason="throttle")
 
         for attempt in range(1, 4):  # Try 3 times
+            start = time.perf_counter()
             try:
                 if method == "GET":
                     resp = self.session.get(url, params=params, timeout=10)
@@ -37,12 +193,16 @@ class TelegramClient:
                     resp = self.session.post(url, json=json_data, data=params, files=files, timeout=10)
                 else:
                     raise ValueError(f"Unsupported method: {method}")
+                REQUEST_SECONDS.observe(time.perf_counter() - start, method=endpoint)
+                RESPONSES.inc(method=endpoint, status=resp.status_code)
 
                 # --- Handle Rate Limits (429) ---
                 if resp.status_code == 429:
                     retry_after = int(resp.headers.get("Retry-After", 1))
                     logger.warning(f"Rate limited by Telegram (429). Waiting {retry_after}s...")
+                    RATE_LIMITED.inc(method=endpoint)
                     time.sleep(retry_after + 0.5)  # Wait + buffer
+                    WAIT_SECONDS.inc(retry_after + 0.5, reason="retry_after")
                     continue
                 
                 # --- Handle Other Errors ---
@@ -57,6 +217,8 @@ class TelegramClient:
                 return resp.json()
 
             except requests.RequestException as e:
+                REQUEST_SECONDS.observe(time.perf_counter() - start, method=endpoint)
+                RESPONSES.inc(method=endpoint, status="error")
                 logger.error(f"Network error ({endpoint}): {e}")
                 time.sleep(1 * attempt) # Exponential backoff
         
@@ -72,13 +234,16 @@ class TelegramClient:
             # We use a longer timeout for getUpdates specifically
             url = f"{self.base_url}/getUpdates"
             resp = self.session.get(url, params=params, timeout=timeout + 5)
+            RESPONSES.inc(method="getUpdates", status=resp.status_code)
             if resp.status_code == 200:
                 return resp.json().get("result", [])
         except Exception as e:
+            RESPONSES.inc(method="getUpdates", status="error")
             logger.error(f"getUpdates failed: {e}")
         return []
 
     def send_message(self, chat_id, text, reply_markup=None, parse_mode="Markdown"):
+        self.edits.flush(chat_id)  # keep the chat's messages in the order they were made
         payload = {"chat_id": chat_id, "text": text, "parse_mode": parse_mode}
         if reply_markup:
             payload['reply_markup'] = json.dumps(reply_markup) if isinstance(reply_markup, dict) else reply_markup
@@ -88,9 +253,12 @@ class TelegramClient:
         payload = {"chat_id": chat_id, "message_id": message_id, "text": text, "parse_mode": parse_mode}
         if reply_markup:
             payload['reply_markup'] = json.dumps(reply_markup) if isinstance(reply_markup, dict) else reply_markup
-        return self._request("POST", "editMessageText", json_data=payload)
+        if self.edits.window <= 0:
+            return self._request("POST", "editMessageText", json_data=payload)
+        return self.edits.edit(payload)
 
     def delete_message(self, chat_id, message_id):
+        self.edits.forget(chat_id, message_id)
         return self._request("POST", "deleteMessage", json_data={"chat_id": chat_id, "message_id": message_id})
 
     def send_document(self, chat_id, file_path):
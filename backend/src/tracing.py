@@ -0,0 +1,314 @@
+import argparse
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# --- Tracing ---
+# Трейс на каждый process_update: дочерние спаны на вызовы db.*, logic.* и запросы
+# к Telegram. Медленные апдейты пишутся в JSONL, а `python -m src.tracing` рисует
+# водопад самых медленных — видно, куда ушло время: SQLite, Telegram или сам Python.
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("TRACING", "1") != "0"
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+# Only traces at least this slow are written out
+MIN_MS = float(os.getenv("TRACE_MIN_MS", "50"))
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join("data", "traces.jsonl"))
+# The file is rotated to TRACE_FILE + ".1" past this size
+MAX_FILE_BYTES = int(float(os.getenv("TRACE_FILE_MAX_MB", "20")) * 1024 * 1024)
+# Sampling profiler: stacks of the traced thread every PROFILE_INTERVAL_MS
+PROFILE = os.getenv("TRACE_PROFILE", "0") == "1"
+PROFILE_INTERVAL_MS = float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "5"))
+
+CATEGORIES = ("db", "telegram", "logic")
+
+_current = contextvars.ContextVar("trace", default=None)
+_write_lock = threading.Lock()
+
+
+class Trace:
+    """One traced unit of work; spans are a flat list of [name, parent, start, end, attrs]."""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.wall = time.time()
+        self.t0 = time.perf_counter()
+        self.spans = [[name, None, 0.0, None, {}]]
+        self.stack = [0]
+        self.profile = {}
+
+    def open(self, name, attrs=None):
+        self.spans.append([name, self.stack[-1], time.perf_counter() - self.t0, None, attrs or {}])
+        index = len(self.spans) - 1
+        self.stack.append(index)
+        return index
+
+    def close(self, index):
+        self.spans[index][3] = time.perf_counter() - self.t0
+        # An exception can skip inner closes; unwind to this span
+        if index in self.stack:
+            while self.stack[-1] != index:
+                self.stack.pop()
+            self.stack.pop()
+
+    @property
+    def duration_ms(self):
+        end = self.spans[0][3]
+        return (end if end is not None else time.perf_counter() - self.t0) * 1000
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "ts": self.wall,
+            "duration_ms": round(self.duration_ms, 3),
+            "attrs": self.attrs,
+            "spans": [
+                {"name": name, "parent": parent, "start_ms": round(start * 1000, 3),
+                 "duration_ms": round(((end if end is not None else start) - start) * 1000, 3), "attrs": attrs}
+                for name, parent, start, end, attrs in self.spans
+            ],
+            "profile": self.profile,
+        }
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def trace(name, **attrs):
+    """Root span. Sampled by TRACE_SAMPLE_RATE; exported when slower than TRACE_MIN_MS."""
+    if not ENABLED or (SAMPLE_RATE < 1.0 and random.random() >= SAMPLE_RATE) or _current.get() is not None:
+        yield None
+        return
+    t = Trace(name, attrs)
+    token = _current.set(t)
+    if PROFILE:
+        _sampler().add(t)
+    try:
+        yield t
+    except Exception as e:
+        t.attrs["error"] = repr(e)
+        raise
+    finally:
+        t.spans[0][3] = time.perf_counter() - t.t0
+        _current.reset(token)
+        if PROFILE:
+            _sampler().remove(t)
+        if t.duration_ms >= MIN_MS:
+            export(t)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Child span of the current trace; a no-op outside of one."""
+    t = _current.get()
+    if t is None:
+        yield
+        return
+    index = t.open(name, attrs)
+    try:
+        yield
+    finally:
+        t.close(index)
+
+
+def traced(name, fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t = _current.get()
+        if t is None:
+            return fn(*args, **kwargs)
+        index = t.open(name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            t.close(index)
+    wrapper.__traced__ = True
+    return wrapper
+
+
+def instrument_module(module, prefix=None, names=None, exclude=()):
+    """
+    Replaces the module's public functions with traced wrappers. Callers going through
+    the module attribute (db.get_user(...)) are covered; names imported with
+    `from module import f` before this call are not.
+    """
+    prefix = prefix or module.__name__.rsplit(".", 1)[-1]
+    for attr, fn in list(vars(module).items()):
+        if names is not None and attr not in names:
+            continue
+        if attr.startswith("_") or attr in exclude or not inspect.isfunction(fn):
+            continue
+        if fn.__module__ != module.__name__ or getattr(fn, "__traced__", False):
+            continue
+        setattr(module, attr, traced(f"{prefix}.{attr}", fn))
+
+
+# --- Export ---
+
+def export(t):
+    line = json.dumps(t.to_dict(), ensure_ascii=False, separators=(",", ":"), default=str)
+    try:
+        with _write_lock:
+            directory = os.path.dirname(TRACE_FILE)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > MAX_FILE_BYTES:
+                os.replace(TRACE_FILE, TRACE_FILE + ".1")
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except OSError as e:
+        logger.error(f"Trace export failed: {e}")
+
+
+# --- Sampling Profiler ---
+
+class _Sampler(threading.Thread):
+    """Samples the stacks of threads that are inside a trace; idle otherwise."""
+
+    def __init__(self, interval):
+        super().__init__(name="trace-sampler", daemon=True)
+        self.interval = interval
+        self.active = {}  # thread ident -> Trace
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def add(self, t):
+        with self.lock:
+            self.active[threading.get_ident()] = t
+        self.wakeup.set()
+
+    def remove(self, t):
+        with self.lock:
+            if self.active.get(threading.get_ident()) is t:
+                del self.active[threading.get_ident()]
+            if not self.active:
+                self.wakeup.clear()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                active = list(self.active.items())
+            for ident, t in active:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and len(stack) < 64:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                t.profile[key] = t.profile.get(key, 0) + 1
+
+
+_sampler_instance = None
+_sampler_lock = threading.Lock()
+
+
+def _sampler():
+    global _sampler_instance
+    if _sampler_instance is None:
+        with _sampler_lock:
+            if _sampler_instance is None:
+                _sampler_instance = _Sampler(PROFILE_INTERVAL_MS / 1000)
+                _sampler_instance.start()
+    return _sampler_instance
+
+
+# --- Waterfall CLI ---
+
+def load(path):
+    traces = []
+    for p in (path + ".1", path):
+        if not os.path.exists(p):
+            continue
+        with open(p, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        traces.append(json.loads(line))
+                    except ValueError:
+                        pass  # a line cut short by a crash
+    return traces
+
+
+def breakdown(t):
+    """ms per category, counting only the outermost span of a category; the rest is Python."""
+    spans = t["spans"]
+    totals = {c: 0.0 for c in CATEGORIES}
+
+    def category(s):
+        c = s["name"].split(".", 1)[0]
+        return c if c in totals else None
+
+    for s in spans[1:]:
+        c = category(s)
+        if c is None:
+            continue
+        parent = s["parent"]
+        while parent is not None and category(spans[parent]) != c:
+            parent = spans[parent]["parent"]
+        if parent is None:
+            totals[c] += s["duration_ms"]
+    totals["python"] = max(0.0, t["duration_ms"] - sum(totals.values()))
+    return totals
+
+
+def waterfall(t, width=50, min_ms=0.0):
+    total = t["duration_ms"] or 1e-9
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t["ts"]))
+    attrs = " ".join(f"{k}={v}" for k, v in t["attrs"].items())
+    parts = ", ".join(f"{k} {v:.1f}" for k, v in breakdown(t).items())
+    lines = [f"{t['name']}  {total:.1f} ms  {when}  {attrs}", f"  ({parts} ms)"]
+    depth = {}
+    for i, s in enumerate(t["spans"]):
+        depth[i] = 0 if s["parent"] is None else depth[s["parent"]] + 1
+        if i and s["duration_ms"] < min_ms:
+            continue
+        start = int(s["start_ms"] / total * width)
+        length = max(1, int(s["duration_ms"] / total * width))
+        bar = " " * start + "█" * min(length, width - start)
+        lines.append(f"  {s['start_ms']:>8.1f} {bar:<{width}} {'  ' * depth[i]}{s['name']} {s['duration_ms']:.1f}")
+    if t.get("profile"):
+        lines.append("  hottest stacks:")
+        for stack, n in sorted(t["profile"].items(), key=lambda kv: -kv[1])[:5]:
+            lines.append(f"    {n:>4}  {stack.split(';')[-1]}  <- {';'.join(stack.split(';')[-4:-1])}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Waterfall of the slowest traced updates")
+    parser.add_argument("--file", default=TRACE_FILE)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--name", help="only traces with this name, e.g. cb:MENU_BALANCE")
+    parser.add_argument("--min-span-ms", type=float, default=0.0, help="hide shorter child spans")
+    args = parser.parse_args()
+
+    traces = load(args.file)
+    if args.name:
+        traces = [t for t in traces if t["name"] == args.name]
+    if not traces:
+        print(f"No traces in {args.file}")
+        return
+    traces.sort(key=lambda t: t["duration_ms"], reverse=True)
+    for t in traces[:args.top]:
+        print(waterfall(t, min_ms=args.min_span_ms))
+        print()
+
+
+if __name__ == "__main__":
+    main()
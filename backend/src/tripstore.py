@@ -0,0 +1,205 @@
+import json
+import sys
+from array import array
+from collections.abc import Mapping, Sequence
+from functools import partial
+
+# --- Compact Trip Store ---
+# db.get_trip раньше отдавал каждую трату отдельным dict (плюс dict сплита, float и int
+# объектами на каждое значение и дублями ts/created_at). Здесь траты поездки лежат
+# колонками: суммы, время и id в array, user id интернированы, ключи сплитов — общие
+# кортежи на одинаковые наборы участников, доли — один array на всю поездку.
+# Снаружи это по-прежнему список mapping'ов: exp['amount'], exp.get('category'),
+# exp['split'].items() работают как раньше. Замер памяти: python -m benchmarks.memory
+
+# Columns stored in arrays / shared lists; anything else (later migrations) goes to `extra`
+_FIXED = ("id", "trip_id", "payer_id", "amount", "description", "category", "created_at", "split_json")
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class SplitView(Mapping):
+    """Read-only {user_id: share} over a slice of the trip's share array."""
+
+    __slots__ = ("_keys", "_values", "_start")
+
+    def __init__(self, keys, values, start):
+        self._keys = keys
+        self._values = values
+        self._start = start
+
+    def __getitem__(self, key):
+        try:
+            i = self._keys.index(key)
+        except ValueError:
+            raise KeyError(key) from None
+        return self._values[self._start + i]
+
+    def get(self, key, default=None):
+        try:
+            return self._values[self._start + self._keys.index(key)]
+        except ValueError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def values(self):
+        return self._values[self._start:self._start + len(self._keys)]
+
+    def items(self):
+        return list(zip(self._keys, self.values()))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class ExpenseRecord(Mapping):
+    """One expense: a view of row i of an ExpenseList, read like the old expense dict."""
+
+    __slots__ = ("_store", "_i")
+
+    def __init__(self, store, i):
+        self._store = store
+        self._i = i
+
+    def __getitem__(self, key):
+        column = self._store.columns.get(key)
+        if column is not None:
+            return column[self._i]
+        if key == "split":
+            return self._store.split(self._i)
+        if key == "trip_id":
+            return self._store.trip_id
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        column = self._store.columns.get(key)
+        if column is not None:
+            return column[self._i]
+        if key == "split":
+            return self._store.split(self._i)
+        if key == "trip_id":
+            return self._store.trip_id
+        return default
+
+    def __contains__(self, key):
+        return key in self._store.columns or key == "split" or key == "trip_id"
+
+    def __iter__(self):
+        return iter(self._store.keys)
+
+    def __len__(self):
+        return len(self._store.keys)
+
+    def to_dict(self):
+        """A plain dict, e.g. for json.dumps."""
+        d = {k: self[k] for k in self._store.keys}
+        d["split"] = dict(d["split"].items())
+        return d
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class ExpenseList(Sequence):
+    """A trip's expenses stored by column; indexing and iteration yield ExpenseRecord."""
+
+    def __init__(self, trip_id, extra_columns=()):
+        self.trip_id = trip_id
+        self.ids = array("q")
+        self.amounts = array("d")
+        self.created = array("q")
+        self.payers = []
+        self.descriptions = []
+        self.categories = []
+        # Split of row i: keys split_keys[i], shares split_values[split_offsets[i]:split_offsets[i + 1]]
+        self.split_keys = []
+        self.split_offsets = array("q", [0])
+        self.split_values = array("d")
+        self.extra = {name: [] for name in extra_columns}
+        # Record key -> column; "ts" is the alias the bot's logic reads
+        self.columns = {"id": self.ids, "payer_id": self.payers, "amount": self.amounts,
+                        "description": self.descriptions, "category": self.categories,
+                        "created_at": self.created, "ts": self.created, **self.extra}
+        self.keys = ("id", "trip_id", "payer_id", "amount", "description", "category", "created_at",
+                     *self.extra, "split", "ts")
+
+    @classmethod
+    def from_rows(cls, rows, trip_id):
+        """Raises TypeError / ValueError on rows that do not fit the arrays (NULL amount, ...)."""
+        rows = list(rows)
+        extra = [k for k in rows[0].keys() if k not in _FIXED] if rows else []
+        store = cls(trip_id, extra)
+        shared = {}      # description / category strings, one object per distinct value
+        key_tuples = {}  # one tuple per distinct set of split keys
+        for row in rows:
+            split = json.loads(row['split_json'])
+            if type(split) is not dict:
+                raise TypeError("split_json is not an object")
+            keys = tuple(map(sys.intern, split))
+            store.split_keys.append(key_tuples.setdefault(keys, keys))
+            store.split_values.extend(split.values())
+            store.split_offsets.append(len(store.split_values))
+            store.ids.append(row['id'])
+            store.amounts.append(row['amount'])
+            store.created.append(row['created_at'])
+            store.payers.append(_intern(row['payer_id']))
+            store.descriptions.append(shared.setdefault(row['description'], row['description']))
+            store.categories.append(shared.setdefault(row['category'], row['category']))
+            for name, column in store.extra.items():
+                column.append(row[name])
+        return store
+
+    def split(self, i):
+        return SplitView(self.split_keys[i], self.split_values, self.split_offsets[i])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ExpenseRecord(self, j) for j in range(*i.indices(len(self.ids)))]
+        if i < 0:
+            i += len(self.ids)
+        if not 0 <= i < len(self.ids):
+            raise IndexError("expense index out of range")
+        return ExpenseRecord(self, i)
+
+    def __iter__(self):
+        return map(partial(ExpenseRecord, self), range(len(self.ids)))
+
+    def __repr__(self):
+        return f"<ExpenseList {self.trip_id!r}: {len(self)} expenses>"
+
+
+def dict_expenses(rows):
+    """The pre-tripstore representation: one dict per expense."""
+    expenses = []
+    for row in rows:
+        exp = dict(row)
+        try:
+            exp['split'] = json.loads(row['split_json']) if row['split_json'] else {}
+        except ValueError:
+            exp['split'] = {}  # corrupt row: counted with no shares, as the API shows it
+        exp['ts'] = row['created_at']
+        del exp['split_json']
+        expenses.append(exp)
+    return expenses
+
+
+def expenses_from_rows(rows, trip_id):
+    """ExpenseList for the rows, or plain dicts when some row does not fit the arrays."""
+    try:
+        return ExpenseList.from_rows(rows, trip_id)
+    except (TypeError, ValueError, OverflowError):
+        # Old rows with NULL amount / created_at or odd split JSON keep the exact old shape
+        return dict_expenses(rows)
@@ -35,23 +35,24 @@ function GroupDetailsScreen({
   const expenses = useStore((state) => state.expenses);
   const currentTripMembers = useStore((state) => state.currentTripMembers);
   const balances = useStore((state) => state.balances);
+  const tripTotalSpent = useStore((state) => state.totalSpent);
   const groups = useStore((state) => state.groups);
   const user = useStore((state) => state.user);
   const loading = useStore((state) => state.loading);
-  const fetchExpenses = useStore((state) => state.fetchExpenses);
-  const fetchDebts = useStore((state) => state.fetchDebts);
-  const fetchTripMembers = useStore((state) => state.fetchTripMembers);
+  const fetchTripOverview = useStore((state) => state.fetchTripOverview);
+  const subscribeTripEvents = useStore((state) => state.subscribeTripEvents);
 
   useEffect(() => {
-    void fetchExpenses(tripId);
-    void fetchDebts(tripId);
-    void fetchTripMembers(tripId);
-  }, [tripId, fetchExpenses, fetchDebts, fetchTripMembers]);
+    void fetchTripOverview(tripId, ["members", "expenses", "balances", "debts"]);
+  }, [tripId, fetchTripOverview]);
+
+  useEffect(() => subscribeTripEvents(tripId), [tripId, subscribeTripEvents]);
 
   const trip = groups.find((group) => group.id === tripId);
   const currency = trip?.currency ?? "THB";
   const myBalance = user ? balances?.[String(user.id)] || 0 : 0;
-  const totalSpent = expenses.reduce((sum, expense) => sum + expense.amount, 0);
+  // The overview only returns the first page of expenses, so prefer the server-side total
+  const totalSpent = tripTotalSpent ?? expenses.reduce((sum, expense) => sum + expense.amount, 0);
 
   const filteredExpenses = useMemo(() => {
     if (!filterUser) {
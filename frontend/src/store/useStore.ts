@@ -143,6 +143,38 @@ interface GetTripsResponse {
   trips: TripDto[];
 }
 
+type OverviewField = "members" | "expenses" | "balances" | "debts" | "stats";
+
+// Expenses per overview page when the first page says there are more
+const OVERVIEW_EXPENSES_PAGE = 500;
+// Restarts of the page walk when the trip changes between pages
+const OVERVIEW_PAGE_ATTEMPTS = 3;
+
+interface GetTripOverviewResponse {
+  trip?: { id: string; version?: number };
+  members?: TripMemberDto[];
+  expenses?: ExpenseDto[];
+  expenses_page?: { limit: number; offset: number; total: number; has_more: boolean };
+  balances?: Record<string, number>;
+  total_spent?: number;
+  debts?: DebtTransactionDto[];
+  stats?: GetStatsResponse;
+}
+
+interface GetTripChangesResponse {
+  version: number;
+  reset: boolean;
+  expenses: ExpenseDto[];
+  notes: NoteDto[];
+  members: TripMemberDto[];
+  deleted: { expenses: string[]; notes: string[]; members: string[] };
+}
+
+interface TripVersion {
+  tripId: string;
+  version: number;
+}
+
 interface TripMemberDto {
   id: string;
   name: string;
@@ -160,6 +192,8 @@ interface StoreState {
   expenses: Expense[];
   debts: DebtTransaction[];
   balances: Record<string, number>;
+  totalSpent: number | null;
+  tripVersion: TripVersion | null;
   notes: Note[];
   stats: Stats | null;
   user: AppUser | null;
@@ -178,6 +212,19 @@ interface StoreState {
   createTrip: (name: string, currency: string) => Promise<boolean>;
   joinTrip: (code: string) => Promise<string | null>;
   fetchTripMembers: (tripId: string) => Promise<void>;
+  fetchTripOverview: (
+    tripId: string,
+    fields?: OverviewField[],
+    options?: SyncOptions,
+  ) => Promise<void>;
+  syncTripChanges: (tripId: string, options?: SyncOptions) => Promise<void>;
+  subscribeTripEvents: (tripId: string) => () => void;
+}
+
+// background: a refresh after a pushed event. It leaves `loading` and `error` alone (screens
+// would hide lists or disable Save mid-entry), and a failure waits for the next event.
+interface SyncOptions {
+  background?: boolean;
 }
 
 function mapTrip(dto: TripDto): Trip {
@@ -262,6 +309,105 @@ function mapCategoryRecord(record?: Record<string, number>): StatsCategory[] {
   }));
 }
 
+function mapStats(data: GetStatsResponse): Stats {
+  const myFromRecord = mapCategoryRecord(data.my_category ?? data.my_by_category);
+  const overallFromRecord = mapCategoryRecord(data.by_category);
+
+  return {
+    my:
+      myFromRecord.length > 0
+        ? myFromRecord
+        : (data.my ?? data.mine ?? []).map(mapStatsCategory),
+    overall:
+      overallFromRecord.length > 0
+        ? overallFromRecord
+        : (data.overall ?? data.total ?? []).map(mapStatsCategory),
+  };
+}
+
+function withCurrentUserName(member: TripMember, currentUser: AppUser | null): TripMember {
+  if (
+    currentUser &&
+    String(member.id) === String(currentUser.id) &&
+    (member.name === "User" || member.name === "Unknown")
+  ) {
+    return { ...member, name: currentUser.firstName };
+  }
+
+  return member;
+}
+
+/**
+ * Loads the expense pages after the first one. If the trip version changes between
+ * pages (an added or deleted expense shifts the offsets), the walk starts over from
+ * offset 0; after OVERVIEW_PAGE_ATTEMPTS it keeps the last walk with the version of its
+ * first page, so the next delta sync brings in anything that moved.
+ */
+async function fetchAllOverviewExpenses(
+  tripId: string,
+  first: GetTripOverviewResponse,
+): Promise<{ expenses: ExpenseDto[]; version?: number }> {
+  const url = `${API_BASE_URL}/api/trips/${encodeURIComponent(tripId)}/overview`;
+  const fetchPage = async (offset: number) => {
+    const params = new URLSearchParams({
+      fields: "expenses",
+      limit: String(OVERVIEW_EXPENSES_PAGE),
+      offset: String(offset),
+    });
+    const response = await fetch(`${url}?${params.toString()}`);
+    if (!response.ok) {
+      throw new Error(`Failed to fetch trip overview: ${response.status}`);
+    }
+    return (await response.json()) as GetTripOverviewResponse;
+  };
+
+  let page = first;
+  let expenses: ExpenseDto[] = [];
+  let version = first.trip?.version;
+
+  for (let attempt = 0; attempt < OVERVIEW_PAGE_ATTEMPTS; attempt += 1) {
+    if (attempt > 0) {
+      page = await fetchPage(0);
+    }
+    version = page.trip?.version;
+    expenses = [...(page.expenses ?? [])];
+    let consistent = true;
+
+    while (page.expenses?.length && page.expenses_page?.has_more) {
+      page = await fetchPage(expenses.length);
+      expenses.push(...(page.expenses ?? []));
+      consistent = consistent && page.trip?.version === version;
+    }
+
+    if (consistent) {
+      break;
+    }
+  }
+
+  const seen = new Set<string>();
+  const unique = expenses.filter((expense) => {
+    if (seen.has(expense.id)) {
+      return false;
+    }
+    seen.add(expense.id);
+    return true;
+  });
+  return { expenses: unique, version };
+}
+
+function mergeById<T extends { id: string }>(
+  current: T[],
+  updated: T[],
+  deletedIds: string[],
+): T[] {
+  const removed = new Set([...deletedIds, ...updated.map((item) => item.id)].map(String));
+  return [...current.filter((item) => !removed.has(String(item.id))), ...updated];
+}
+
+function byNewest(a: Expense, b: Expense): number {
+  return Number(b.createdAt) - Number(a.createdAt) || Number(b.id) - Number(a.id);
+}
+
 export const useStore = create<StoreState>((set, get) => ({
   currentTripId: null,
   groups: [],
@@ -269,6 +415,8 @@ export const useStore = create<StoreState>((set, get) => ({
   expenses: [],
   debts: [],
   balances: {},
+  totalSpent: null,
+  tripVersion: null,
   notes: [],
   stats: null,
   user: null,
@@ -576,20 +724,8 @@ export const useStore = create<StoreState>((set, get) => ({
       }
 
       const data = (await response.json()) as GetStatsResponse;
-      const myFromRecord = mapCategoryRecord(data.my_category ?? data.my_by_category);
-      const overallFromRecord = mapCategoryRecord(data.by_category);
-
       set({
-        stats: {
-          my:
-            myFromRecord.length > 0
-              ? myFromRecord
-              : (data.my ?? data.mine ?? []).map(mapStatsCategory),
-          overall:
-            overallFromRecord.length > 0
-              ? overallFromRecord
-              : (data.overall ?? data.total ?? []).map(mapStatsCategory),
-        },
+        stats: mapStats(data),
         loading: false,
         error: null,
       });
@@ -616,18 +752,9 @@ export const useStore = create<StoreState>((set, get) => ({
       const data = (await response.json()) as GetTripMembersResponse;
       const currentUser = get().user;
       set({
-        currentTripMembers: data.members.map((member) => {
-          const mapped = mapTripMember(member);
-          if (
-            currentUser &&
-            String(mapped.id) === String(currentUser.id) &&
-            (mapped.name === "User" || mapped.name === "Unknown")
-          ) {
-            return { ...mapped, name: currentUser.firstName };
-          }
-
-          return mapped;
-        }),
+        currentTripMembers: data.members.map((member) =>
+          withCurrentUserName(mapTripMember(member), currentUser),
+        ),
         loading: false,
         error: null,
       });
@@ -639,6 +766,169 @@ export const useStore = create<StoreState>((set, get) => ({
     }
   },
 
+  fetchTripOverview: async (tripId, fields, options) => {
+    const background = options?.background ?? false;
+    if (!background) {
+      set((state) => ({
+        loading: true,
+        error: null,
+        currentTripId: tripId,
+        // Another trip: the previous one's totals (and the expenses the screen sums when
+        // totalSpent is null) must not show while, or if, this request is loading
+        ...(state.currentTripId !== tripId && {
+          balances: {},
+          totalSpent: null,
+          expenses: [],
+          debts: [],
+        }),
+      }));
+    }
+
+    try {
+      const params = new URLSearchParams();
+      if (fields && fields.length > 0) {
+        params.set("fields", fields.join(","));
+      }
+      const userId = get().user?.id;
+      if (userId) {
+        params.set("user_id", String(userId));
+      }
+      const query = params.toString();
+      const response = await fetch(
+        `${API_BASE_URL}/api/trips/${encodeURIComponent(tripId)}/overview${query ? `?${query}` : ""}`,
+      );
+
+      if (!response.ok) {
+        throw new Error(`Failed to fetch trip overview: ${response.status}`);
+      }
+
+      const data = (await response.json()) as GetTripOverviewResponse;
+      if (data.expenses && data.expenses_page?.has_more) {
+        // The list, the payer filter and expense details all need every expense of the trip
+        const all = await fetchAllOverviewExpenses(tripId, data);
+        data.expenses = all.expenses;
+        data.trip = { id: tripId, ...data.trip, version: all.version };
+      }
+      if (background && get().currentTripId !== tripId) {
+        return;
+      }
+      const currentUser = get().user;
+      set({
+        ...(data.members && {
+          currentTripMembers: data.members.map((member) =>
+            withCurrentUserName(mapTripMember(member), currentUser),
+          ),
+        }),
+        ...(data.expenses && { expenses: data.expenses.map(mapExpense) }),
+        ...(data.debts && { debts: data.debts.map(mapDebt) }),
+        ...(data.balances && { balances: data.balances, totalSpent: data.total_spent ?? null }),
+        ...(data.stats && { stats: mapStats(data.stats) }),
+        // Only a response with expenses tells us which version the local list reflects
+        ...(data.expenses &&
+          data.trip?.version !== undefined && {
+            tripVersion: { tripId, version: data.trip.version },
+          }),
+        ...(!background && { loading: false, error: null }),
+      });
+    } catch (error) {
+      if (background) {
+        return;
+      }
+      set({
+        loading: false,
+        error: error instanceof Error ? error.message : "Unknown error",
+      });
+    }
+  },
+
+  syncTripChanges: async (tripId, options) => {
+    const background = options?.background ?? false;
+    const { tripVersion } = get();
+    const since = tripVersion?.tripId === tripId ? tripVersion.version : 0;
+
+    try {
+      const response = await fetch(
+        `${API_BASE_URL}/api/trips/${encodeURIComponent(tripId)}/changes?since=${since}`,
+      );
+
+      if (!response.ok) {
+        throw new Error(`Failed to sync trip changes: ${response.status}`);
+      }
+
+      const data = (await response.json()) as GetTripChangesResponse;
+      if (background && get().currentTripId !== tripId) {
+        return;
+      }
+      const currentUser = get().user;
+      const expenses = data.expenses.map(mapExpense);
+      const notes = data.notes.map(mapNote);
+      const members = data.members.map((member) =>
+        withCurrentUserName(mapTripMember(member), currentUser),
+      );
+
+      set((state) => ({
+        expenses: (data.reset
+          ? expenses
+          : mergeById(state.expenses, expenses, data.deleted.expenses)
+        ).sort(byNewest),
+        notes: data.reset ? notes : mergeById(state.notes, notes, data.deleted.notes),
+        currentTripMembers: data.reset
+          ? members
+          : mergeById(state.currentTripMembers, members, data.deleted.members),
+        tripVersion: { tripId, version: data.version },
+        ...(!background && { loading: false, error: null }),
+      }));
+    } catch (error) {
+      if (background) {
+        return;
+      }
+      set({
+        loading: false,
+        error: error instanceof Error ? error.message : "Unknown error",
+      });
+    }
+  },
+
+  subscribeTripEvents: (tripId) => {
+    const source = new EventSource(
+      `${API_BASE_URL}/api/trips/${encodeURIComponent(tripId)}/events`,
+    );
+    let syncing = false;
+    let pending = false;
+
+    // Bursts of events collapse into one in-flight sync plus at most one follow-up
+    const sync = async () => {
+      if (syncing) {
+        pending = true;
+        return;
+      }
+      syncing = true;
+      do {
+        pending = false;
+        await get().syncTripChanges(tripId, { background: true });
+        await get().fetchTripOverview(tripId, ["balances", "debts"], {
+          background: true,
+        });
+      } while (pending);
+      syncing = false;
+    };
+
+    const onEvent = (event: MessageEvent<string>) => {
+      const { v } = JSON.parse(event.data) as { v: number };
+      const known = get().tripVersion;
+      if (known?.tripId === tripId && known.version >= v) {
+        return;
+      }
+      void sync();
+    };
+
+    source.addEventListener("hello", onEvent);
+    source.addEventListener("change", onEvent);
+    source.addEventListener("resync", onEvent);
+
+    return () => source.close();
+  },
+
   addExpense: async (expenseInput) => {
     set({ loading: true, error: null });
 
@@ -657,7 +947,7 @@ export const useStore = create<StoreState>((set, get) => ({
 
       const { currentTripId } = get();
       if (currentTripId && currentTripId === expenseInput.trip_id) {
-        await get().fetchExpenses(currentTripId);
+        await get().syncTripChanges(currentTripId);
       } else {
         set({ loading: false, error: null });
       }